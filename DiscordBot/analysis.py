@@ -0,0 +1,341 @@
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from metrics import ANALYSIS_LATENCY, ANALYSIS_BATCH, ANALYSIS_ERRORS
+from tracing import span
+
+'''
+CPU-bound analysis of messages in a pool of worker processes.
+
+The event loop thread also sends the gateway heartbeats, so work that takes milliseconds of CPU
+per message (hashing images, scoring text locally) runs in worker processes instead:
+
+    result = await analysis.pool.run("hash_images", data)
+
+A stage is registered by name with the function implementing it, as "module:function" like the
+detector backends. The function takes a list of payloads and returns a list of results, one per
+payload, so the items submitted to a stage within BATCH_DELAY of each other (up to the stage's
+batch size) are sent to a worker in one call. That pays for the inter-process round trip once
+per batch, and lets a stage process a batch at once (hash_images stacks the images into one
+NumPy array).
+
+Workers are warm: when a worker process starts, it imports the module of every stage and calls
+the module's warm() function if it has one, to load models and lexicons once. warm() starts every
+worker after the bot has connected, so the first messages do not wait for them.
+
+Payloads of at least SHARED_MEMORY_MIN_BYTES bytes (attachments) are copied once into shared
+memory, and the worker gets a memoryview of that block instead of a pickled copy sent through a
+pipe. The memoryview is only valid during the call.
+
+Each stage has a timeout. An item that is not done in time raises AnalysisTimeout; a worker that
+is already running it keeps going (a process cannot be interrupted safely), but its result is
+dropped. If a worker dies, every item sent to the pool raises AnalysisError and the pool is
+started again for the next items, so callers can treat a crash like a timeout.
+
+The workers are not forked from the bot, whose store writer and logging threads may hold locks at
+the time of the fork. On POSIX they are forked from a forkserver process (which preloads this
+module), elsewhere they are spawned. Either way a worker imports the main script again, so it must
+only start the bot under `if __name__ == '__main__'`.
+'''
+
+logger = logging.getLogger('discord')
+
+# Number of worker processes
+ANALYSIS_WORKERS = 2
+# Seconds an item waits for more items of its stage before its batch is sent to a worker
+BATCH_DELAY = 0.002
+# Default maximum number of items per batch
+BATCH_SIZE = 32
+# Payloads of at least this many bytes are passed to the workers through shared memory
+SHARED_MEMORY_MIN_BYTES = 64 * 1024
+# Default seconds an item may take, from submission to result
+STAGE_TIMEOUT = 10
+
+
+class AnalysisError(Exception):
+    '''
+    Raised when a stage gives no result for an item because the workers failed (a worker died, or the pool
+    could not start).
+    '''
+    pass
+
+
+class AnalysisTimeout(AnalysisError):
+    pass
+
+
+class SharedPayload:
+    '''
+    Picklable handle of a payload copied into a shared memory block.
+    '''
+    __slots__ = ("name", "size")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class Stage:
+    __slots__ = ("name", "target", "timeout", "batch_size")
+
+    def __init__(self, name, target, timeout=STAGE_TIMEOUT, batch_size=BATCH_SIZE):
+        self.name = name
+        self.target = target # "module:function"
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+
+### Worker side ###
+
+functions = {} # Map from "module:function" to the function, in each worker
+
+
+def load_function(target):
+    function = functions.get(target)
+    if function is None:
+        module_name, name = target.split(":")
+        function = functions[target] = getattr(importlib.import_module(module_name), name)
+    return function
+
+
+def warm_worker(targets):
+    '''
+    Initializer of the worker processes: imports the stages and calls the warm() function of their modules.
+    '''
+    warmed = set()
+    for target in targets:
+        module_name = target.split(":")[0]
+        try:
+            load_function(target)
+            warm = getattr(importlib.import_module(module_name), "warm", None)
+            if warm is not None and module_name not in warmed:
+                warm()
+        except Exception as e:
+            # The stage fails when it is used; the other stages still work
+            logger.warning(f"Could not load analysis stage {target}: {e}")
+        warmed.add(module_name)
+
+
+def run_batch(target, payloads):
+    '''
+    Runs a stage function on a batch in a worker process.
+    '''
+    blocks = []
+    views = []
+    args = []
+    for payload in payloads:
+        if isinstance(payload, SharedPayload):
+            block = shared_memory.SharedMemory(payload.name)
+            blocks.append(block)
+            view = block.buf[:payload.size]
+            views.append(view)
+            args.append(view)
+        else:
+            args.append(payload)
+    try:
+        return load_function(target)(args)
+    finally:
+        del args
+        for view in views:
+            view.release()
+        for block in blocks:
+            block.close()
+
+
+def ping():
+    return True
+
+
+### Event loop side ###
+
+class AnalysisPool:
+    def __init__(self, workers=ANALYSIS_WORKERS, batch_delay=BATCH_DELAY, shared_memory_min_bytes=SHARED_MEMORY_MIN_BYTES):
+        self.workers = workers
+        self.batch_delay = batch_delay
+        self.shared_memory_min_bytes = shared_memory_min_bytes
+        self.stages = {} # Map from stage name to Stage
+        self.executor = None # Started on the first item, or by warm()
+        self.batches = {} # Map from stage name to [(payload, future)] waiting to be sent
+        self.flush_handles = {} # Map from stage name to the call_later handle that sends its batch
+        self.in_flight = {} # Map from the concurrent future of each batch sent to the current executor to (batch, blocks)
+        self.blocks = set() # Shared memory blocks of the batches being processed
+
+    def __contains__(self, name):
+        return name in self.stages
+
+    def register(self, name, target, timeout=STAGE_TIMEOUT, batch_size=BATCH_SIZE):
+        '''
+        Registers a stage. target is "module:function"; the function takes a list of payloads and returns a
+        list of results. Stages registered after the workers started are imported by them on first use.
+        '''
+        self.stages[name] = Stage(name, target, timeout, batch_size)
+
+    def start(self):
+        if self.executor is None:
+            if os.name == "posix":
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["analysis"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            targets = [stage.target for stage in self.stages.values()]
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=warm_worker,
+                                                initargs=(targets,))
+        return self.executor
+
+    async def warm(self):
+        '''
+        Starts the worker processes and waits until each has loaded the stages. Errors are logged.
+        '''
+        try:
+            executor = self.start()
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(executor, ping) for _ in range(self.workers)))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"Could not start the analysis workers: {e}")
+
+    async def run(self, name, payload):
+        '''
+        Returns the result of stage name for payload, computed in a worker process. Raises AnalysisTimeout if it
+        takes longer than the stage's timeout, AnalysisError if the workers failed (they are restarted), and the
+        exception of the stage function if it fails.
+        '''
+        stage = self.stages[name]
+        future = asyncio.get_running_loop().create_future()
+        batch = self.batches.setdefault(name, [])
+        batch.append((payload, future))
+        if len(batch) >= stage.batch_size:
+            self.flush(name)
+        elif name not in self.flush_handles:
+            self.flush_handles[name] = asyncio.get_running_loop().call_later(self.batch_delay, self.flush, name)
+
+        start = time.perf_counter()
+        try:
+            with span(f"analysis.{name}"):
+                return await asyncio.wait_for(future, stage.timeout)
+        except asyncio.TimeoutError:
+            ANALYSIS_ERRORS.labels(name, "timeout").inc()
+            raise AnalysisTimeout(f"Analysis stage {name} took longer than {stage.timeout}s") from None
+        except AnalysisError:
+            ANALYSIS_ERRORS.labels(name, "unavailable").inc()
+            raise
+        except Exception:
+            ANALYSIS_ERRORS.labels(name, "error").inc()
+            raise
+        finally:
+            ANALYSIS_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+    def flush(self, name):
+        '''
+        Sends the waiting items of a stage to a worker.
+        '''
+        handle = self.flush_handles.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        # Items that timed out before their batch was sent are dropped
+        batch = [(payload, future) for payload, future in self.batches.pop(name, []) if not future.done()]
+        if not batch:
+            return
+        ANALYSIS_BATCH.labels(name).observe(len(batch))
+        blocks = []
+        try:
+            payloads = [self.share(payload, blocks) for payload, _ in batch]
+        except OSError as e:
+            self.release(blocks)
+            self.fail(batch, AnalysisError(f"Could not share a payload with the analysis workers: {e}"))
+            return
+        try:
+            submitted = self.start().submit(run_batch, self.stages[name].target, payloads)
+        except (OSError, RuntimeError, BrokenProcessPool) as e:
+            self.release(blocks)
+            self.restart(e)
+            self.fail(batch, AnalysisError(f"Analysis workers are unavailable: {e}"))
+            return
+        self.in_flight[submitted] = (batch, blocks)
+        asyncio.wrap_future(submitted).add_done_callback(lambda done: self.finish(batch, blocks, done, submitted))
+
+    def share(self, payload, blocks):
+        '''
+        Returns the payload to send to a worker: a SharedPayload for large bytes, the payload itself otherwise.
+        '''
+        if not isinstance(payload, (bytes, bytearray, memoryview)) or len(payload) < self.shared_memory_min_bytes:
+            return payload
+        block = shared_memory.SharedMemory(create=True, size=len(payload))
+        blocks.append(block)
+        self.blocks.add(block)
+        block.buf[:len(payload)] = payload
+        return SharedPayload(block.name, len(payload))
+
+    def finish(self, batch, blocks, done, submitted):
+        self.release(blocks)
+        if done.cancelled():
+            error = AnalysisError("Analysis batch was cancelled by a restart of the workers")
+        else:
+            error = done.exception()
+        if self.in_flight.pop(submitted, None) is None:
+            # Sent to an executor that restart() or close() dropped; its items have already failed
+            return
+        if isinstance(error, BrokenProcessPool):
+            self.restart(error)
+            error = AnalysisError(f"Analysis worker died: {error}")
+        if error is None:
+            results = done.result()
+            if len(results) != len(batch):
+                error = RuntimeError(f"Analysis stage returned {len(results)} results for {len(batch)} items")
+        if error is not None:
+            self.fail(batch, error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def fail(self, batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def release(self, blocks):
+        for block in blocks:
+            # close() releases the blocks of the batches still in flight, which finish afterwards
+            if block in self.blocks:
+                self.blocks.discard(block)
+                block.close()
+                block.unlink()
+
+    def restart(self, error):
+        '''
+        Drops a broken pool; the next batch starts a new one. The batches sent to the old pool fail now, so their
+        results (or failures) cannot arrive after the new pool started.
+        '''
+        if self.executor is not None:
+            logger.warning(f"Restarting the analysis workers: {error}")
+            in_flight, self.in_flight = self.in_flight, {}
+            for batch, blocks in in_flight.values():
+                self.release(blocks)
+                self.fail(batch, AnalysisError(f"Analysis workers were restarted: {error}"))
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def close(self):
+        for handle in self.flush_handles.values():
+            handle.cancel()
+        self.flush_handles.clear()
+        for batch in self.batches.values():
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+        self.batches.clear()
+        self.in_flight.clear()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        self.release(list(self.blocks))
+
+
+pool = AnalysisPool()
+pool.register("hash_images", "attachments:hash_images", timeout=30, batch_size=16)
@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
+from records import REPORT_CODED_FIELDS, REVIEW_CODED_FIELDS
+
+'''
+Analytics export of the report and review history.
+
+    python analytics.py export [--db reports.db] [--dir analytics]
+    python analytics.py aggregate [--dir analytics] [--days 14] [--json]
+
+While the bot runs, AnalyticsExporter follows the reports and reviews tables of the store (by row
+id, like the risk profiles do) and appends every completed report and review outcome to files
+partitioned by table and UTC day:
+
+    analytics/reports/date=2024-05-30/part-000000001201-000000001460.json.gz
+    analytics/reviews/date=2024-05-30/part-000000000311-000000000342.json.gz
+
+A part holds one batch in columns ({"column": [value of each row]}), as Parquet instead when
+pyarrow is installed. Parts are never changed once written; the id of the last exported row of
+each table is kept in _cursor.json, so an export picks up exactly where the previous one stopped.
+Names and message contents are not exported.
+
+Report columns: the answers of the report (category and sub-types), source ("user" or the detector
+that made the report), reporter count, confidence and times. Review columns: the answers of the
+moderator (legitimate, category, sexual threat type, severity), the action taken, the category of
+the report and the time from the report to the review.
+
+`aggregate` reads only the parts written since its previous run and adds them to the totals kept
+in _aggregates.json: report volumes per day, category and source, time to review per category,
+and the precision of each detector (the share of the messages it flagged that moderators found
+to be legitimate abuse), with user reports as the baseline.
+'''
+
+logger = logging.getLogger('discord')
+
+ANALYTICS_DIR = 'analytics'
+# Seconds between exports while the bot runs
+EXPORT_INTERVAL = 5 * 60
+# Rows read from the store at a time, and so the largest part
+EXPORT_BATCH = 5000
+CURSOR_FILE = '_cursor.json'
+AGGREGATES_FILE = '_aggregates.json'
+# Upper bounds in seconds of the time to review histogram buckets
+TIME_TO_REVIEW_BUCKETS = (60, 5 * 60, 15 * 60, 60 * 60, 4 * 60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60, math.inf)
+# Flagged messages that are not reviewed within this many seconds are no longer matched to a review
+FLAGGED_MAX_AGE = 30 * 24 * 60 * 60
+
+parquet = None # pyarrow, once imported
+
+
+def load_parquet():
+    '''
+    Returns pyarrow (with pyarrow.parquet imported) if it is installed, else None.
+    '''
+    global parquet
+    if parquet is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            parquet = False
+        else:
+            parquet = pyarrow
+    return parquet or None
+
+
+def value_name(value):
+    return value.name if isinstance(value, Enum) else value
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def action_for(review):
+    if not review.get("legitimate"):
+        return "dismiss"
+    return {2: "kick", 3: "escalate"}.get(review.get("severity"), "none")
+
+
+def report_row(row_id, reporter_id, source, created_at, record):
+    if source is None:
+        # Stored before the source was recorded; only the bot's own reports have no reporter
+        source = "user" if record.reporter_ids else "detector"
+    row = {
+        "id": row_id,
+        "created_at": created_at,
+        "reported_at": record.reported_at or created_at,
+        "guild_id": record.guild_id,
+        "channel_id": record.channel_id,
+        "message_id": record.message_id,
+        "source": source,
+        "reporter_count": record.reporter_count,
+        "confidence": record.confidence,
+        "has_context": record.context_content is not None,
+    }
+    for field in REPORT_CODED_FIELDS:
+        row[field] = value_name(record.get(field))
+    return row
+
+
+def review_row(row_id, moderator_id, created_at, record, review):
+    reported_at = record.reported_at or None
+    row = {
+        "id": row_id,
+        "reviewed_at": created_at,
+        "reported_at": reported_at,
+        "time_to_review": created_at - reported_at if reported_at else None,
+        "moderator_id": moderator_id,
+        "guild_id": record.guild_id,
+        "channel_id": record.channel_id,
+        "message_id": record.message_id,
+        "report_category": value_name(record.category),
+        "reporter_count": record.reporter_count,
+        "confidence": record.confidence,
+        "action": action_for(review),
+    }
+    for field in REVIEW_CODED_FIELDS:
+        row[field] = value_name(review.get(field))
+    return row
+
+
+def write_json(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_part(path, columns):
+    '''
+    Writes columns ({name: [values]}) to path plus the extension of the format used. Returns the full path.
+    '''
+    pyarrow = load_parquet()
+    path += ".parquet" if pyarrow else ".json.gz"
+    temp_path = path + ".tmp"
+    if pyarrow:
+        pyarrow.parquet.write_table(pyarrow.table(columns), temp_path)
+    else:
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(columns, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+    return path
+
+
+def read_part(path):
+    '''
+    Returns the columns of a part written by write_part().
+    '''
+    if path.endswith(".parquet"):
+        pyarrow = load_parquet()
+        if not pyarrow:
+            raise RuntimeError(f"pyarrow is needed to read {path}")
+        return pyarrow.parquet.read_table(path).to_pydict()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def part_ids(name):
+    '''
+    Returns (first id, last id) of a part file name, or None if name is not a part.
+    '''
+    if not name.startswith("part-") or name.endswith(".tmp"):
+        return None
+    first, last = name[len("part-"):].split(".")[0].split("-")
+    return int(first), int(last)
+
+
+def rows(columns):
+    names = list(columns)
+    for values in zip(*(columns[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+class AnalyticsExporter:
+    def __init__(self, store, directory=ANALYTICS_DIR, batch_size=EXPORT_BATCH):
+        self.store = store
+        self.directory = directory
+        self.batch_size = batch_size
+        self.cursor = read_json(os.path.join(directory, CURSOR_FILE), {"reports": 0, "reviews": 0}) # Last exported row id of each table
+        self.lock = threading.Lock() # Exports run in a thread, and once more on shutdown
+
+    def tables(self):
+        return (
+            ("reports", self.store.report_rows_since, report_row, "created_at"),
+            ("reviews", self.store.review_rows_since, review_row, "reviewed_at"),
+        )
+
+    def export(self):
+        '''
+        Appends the reports and review outcomes stored since the last export to the analytics files. Returns the
+        number of rows exported.
+        '''
+        exported = 0
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for table, rows_since, to_row, time_column in self.tables():
+                while True:
+                    batch = [to_row(*row) for row in rows_since(self.cursor[table], self.batch_size)]
+                    if not batch:
+                        break
+                    # Each run of rows from the same day is a part, so the parts of a table never overlap in ids
+                    # and are written in id order (rows of several processes are not stored exactly in time order)
+                    runs = []
+                    for row in batch:
+                        day = day_of(row[time_column])
+                        if runs and runs[-1][0] == day:
+                            runs[-1][1].append(row)
+                        else:
+                            runs.append((day, [row]))
+                    for day, day_rows in runs:
+                        self.write(table, day, day_rows)
+                    self.cursor[table] = batch[-1]["id"]
+                    write_json(os.path.join(self.directory, CURSOR_FILE), self.cursor)
+                    exported += len(batch)
+                    if len(batch) < self.batch_size:
+                        break
+        return exported
+
+    def write(self, table, day, day_rows):
+        partition = os.path.join(self.directory, table, f"date={day}")
+        os.makedirs(partition, exist_ok=True)
+        columns = {name: [row[name] for row in day_rows] for name in day_rows[0]}
+        return write_part(os.path.join(partition, f"part-{day_rows[0]['id']:012d}-{day_rows[-1]['id']:012d}"), columns)
+
+    async def watch(self, interval=EXPORT_INTERVAL):
+        '''
+        Background task that exports new rows every interval seconds.
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                exported = await asyncio.to_thread(self.export)
+            except OSError as e:
+                logger.warning(f"Could not export analytics to {self.directory}: {e}")
+                continue
+            if exported:
+                logger.info(f"Exported {exported} rows to {self.directory}")
+
+
+class Aggregates:
+    '''
+    Totals over every part added with add_part(), saved to and loaded from a JSON file.
+    '''
+    def __init__(self, data=None):
+        data = data or {}
+        self.done = data.get("done", {"reports": 0, "reviews": 0}) # Last row id aggregated of each table
+        self.done_day = data.get("done_day", {}) # Partition of that row; older partitions are not listed again
+        self.volumes = data.get("volumes", {}) # Map from day to category to source to the number of reports
+        self.time_to_review = data.get("time_to_review", {}) # Map from category to count, sum and bucket counts
+        self.precision = data.get("precision", {}) # Map from source to the number of reported, reviewed and confirmed messages
+        self.flagged = data.get("flagged", {}) # Map from message key to [source, time] of reported messages not reviewed yet
+
+    def to_dict(self):
+        return {"done": self.done, "done_day": self.done_day, "volumes": self.volumes, "time_to_review": self.time_to_review,
+                "precision": self.precision, "flagged": self.flagged}
+
+    def add_reports(self, columns):
+        for row in rows(columns):
+            category = row["category"] or "UNKNOWN"
+            day = self.volumes.setdefault(day_of(row["created_at"]), {}).setdefault(category, {})
+            day[row["source"]] = day.get(row["source"], 0) + 1
+            self.count(row["source"], "reported")
+            key = f'{row["guild_id"]}:{row["channel_id"]}:{row["message_id"]}'
+            # A message reported by a detector counts for the detector even if users report it too
+            if key not in self.flagged or self.flagged[key][0] == "user":
+                self.flagged[key] = [row["source"], row["created_at"]]
+
+    def add_reviews(self, columns):
+        for row in rows(columns):
+            key = f'{row["guild_id"]}:{row["channel_id"]}:{row["message_id"]}'
+            source = self.flagged.pop(key, ["user"])[0]
+            self.count(source, "reviewed")
+            if row["legitimate"]:
+                self.count(source, "confirmed")
+            if row["time_to_review"] is not None:
+                stats = self.time_to_review.setdefault(row["report_category"] or "UNKNOWN",
+                                                       {"count": 0, "sum": 0.0, "buckets": [0] * len(TIME_TO_REVIEW_BUCKETS)})
+                stats["count"] += 1
+                stats["sum"] += row["time_to_review"]
+                stats["buckets"][next(i for i, bound in enumerate(TIME_TO_REVIEW_BUCKETS) if row["time_to_review"] <= bound)] += 1
+
+    def count(self, source, outcome):
+        counts = self.precision.setdefault(source, {"reported": 0, "reviewed": 0, "confirmed": 0})
+        counts[outcome] += 1
+
+    def prune(self, now=None):
+        cutoff = (time.time() if now is None else now) - FLAGGED_MAX_AGE
+        self.flagged = {key: value for key, value in self.flagged.items() if value[1] >= cutoff}
+
+    def new_parts(self, directory, table):
+        '''
+        Returns [(first id, last id, day, path)] of the parts of table not aggregated yet, oldest first.
+        '''
+        table_dir = os.path.join(directory, table)
+        if not os.path.isdir(table_dir):
+            return []
+        parts = []
+        # Rows around midnight can land in the previous day's partition after rows of the next day
+        done_day = self.done_day.get(table)
+        if done_day is not None:
+            done_day = (datetime.strptime(done_day, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        for partition in sorted(os.listdir(table_dir)):
+            day = partition[len("date="):]
+            if not partition.startswith("date=") or done_day is not None and day < done_day:
+                continue
+            for name in os.listdir(os.path.join(table_dir, partition)):
+                ids = part_ids(name)
+                if ids is not None and ids[1] > self.done[table]:
+                    parts.append((*ids, day, os.path.join(table_dir, partition, name)))
+        return sorted(parts)
+
+    def update(self, directory):
+        '''
+        Adds the parts written since the last update. Returns the number of parts read.
+        '''
+        read = 0
+        # Reports first, so the reviews of messages reported in the same period find them
+        for table, add in (("reports", self.add_reports), ("reviews", self.add_reviews)):
+            for first, last, day, path in self.new_parts(directory, table):
+                add(read_part(path))
+                self.done[table] = max(self.done[table], last)
+                self.done_day[table] = max(self.done_day.get(table, ""), day)
+                read += 1
+        self.prune()
+        return read
+
+
+def format_duration(seconds):
+    if seconds == math.inf:
+        return "longer"
+    for unit, size in (("d", 24 * 60 * 60), ("h", 60 * 60), ("m", 60)):
+        if seconds >= size:
+            return f"{seconds / size:.1f}{unit}"
+    return f"{seconds:.0f}s"
+
+
+def bucket_percentile(buckets, fraction):
+    '''
+    Returns the upper bound of the bucket holding the given fraction of the observations.
+    '''
+    target = fraction * sum(buckets)
+    seen = 0
+    for bound, count in zip(TIME_TO_REVIEW_BUCKETS, buckets):
+        seen += count
+        if seen >= target:
+            return bound
+    return math.inf
+
+
+def print_summary(aggregates, days):
+    recent = sorted(aggregates.volumes)[-days:]
+    sources = sorted({source for day in recent for counts in aggregates.volumes[day].values() for source in counts})
+    print(f"Reports per category, last {len(recent)} days")
+    print(f"{'category':<20}{'total':>8}" + "".join(f"{source:>13}" for source in sources))
+    totals = {}
+    for day in recent:
+        for category, counts in aggregates.volumes[day].items():
+            category_totals = totals.setdefault(category, {})
+            for source, count in counts.items():
+                category_totals[source] = category_totals.get(source, 0) + count
+    for category, counts in sorted(totals.items()):
+        print(f"{category:<20}{sum(counts.values()):>8}" + "".join(f"{counts.get(source, 0):>13}" for source in sources))
+
+    print("\nTime to review (all time)")
+    print(f"{'category':<20}{'reviews':>8}{'mean':>9}{'median':>9}{'p90':>9}")
+    for category, stats in sorted(aggregates.time_to_review.items()):
+        print(f"{category:<20}{stats['count']:>8}{format_duration(stats['sum'] / stats['count']):>9}"
+              f"{'<' + format_duration(bucket_percentile(stats['buckets'], 0.5)):>9}"
+              f"{'<' + format_duration(bucket_percentile(stats['buckets'], 0.9)):>9}")
+
+    print("\nPrecision against moderator decisions (all time)")
+    print(f"{'source':<14}{'reported':>9}{'reviewed':>10}{'confirmed':>11}{'precision':>11}")
+    for source, counts in sorted(aggregates.precision.items()):
+        precision = f"{counts['confirmed'] / counts['reviewed']:.1%}" if counts["reviewed"] else "-"
+        print(f"{source:<14}{counts['reported']:>9}{counts['reviewed']:>10}{counts['confirmed']:>11}{precision:>11}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export and aggregate the report and review history.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export the rows stored since the last export")
+    export_parser.add_argument("--db", default="reports.db")
+    export_parser.add_argument("--dir", default=ANALYTICS_DIR)
+    aggregate_parser = commands.add_parser("aggregate", help="add the new parts to the totals and print them")
+    aggregate_parser.add_argument("--dir", default=ANALYTICS_DIR)
+    aggregate_parser.add_argument("--days", type=int, default=14, help="days of report volumes to print")
+    aggregate_parser.add_argument("--json", action="store_true", help="print the totals as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        from store import ReportStore
+        store = ReportStore(args.db)
+        try:
+            start = time.perf_counter()
+            exported = AnalyticsExporter(store, args.dir).export()
+        finally:
+            store.close()
+        print(f"Exported {exported} rows to {args.dir} in {time.perf_counter() - start:.2f}s")
+        return 0
+
+    path = os.path.join(args.dir, AGGREGATES_FILE)
+    aggregates = Aggregates(read_json(path, None))
+    start = time.perf_counter()
+    read = aggregates.update(args.dir)
+    if read:
+        write_json(path, aggregates.to_dict())
+    if args.json:
+        totals = aggregates.to_dict()
+        del totals["flagged"]
+        print(json.dumps(totals, indent=2))
+    else:
+        print(f"Read {read} new parts in {time.perf_counter() - start:.2f}s\n")
+        print_summary(aggregates, args.days)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import asyncio
+import importlib
+import io
+import logging
+import os
+import sys
+import numpy as np
+import analysis
+from tracing import span
+
+'''
+Attachment scanning.
+
+Image attachments are downloaded (a few at a time, up to MAX_ATTACHMENT_BYTES each) and hashed by
+the hash_images stage of analysis.pool, in a worker process. The perceptual hash (pHash) of an image
+is the signs of the 8x8 lowest frequencies of its 32x32 DCT, relative to their median, with the
+images of a batch (from one or several messages) stacked into one NumPy array. Resized, recompressed
+or lightly edited copies of an image get hashes a few bits apart.
+
+The pHashes are looked up in HashIndex, a multi-index hash table over a local list of known abuse
+images (KNOWN_IMAGES_PATH, one "<16 hex digits> <label>" line per image). Each 64 bit hash is split
+into 4 chunks of 16 bits. If two hashes are within distance r, one of the chunks is within r // 4
+(pigeonhole principle), so a search only looks at the hashes that share a chunk up to r // 4 bits
+away and then checks the full distance. With sorted chunk arrays a search takes a few
+milliseconds with 2 million hashes, instead of a scan of the whole list.
+
+Run `python attachments.py <image> ...` to print the line of each image for the known image list.
+'''
+
+logger = logging.getLogger('discord')
+
+KNOWN_IMAGES_PATH = 'known_images.txt'
+# Maximum Hamming distance between the pHashes of two copies of the same image
+MATCH_DISTANCE = 8
+MAX_ATTACHMENT_BYTES = 8 * 1024 * 1024
+# Number of attachments downloaded at the same time
+MAX_DOWNLOADS = 4
+
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+DCT_SIZE = 32
+PHASH_SIZE = 8
+
+
+def dct_matrix(n):
+    k = np.arange(n).reshape(-1, 1)
+    matrix = np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+DCT = dct_matrix(DCT_SIZE)
+# Number of set bits of every 16 bit value
+POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << CHUNK_BITS)], dtype=np.uint8)
+
+
+def popcount(values):
+    '''
+    Number of set bits of each uint64 in values.
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    chunks = values.view(np.uint16).reshape(-1, 4)
+    return POPCOUNT16[chunks].sum(axis=1, dtype=np.uint32)
+
+
+def pack_bits(bits):
+    '''
+    Turns an (N, 64) array of booleans into N uint64 hashes (first bit is the most significant).
+    '''
+    return np.packbits(bits, axis=1).view(">u8").reshape(-1).astype(np.uint64)
+
+
+def load_gray(data, size):
+    from PIL import Image # Only needed in the worker processes
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (size[0] * 4, size[1] * 4)) # Lets JPEG decoding skip most of the pixels
+    return np.asarray(image.convert("L").resize(size, Image.LANCZOS), dtype=np.float32)
+
+
+def warm():
+    '''
+    Called once in each analysis worker, so the first image does not wait for PIL to load.
+    '''
+    importlib.import_module("PIL.Image")
+
+
+def hash_images(images):
+    '''
+    Returns the pHash (an int) of every image (bytes) in images, or None for the ones that cannot be
+    decoded. Runs in the worker processes.
+    '''
+    decoded = []
+    for data in images:
+        try:
+            decoded.append(load_gray(data, (DCT_SIZE, DCT_SIZE)))
+        except Exception:
+            decoded.append(None)
+    valid = [pixels for pixels in decoded if pixels is not None]
+    if not valid:
+        return [None] * len(images)
+
+    pixels = np.stack(valid)
+    frequencies = (DCT @ pixels @ DCT.T)[:, :PHASH_SIZE, :PHASH_SIZE].reshape(len(valid), -1)
+    phashes = iter(pack_bits(frequencies > np.median(frequencies, axis=1, keepdims=True)).tolist())
+    return [next(phashes) if pixels is not None else None for pixels in decoded]
+
+
+def chunk_variants(radius):
+    '''
+    Every 16 bit mask with at most radius bits set.
+    '''
+    return np.flatnonzero(POPCOUNT16 <= radius).astype(np.uint16)
+
+
+class HashIndex:
+    '''
+    Multi-index hash table of 64 bit perceptual hashes with a label each.
+    '''
+    def __init__(self, hashes=(), labels=()):
+        self.hashes = np.asarray(hashes, dtype=np.uint64).reshape(-1)
+        self.labels = list(labels)
+        self.pending = [] # Hashes added since the tables were built
+        self.pending_labels = []
+        self.tables = []
+        self.variants = {}
+        self.build()
+
+    def __len__(self):
+        return len(self.hashes) + len(self.pending)
+
+    @classmethod
+    def load(cls, path=KNOWN_IMAGES_PATH):
+        '''
+        Reads a known image list. A missing file gives an empty index.
+        '''
+        hashes, labels = [], []
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.split(maxsplit=1)
+                    if parts and not parts[0].startswith("#"):
+                        hashes.append(int(parts[0], 16))
+                        labels.append(parts[1].strip() if len(parts) > 1 else "")
+        return cls(hashes, labels)
+
+    def build(self):
+        if self.pending:
+            self.hashes = np.concatenate([self.hashes, np.array(self.pending, dtype=np.uint64)])
+            self.labels.extend(self.pending_labels)
+            self.pending, self.pending_labels = [], []
+        self.tables = []
+        for chunk in range(CHUNKS):
+            values = ((self.hashes >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            self.tables.append((values[order], order))
+
+    def add(self, phash, label=""):
+        '''
+        Adds a hash. The tables are rebuilt once the unindexed hashes reach a tenth of the index.
+        '''
+        self.pending.append(phash)
+        self.pending_labels.append(label)
+        if len(self.pending) >= max(1024, len(self.hashes) // 10):
+            self.build()
+
+    def search(self, phash, radius=MATCH_DISTANCE):
+        '''
+        Returns [(label, distance)] of every hash within radius bits of phash, closest first.
+        '''
+        matches = []
+        if len(self.hashes):
+            sub_radius = radius // CHUNKS
+            if sub_radius not in self.variants:
+                self.variants[sub_radius] = chunk_variants(sub_radius)
+            candidates = []
+            for chunk, (values, order) in enumerate(self.tables):
+                keys = self.variants[sub_radius] ^ np.uint16((phash >> (chunk * CHUNK_BITS)) & CHUNK_MASK)
+                starts = np.searchsorted(values, keys, "left")
+                ends = np.searchsorted(values, keys, "right")
+                lengths = ends - starts
+                # Concatenation of order[start:end] for every key, without a Python loop
+                offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+                candidates.append(order[np.arange(lengths.sum()) + offsets])
+            if candidates:
+                candidates = np.unique(np.concatenate(candidates))
+                distances = popcount(self.hashes[candidates] ^ np.uint64(phash))
+                close = distances <= radius
+                matches = [(self.labels[i], int(d)) for i, d in zip(candidates[close], distances[close])]
+        for pending, label in zip(self.pending, self.pending_labels):
+            distance = bin(pending ^ phash).count("1")
+            if distance <= radius:
+                matches.append((label, distance))
+        return sorted(matches, key=lambda match: match[1])
+
+
+class AttachmentMatch:
+    __slots__ = ("filename", "phash", "label", "distance")
+
+    def __init__(self, filename, phash, label, distance):
+        self.filename = filename
+        self.phash = phash
+        self.label = label
+        self.distance = distance
+
+    def describe(self):
+        return f'Attachment {self.filename} matches known image "{self.label}" (distance {self.distance})'
+
+
+class AttachmentScanner:
+    def __init__(self, index, max_downloads=MAX_DOWNLOADS, radius=MATCH_DISTANCE, pool=None):
+        self.index = index
+        self.radius = radius
+        self.downloads = asyncio.Semaphore(max_downloads)
+        self.pool = pool if pool is not None else analysis.pool
+
+    def is_image(self, attachment):
+        return (attachment.content_type or "").startswith("image/") and attachment.size <= MAX_ATTACHMENT_BYTES
+
+    async def download(self, attachment):
+        async with self.downloads:
+            with span("attachments.download", size=attachment.size):
+                return await attachment.read()
+
+    async def scan(self, message):
+        '''
+        Downloads and hashes the image attachments of message. Returns an AttachmentMatch for every
+        image close to a known one.
+        '''
+        images = [attachment for attachment in message.attachments if self.is_image(attachment)]
+        if not images or not len(self.index):
+            return []
+        downloads = await asyncio.gather(*(self.download(attachment) for attachment in images), return_exceptions=True)
+        downloaded = []
+        for attachment, data in zip(images, downloads):
+            # A failed attachment is skipped; only a cancellation stops the scan
+            if isinstance(data, Exception):
+                logger.warning(f"Could not download attachment {attachment.filename}: {data!r}")
+            elif isinstance(data, BaseException):
+                raise data
+            else:
+                downloaded.append((attachment, data))
+        if not downloaded:
+            return []
+
+        with span("attachments.hash", images=len(downloaded)):
+            hashes = await asyncio.gather(*(self.pool.run("hash_images", data) for _, data in downloaded), return_exceptions=True)
+        matches = []
+        for (attachment, _), phash in zip(downloaded, hashes):
+            if isinstance(phash, Exception):
+                logger.warning(f"Could not hash attachment {attachment.filename}: {phash!r}")
+                continue
+            elif isinstance(phash, BaseException):
+                raise phash
+            if phash is None:
+                continue
+            for label, distance in self.index.search(phash, self.radius):
+                matches.append(AttachmentMatch(attachment.filename, phash, label, distance))
+        return matches
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        with open(path, "rb") as f:
+            phash = hash_images([f.read()])[0]
+        if phash is None:
+            print(f"# Could not read {path}")
+        else:
+            print(f"{phash:016x} {os.path.basename(path)}")
@@ -1,71 +1,429 @@
 # bot.py
+import asyncio
 import discord
-from discord.ext import commands
+import gc
 import os
 import json
 import logging
 import re
-import requests
-from report import Report
-from manual import ManualReview
-from report import Category
-import pdb
-from detection import detect_sextortion
-
-# Set up logging to the console
+import signal
+import struct
+import time
+from report import Report, Category
+from manual import ManualReview, determine_action
+from detection import detect_sextortion, detectors
+from store import ReportStore
+from analytics import AnalyticsExporter
+from snapshot import Snapshot, load_snapshot, save_snapshot
+from guilds import GuildRegistry, GuildConfig
+from records import ReportRecord, ReviewRecord
+from sessions import SessionManager, SessionLimitReached, REPORT, REVIEW
+from render import render_report, render_mod_post, report_details
+from mod_posts import ModPostEditor, ReviewSummary
+from attachments import AttachmentScanner, HashIndex
+from links import BlocklistWatcher
+from sharding import ShardOwnership
+import tracing
+import analysis
+from logs import LogLevelWatcher, start_logging, stop_logging
+from metrics import MetricsServer, STEP_LATENCY, DETECTIONS, LIVE_SESSIONS, PENDING_REVIEWS, instrument_http, watch_loop_lag
+from risk import RiskStore, SKIP, KNOWN_BAD, ESCALATE
+from bulk import ACTIONS, BulkFilter, largest_clusters, review_data_for, run_limited
+
+# ADDED: Logging to the file and the console is set up by start_logging() when the bot is started
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
 
 # There should be a file called 'tokens.json' inside the same folder as this file
 token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    openai_token = tokens['openai']
-
-
-class ModBot(discord.Client):
-    def __init__(self): 
+discord_token = None
+openai_token = None
+
+def load_tokens():
+    '''
+    ADDED: Reads the tokens when the bot is started rather than when this module is imported, so that
+    sharding.py and loadtest.py can import it.
+    '''
+    global discord_token, openai_token
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        discord_token = tokens['discord']
+        openai_token = tokens['openai']
+
+# Report and review sessions are dropped after this many seconds without activity
+SESSION_IDLE_TIMEOUT = 15 * 60
+# Backend of detect_sextortion (see detection.py); it is imported after the bot connects
+DETECTOR_BACKEND = "gemini"
+# Maximum number of sessions (reports plus manual reviews) per user, and in total
+MAX_SESSIONS_PER_USER = 2
+MAX_SESSIONS = 10000
+# Edits of the same mod channel post within this many seconds are collapsed into one
+MOD_POST_EDIT_DELAY = 1.0
+# Confidence of a report made by the detector; reports against repeat offenders get up to 1.0 from their risk
+DETECTOR_CONFIDENCE = 0.5
+# Number of past reports and reviews used to rebuild the risk profiles on startup
+RISK_HISTORY = 10000
+# Seconds between reads of the state other processes share through the store (handed off reports, new reviews)
+SHARED_STATE_INTERVAL = 0.5
+# Local address of the Prometheus metrics endpoint. Each process of a sharded deployment adds the first of its shard ids to the port
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+# On shutdown, seconds to wait for the events being handled to finish before the sessions are snapshotted
+DRAIN_TIMEOUT = 10
+
+
+class ModBot(discord.AutoShardedClient):
+    def __init__(self, shard_ids=None, shard_count=None):
         intents = discord.Intents.default()
         intents.message_content = True
         # Add reactions
         intents.reactions = True
         self.group_32_guild_id = 1211760623969370122
-        super().__init__(command_prefix='.', intents=intents)
+        super().__init__(command_prefix='.', intents=intents, shard_ids=shard_ids, shard_count=shard_count)
+        # ADDED: The guilds (and DMs) this process receives events for when shards run in several processes
+        self.ownership = ShardOwnership(shard_ids, shard_count)
         self.group_num = None
-        self.mod_channels = {} # Map from guild to the mod channel id for that guild
         self.reports = {} # Map from user IDs to the state of their report
-        self.reports_to_review = {} # Map from message_id in mod channel to respective report
-        self.mod_channel = None
-        self.manual_review = None # Current instance of ManualReview. It is None until report is complete
+        self.manual_reviews = {} # Map from moderator user IDs to the ManualReview they are doing
+        # ADDED: Idle expiry and limits for self.reports and self.manual_reviews
+        self.sessions = SessionManager(SESSION_IDLE_TIMEOUT, MAX_SESSIONS_PER_USER, MAX_SESSIONS)
+        self.expiry_task = None
+        # ADDED: Debounced edits of mod channel posts
+        self.mod_posts = ModPostEditor(MOD_POST_EDIT_DELAY)
+        # ADDED: Durable copy of the maps above so a restart does not lose reports
+        self.store = ReportStore('reports.db')
+        # ADDED: Mod channel, review queue and settings of each guild
+        configs = {guild_id: GuildConfig.from_dict(config) for guild_id, config in self.store.load_guild_configs().items()}
+        self.tenants = GuildRegistry(self.group_32_guild_id, configs)
+        self.unrestored_reviews = {} # Saved manual reviews waiting for their guild's mod channel to be found
+        # ADDED: Sessions are snapshotted on a graceful shutdown and restored from the snapshot at the next start
+        self.snapshot_path = f'snapshot.shards-{min(shard_ids)}.bin' if shard_ids else 'snapshot.bin'
+        self.restored_idle = {} # Map from (REPORT or REVIEW, user ID) to the seconds a restored session can stay idle
+        self.draining = False # Set on shutdown; new events are ignored from then on
+        self.in_flight = 0 # Number of events being handled
+        self.drained = asyncio.Event()
+        self.shutdown_task = None
+        # Restoring creates a few small objects per session, all long lived; the cycle collector would otherwise
+        # run many times over them while they are created
+        gc.disable()
+        try:
+            self.restore_reports()
+        finally:
+            gc.enable()
+        # ADDED: Per-user risk profiles and known-bad content, used to gate detection and prioritize reports
+        self.risk = RiskStore()
+        self.last_report_id = max(0, self.store.last_id("reports") - RISK_HISTORY)
+        self.last_review_id = max(0, self.store.last_id("reviews") - RISK_HISTORY)
+        self.sync_risk()
+        self.shared_state_task = None
+        # ADDED: Matching of image attachments against known abuse images
+        self.attachments = AttachmentScanner(HashIndex.load())
+        # ADDED: Links to blocklisted scam domains are reported to the mod channel
+        self.scam_domains = BlocklistWatcher()
+        self.blocklist_task = None
+        # ADDED: Metrics endpoint
+        self.metrics = MetricsServer(METRICS_HOST, METRICS_PORT + (min(shard_ids) if shard_ids else 0))
+        self.loop_lag_task = None
+        self.log_levels_task = None
+        # ADDED: The report and review history is exported for analysis, by one process of a sharded deployment
+        self.exporter = AnalyticsExporter(self.store) if self.ownership.owns_dms() else None
+        self.export_task = None
+        # ADDED: A sample of the events is traced to a local file
+        tracing.configure(tracing.TRACE_SAMPLE_RATE, f'traces.shards-{min(shard_ids)}.json' if shard_ids else 'traces.json')
+
+    async def setup_hook(self):
+        '''
+        Called once after login, before any guild events.
+        '''
+        # Parse the group number out of the bot's name
+        match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
+        if match:
+            self.group_num = match.group(1)
+        else:
+            raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
+        self.tenants.group_num = self.group_num
+        self.expiry_task = asyncio.create_task(self.expire_sessions())
+        self.blocklist_task = asyncio.create_task(self.scam_domains.watch())
+        self.shared_state_task = asyncio.create_task(self.sync_shared_state())
+        instrument_http(self.http)
+        tracing.instrument_http(self.http)
+        LIVE_SESSIONS.set_function(lambda: {("report",): len(self.reports), ("review",): len(self.manual_reviews)})
+        PENDING_REVIEWS.set_function(lambda: sum(len(tenant.reports_to_review) for tenant in self.tenants))
+        self.loop_lag_task = asyncio.create_task(watch_loop_lag())
+        self.log_levels_task = asyncio.create_task(LogLevelWatcher().watch())
+        if self.exporter is not None:
+            self.export_task = asyncio.create_task(self.exporter.watch())
+        # discord.py only shuts down cleanly on Ctrl-C; a deploy stops the bot with SIGTERM
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass
+        try:
+            await self.metrics.start()
+        except OSError as e:
+            logger.warning(f"Could not serve metrics on port {self.metrics.port}: {e}")
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
         for guild in self.guilds:
             print(f' - {guild.name}')
         print('Press Ctrl-C to quit.')
+        # ADDED: The detector's SDK is imported now rather than delaying startup
+        asyncio.create_task(detectors.preload(DETECTOR_BACKEND))
+        # ADDED: So are the worker processes of the CPU-bound analysis (image hashing, local detectors)
+        asyncio.create_task(analysis.pool.warm())
+
+    # ADDED: The mod channel of each guild is found when the guild becomes available and kept up to date
+    # from channel events, so startup does not scan every channel of every guild
+    async def on_guild_available(self, guild):
+        await self.index_guild(guild)
+
+    async def on_guild_join(self, guild):
+        await self.index_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.tenants.remove_guild(guild)
+
+    async def on_guild_channel_create(self, channel):
+        tenant = self.tenants.channel_created(channel)
+        if tenant is not None:
+            self.mod_channel_found(tenant)
+
+    async def on_guild_channel_delete(self, channel):
+        tenant = self.tenants.channel_deleted(channel)
+        if tenant is not None:
+            self.store.save_guild_config(tenant.guild_id, tenant.config.to_dict())
+            logger.warning(f"The mod channel of guild {tenant.guild_id} was deleted")
+
+    async def on_guild_channel_update(self, before, after):
+        tenant = self.tenants.get(after.guild.id)
+        if tenant is not None and (after.id == tenant.config.mod_channel_id or after.name == self.tenants.mod_channel_name(tenant)):
+            await self.index_guild(after.guild)
+
+    async def index_guild(self, guild):
+        tenant, changed = self.tenants.index_guild(guild)
+        if changed:
+            self.mod_channel_found(tenant)
+
+    def mod_channel_found(self, tenant):
+        self.store.save_guild_config(tenant.guild_id, tenant.config.to_dict())
+        if tenant.mod_channel is not None:
+            # In-progress manual reviews need the mod channel, so they are restored here
+            self.restore_manual_reviews(tenant)
+
+    async def close(self):
+        # close() is called again by discord.py once the connection is closed; the shutdown only runs once
+        if self.shutdown_task is None:
+            self.draining = True
+            self.shutdown_task = asyncio.ensure_future(self.shutdown())
+        await asyncio.shield(self.shutdown_task)
+
+    async def shutdown(self):
+        '''
+        Waits for the events being handled, then closes the connection and snapshots the sessions.
+        '''
+        if self.in_flight:
+            try:
+                await asyncio.wait_for(self.drained.wait(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Shutting down with {self.in_flight} events still being handled")
+        try:
+            await self.mod_posts.flush()
+            await super().close()
+            analysis.pool.close()
+            self.metrics.close()
+            tracing.tracer.close()
+            self.save_snapshot()
+        finally:
+            try:
+                if self.exporter is not None:
+                    # The reports and outcomes of the last minutes are exported once they are committed
+                    self.store.flush()
+                    try:
+                        self.exporter.export()
+                    except Exception as e:
+                        logger.warning(f"Could not export analytics: {e}")
+            finally:
+                # Commits every queued write before the process exits
+                self.store.close()
+
+    def event_started(self):
+        self.in_flight += 1
+
+    def event_finished(self):
+        self.in_flight -= 1
+        if self.draining and not self.in_flight:
+            self.drained.set()
+
+    def save_snapshot(self):
+        '''
+        Writes the in-progress reports and reviews and the review queues to self.snapshot_path.
+        '''
+        start = time.perf_counter()
+        snapshot = Snapshot(
+            sessions={user_id: report.to_dict() for user_id, report in self.reports.items()},
+            pending_by_guild={tenant.guild_id: tenant.reports_to_review for tenant in self.tenants if tenant.reports_to_review},
+            reviews=dict(self.unrestored_reviews),
+        )
+        for moderator_id, manual_review in self.manual_reviews.items():
+            snapshot.reviews[moderator_id] = manual_review.to_dict()
+        for kind, sessions in ((REPORT, self.reports), (REVIEW, snapshot.reviews)):
+            for key in sessions:
+                idle = self.sessions.idle_left(kind, key)
+                if idle is None:
+                    idle = self.restored_idle.get((kind, key))
+                if idle is not None:
+                    snapshot.idle[(kind, key)] = idle
+        try:
+            size = save_snapshot(self.snapshot_path, snapshot, self.ownership.shard_ids, self.ownership.shard_count)
+        except (OSError, TypeError, ValueError, struct.error) as e:
+            logger.warning(f"Could not write the session snapshot: {e}")
+            return
+        logger.info(f"Snapshotted {len(snapshot.sessions)} reports and {len(snapshot.reviews)} reviews "
+                    f"({size} bytes) in {time.perf_counter() - start:.3f}s")
 
-        # Parse the group number out of the bot's name
-        match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
-        if match:
-            self.group_num = match.group(1)
+    def restore_reports(self):
+        '''
+        Rebuilds self.reports and the review queues of self.tenants after a restart, from the snapshot written on
+        shutdown if there is one and from the store otherwise.
+        '''
+        start = time.perf_counter()
+        snapshot = load_snapshot(self.snapshot_path, self.ownership.shard_ids, self.ownership.shard_count)
+        if snapshot is not None:
+            sessions, pending_by_guild, reviews = snapshot.sessions, snapshot.pending_by_guild, snapshot.reviews
+            self.restored_idle = snapshot.idle
         else:
-            raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
+            # Report sessions happen in DMs, which only the process running shard 0 receives
+            sessions = self.store.load_sessions() if self.ownership.owns_dms() else {}
+            pending_by_guild = self.store.load_pending_by_guild()
+            reviews = self.store.load_reviews()
+        for user_id, session in sessions.items():
+            try:
+                self.reports[user_id] = Report.from_dict(self, session)
+            except KeyError:
+                # Saved by a version of the bot with a different report flow
+                self.store.delete_session(user_id)
+                continue
+            self.sessions.restore(REPORT, user_id, user_id, self.restored_idle.get((REPORT, user_id)))
+        for guild_id, pending in pending_by_guild.items():
+            # Reports saved before guilds were tracked all belong to the default guild
+            guild_id = guild_id if guild_id is not None else self.group_32_guild_id
+            if not self.ownership.owns(guild_id):
+                continue
+            tenant = self.tenants.tenant(guild_id)
+            tenant.reports_to_review.update(pending)
+            for message_id, record in pending.items():
+                tenant.review_queue.push(message_id, record)
+                key = self.reported_message_key(record)
+                if key is not None:
+                    tenant.pending_by_message[key] = message_id
+        self.unrestored_reviews = reviews
+        logger.info(f"Restored {len(self.reports)} reports and {len(reviews)} reviews from the "
+                    f"{'snapshot' if snapshot is not None else 'store'} in {time.perf_counter() - start:.3f}s")
+
+    def sync_risk(self):
+        '''
+        Adds the reports and review outcomes stored since the last call (by any process) to self.risk.
+        '''
+        while self.apply_risk_changes(*self.risk_changes()):
+            pass
 
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
-        # ADDED: Populates mod_channel attribute
-        self.mod_channel = self.mod_channels[self.group_32_guild_id]
-        
+    def risk_changes(self):
+        '''
+        Reads the reports and review outcomes stored since the last ones added to self.risk. Safe to call from
+        another thread, as it only reads the store.
+        '''
+        return self.store.reports_since(self.last_report_id), self.store.reviews_since(self.last_review_id)
+
+    def apply_risk_changes(self, reports, reviews):
+        '''
+        Adds the output of risk_changes() to self.risk. Returns whether there may be more to read.
+        '''
+        for self.last_report_id, record in reports:
+            self.risk.record_report(record.author_id, record.reported_at or None)
+        for self.last_review_id, record, review in reviews:
+            self.risk.record_review(record, review.to_review_data(), record.reported_at or None)
+        return len(reports) >= 1000 or len(reviews) >= 1000
+
+    async def sync_shared_state(self):
+        '''
+        Background task that picks up what other processes wrote to the shared store: new reports and reviews for
+        the risk profiles, and reports handed off to the guilds of this process. The store is read in a thread.
+        '''
+        while not self.is_closed():
+            await asyncio.sleep(SHARED_STATE_INTERVAL)
+            while self.apply_risk_changes(*await asyncio.to_thread(self.risk_changes)):
+                pass
+            if not self.ownership.is_sharded():
+                continue
+            handoffs = await asyncio.to_thread(self.store.take_handoffs, self.ownership.shard_ids, self.ownership.shard_count)
+            for _, guild_id, record in handoffs:
+                try:
+                    await self.submit_report(record, guild_id)
+                except discord.errors.HTTPException as e:
+                    logger.warning(f"Could not post a report handed off to guild {guild_id}: {e}")
+
+    def restore_manual_reviews(self, tenant):
+        '''
+        Rebuilds the in-progress manual reviews of tenant's mod channel from the store after a restart.
+        '''
+        for moderator_id, review in list(self.unrestored_reviews.items()):
+            mod_channel_id = review.get("mod_channel_id")
+            if mod_channel_id != tenant.mod_channel.id and (mod_channel_id is not None or tenant.guild_id != self.group_32_guild_id):
+                continue
+            del self.unrestored_reviews[moderator_id]
+            try:
+                self.manual_reviews[moderator_id] = ManualReview.from_dict(self, review, tenant.mod_channel, self.mod_posts)
+            except KeyError:
+                # Saved by a version of the bot with a different review flow
+                self.store.delete_review(moderator_id)
+                continue
+            self.sessions.restore(REVIEW, moderator_id, moderator_id, self.restored_idle.pop((REVIEW, moderator_id), None))
+
+    async def expire_sessions(self):
+        '''
+        Background task that drops report and review sessions that have been idle for SESSION_IDLE_TIMEOUT.
+        An expired user report is discarded; the report of an expired manual review goes back to the queue.
+        '''
+        while not self.is_closed():
+            await asyncio.sleep(self.sessions.wheel.tick)
+            for kind, key in self.sessions.expire():
+                try:
+                    if kind == REPORT:
+                        await self.expire_report(key)
+                    else:
+                        await self.expire_manual_review(key)
+                except discord.errors.HTTPException as e:
+                    logger.warning(f"Could not send session expiry notice for {kind} {key}: {e}")
+
+    async def expire_report(self, user_id):
+        if self.reports.pop(user_id, None) is None:
+            return
+        self.store.delete_session(user_id)
+        user = self.get_user(user_id) or await self.fetch_user(user_id)
+        await user.send(f"Your report session expired after {SESSION_IDLE_TIMEOUT // 60} minutes of inactivity. "
+                        "Use the `report` command to start again.")
+
+    async def expire_manual_review(self, moderator_id):
+        manual_review = self.manual_reviews.pop(moderator_id, None)
+        if manual_review is None:
+            return
+        tenant = self.review_tenant(manual_review)
+        tenant.review_queue.release(moderator_id)
+        self.store.delete_review(moderator_id)
+        await manual_review.mod_channel.send(f"<@{moderator_id}> your review expired after {SESSION_IDLE_TIMEOUT // 60} minutes "
+                                             "of inactivity. The report has been returned to the queue.")
+        if manual_review.summary is None:
+            await self.submit_report(manual_review.report_data)
+        else:
+            # The post's reactions are the options of the last question; the accept reaction replaces them
+            await manual_review.summary.reset_reactions(("1️⃣",))
+            await self.requeue_report(tenant, manual_review.summary.message_id, manual_review.report_data)
+
+    def review_tenant(self, manual_review):
+        return self.tenants.tenant(manual_review.mod_channel.guild.id)
 
     async def on_message(self, message):
         '''
@@ -76,11 +434,60 @@ class ModBot(discord.Client):
         if message.author.id == self.user.id:
             return
 
-        # Check if this message was sent in a server ("guild") or if it's a DM
-        if message.guild:
-            await self.handle_channel_message(message)
+        # ADDED: Events arriving during shutdown are dropped; the ones already being handled finish first
+        if self.draining:
+            return
+        self.event_started()
+        try:
+            # Check if this message was sent in a server ("guild") or if it's a DM
+            with tracing.start_trace("on_message", message_id=message.id, dm=message.guild is None):
+                if message.guild:
+                    await self.handle_channel_message(message)
+                else:
+                    await self.handle_dm(message)
+        finally:
+            self.event_finished()
+
+    async def scan_dm(self, message):
+        '''
+        ADDED: Checks a DM that is not part of a report flow and reports it to the mod channel if it is abuse.
+        '''
+        author_id = message.author.id
+
+        # Make report based on the detection result. 
+        # ADDED: Trusted users are not checked and content already confirmed as abuse does not need the detector
+        triage = self.risk.triage(author_id, message.content, message.author.created_at.timestamp())
+        if triage == SKIP:
+            detected = False
+            DETECTIONS.labels("risk", "skipped").inc()
         else:
-            await self.handle_dm(message)
+            if triage == KNOWN_BAD:
+                DETECTIONS.labels("risk", "known_bad").inc()
+            detected = triage == KNOWN_BAD or await detect_sextortion(message, DETECTOR_BACKEND, openai_token) == True
+            self.risk.record_detection(author_id, detected)
+        if detected:
+            # ADDED: The message is reported to the mod channel. Reports against repeat offenders are escalated: their
+            # confidence moves them up the review queue
+            details = ["Flagged by the sextortion detector"]
+            confidence = max(DETECTOR_CONFIDENCE, self.risk.confidence(author_id))
+            if triage == ESCALATE:
+                risk = self.risk.risk(author_id)
+                logger.info(f"Escalating a detection from repeat offender {author_id} (risk {risk:.1f})")
+                details.append(f"Repeat offender (risk {risk:.1f})")
+                confidence = 1.0
+            await self.auto_report(message, Category.SEXUAL_THREAT, details, confidence, source=DETECTOR_BACKEND)
+
+        # ADDED: Images matching known abuse images are reported to the mod channel
+        if message.attachments:
+            matches = await self.attachments.scan(message)
+            DETECTIONS.labels("attachments", "yes" if matches else "no").inc()
+            if matches:
+                self.risk.record_detection(author_id, True)
+                await self.auto_report(message, Category.SEXUAL_THREAT, [match.describe() for match in matches], source="attachments")
+        link_matches = self.scam_domains.scan(message.content)
+        if link_matches:
+            DETECTIONS.labels("links", "yes").inc()
+            await self.auto_report(message, Category.SPAM_SCAM, [match.describe() for match in link_matches], source="links")
 
     async def handle_dm(self, message):
         # Handle a help message
@@ -93,20 +500,27 @@ class ModBot(discord.Client):
         author_id = message.author.id
         responses = []
 
-        # Make report based on the detection result. 
-        if await detect_sextortion(message, "gemini", openai_token) == True:
-            print("Sextortion detected. TODO: Create a report and send to moderator flow.")
-
         # Only respond to messages if they're part of a reporting flow
         if author_id not in self.reports and not message.content.startswith(Report.START_KEYWORD):
+            # ADDED: Only the other messages are checked for abuse, not the links and answers of a report
+            await self.scan_dm(message)
             return
 
         # If we don't currently have an active report for this user, add one
         if author_id not in self.reports:
+            try:
+                self.sessions.open(REPORT, author_id, author_id)
+            except SessionLimitReached as e:
+                await message.channel.send(str(e))
+                return
             self.reports[author_id] = Report(self)
+        else:
+            self.sessions.touch(REPORT, author_id)
 
         # Let the report class handle this message; forward all the messages it returns to uss
-        responses = await self.reports[author_id].handle_message(message)
+        report = self.reports[author_id]
+        with STEP_LATENCY.labels("report", report.step()).time():
+            responses = await report.handle_message(message)
         for r in responses:
             await message.channel.send(r)
 
@@ -114,11 +528,22 @@ class ModBot(discord.Client):
         # If the report is complete or cancelled, remove it from our map and add it to reports to review
         if self.reports[author_id].report_cancelled():
             self.reports.pop(author_id)
+            self.sessions.close(REPORT, author_id)
+            self.store.delete_session(author_id)
+        else:
+            self.store.save_session(author_id, self.reports[author_id].to_dict())
 
 
     async def handle_channel_message(self, message):
+        # ADDED: Review queue commands in the mod channel
+        tenant = self.tenants.for_channel(message.channel.id)
+        if tenant is not None:
+            await self.handle_mod_command(message, tenant)
+            return
+
         # Only handle messages sent in the "group-#" channel
-        if not message.channel.name == f'group-{self.group_num}':
+        tenant = self.tenants.get(message.guild.id)
+        if tenant is None or message.channel.name != self.tenants.report_channel_name(tenant):
             return
 
         # # Forward the message to the mod channel
@@ -130,129 +555,346 @@ class ModBot(discord.Client):
     # ADDED: This event handler detects when a reaction is made and if the author is reporting
     # TODO: Add message checking on author_id to fix double message problem 
     async def on_raw_reaction_add(self, reaction):
+        if self.draining:
+            return
+        self.event_started()
+        try:
+            with tracing.start_trace("on_raw_reaction_add", message_id=reaction.message_id, emoji=reaction.emoji.name):
+                await self.handle_raw_reaction(reaction)
+        finally:
+            self.event_finished()
+
+    async def handle_raw_reaction(self, reaction):
         author_id = reaction.user_id
         message_id = reaction.message_id
 
-        # Intialization the manual review flow
-        if message_id in self.reports_to_review and reaction.emoji.name == "1️⃣" and self.manual_review == None:
-            report_data = self.reports_to_review.pop(message_id)
-            await self.mod_channel.send(
-                "Current " + self.format_report(report_data)
-            )
-            self.manual_review = ManualReview(self, report_data, self.mod_channel)
-            await self.manual_review.perform_manual_review(reaction)
+        tenant = self.tenants.get(reaction.guild_id) if reaction.guild_id else None
+
+        # Intialization the manual review flow. Each moderator can review one report at a time.
+        if tenant is not None and message_id in tenant.reports_to_review and reaction.emoji.name == "1️⃣" and \
+                author_id != self.user.id and author_id not in self.manual_reviews:
+            assignment = tenant.review_queue.assign(message_id, author_id)
+            if assignment:
+                await self.start_manual_review(tenant, author_id, *assignment)
         # Continuation of manual review flow
-        elif self.manual_review and self.group_32_guild_id == reaction.guild_id and author_id != self.user.id:
-            is_review_complete = await self.manual_review.perform_manual_review(reaction)
-            if is_review_complete: # reset self.manual_review
-                self.manual_review = None
+        elif author_id in self.manual_reviews and self.manual_reviews[author_id].mod_channel.id == reaction.channel_id:
+            manual_review = self.manual_reviews[author_id]
+            self.sessions.touch(REVIEW, author_id)
+            with STEP_LATENCY.labels("manual_review", manual_review.step()).time():
+                is_review_complete = await manual_review.perform_manual_review(reaction)
+            if is_review_complete: # remove the moderator's review
+                self.manual_reviews.pop(author_id)
+                self.sessions.close(REVIEW, author_id)
+                self.review_tenant(manual_review).review_queue.release(author_id)
+                self.store.delete_review(author_id)
+                self.store.add_review_outcome(author_id, manual_review.report_data,
+                                              ReviewRecord.from_review_data(manual_review.review_data))
+                if manual_review.summary is not None:
+                    manual_review.summary.set_status(f"✅ Reviewed by <@{author_id}>")
+            else:
+                self.store.save_review(author_id, manual_review.to_dict())
         # Otherwise report flow is handled
         elif author_id in self.reports:
-            await self.reports[author_id].handle_reaction(reaction)
+            self.sessions.touch(REPORT, author_id)
+            report = self.reports[author_id]
+            with STEP_LATENCY.labels("report", report.step()).time():
+                await report.handle_reaction(reaction)
+            self.store.save_session(author_id, self.reports[author_id].to_dict())
 
-        # When the report is complete it is removed from self.reports and the data is sent to self.reports_to_review
+        # When the report is complete it is removed from self.reports and the data is sent to the review queue of its guild
         # The mod channel then gets forwarded the data and is given the option to review it.
         if author_id in self.reports and self.reports[author_id].report_complete() and not self.reports[author_id].report_cancelled():
             report = self.reports.pop(author_id)
-            # Adds urgent report to sexual threat or danger reports
-            accept_message = "===========================\nPress 1️⃣ to accept and review this report."
-            if report.report_data["category"] != Category.DANGER and report.report_data["category"] != Category.SEXUAL_THREAT:
-                report_message = await self.mod_channel.send(self.format_report(report.report_data) + "\n" + accept_message)
-            else:
-                report_message = await self.mod_channel.send("‼️Urgent Report‼️\n" + self.format_report(report.report_data) + "\n" + accept_message)
-            # Add reactions
-            await report_message.add_reaction("1️⃣")
-            self.reports_to_review[report_message.id] = report.report_data
-
-# Helper functions
+            self.sessions.close(REPORT, author_id)
+            self.store.delete_session(author_id)
+            # The answers are kept as a compact record from here on
+            record = ReportRecord.from_report_data(report.report_data, reporter_ids=[author_id], reported_at=time.time())
+            self.store.add_report(author_id, record)
+            # Reports against repeat offenders get a higher confidence and move up the queue
+            record.confidence = max(record.confidence, self.risk.confidence(record.author_id))
+            await self.submit_report(record)
+
+    async def submit_report(self, record, guild_id=None):
+        '''
+        Posts a completed report (a ReportRecord) to the mod channel of the reported message's guild (or of
+        guild_id) and adds it to that guild's review queue. Reports about guilds run by another process are
+        handed off to it through the store.
+        '''
+        guild_id = guild_id or record.guild_id or self.group_32_guild_id
+        if not self.ownership.owns(guild_id):
+            self.store.hand_off(guild_id, record)
+            return
+        tenant = self.tenants.route(guild_id)
+        if tenant is None and not self.ownership.owns(self.group_32_guild_id):
+            # The guild has no mod channel: the default guild takes the report
+            self.store.hand_off(self.group_32_guild_id, record)
+            return
+        if tenant is None:
+            logger.warning(f"No mod channel can take a report from guild {guild_id}; it is only in the report history")
+            return
+        # Another report of the same message is already waiting: merge into it instead of posting again
+        key = self.reported_message_key(record)
+        if key is not None and key in tenant.pending_by_message:
+            await self.merge_report(tenant, tenant.pending_by_message[key], record)
+            return
 
-    def format_report(self, report_data):
+        report_message = await tenant.mod_channel.send(render_mod_post(record))
+        # Add reactions
+        await report_message.add_reaction("1️⃣")
+        tenant.reports_to_review[report_message.id] = record
+        if key is not None:
+            tenant.pending_by_message[key] = report_message.id
+        tenant.review_queue.push(report_message.id, record)
+        self.store.add_pending(report_message.id, record, record.reported_at, tenant.guild_id)
+
+    async def auto_report(self, message, category, details, confidence=1.0, source="detector"):
+        '''
+        Submits a report generated by the bot (rather than a user) about message. details explain why it was reported
+        and source names the detector that found it.
+        '''
+        guild_id = message.guild.id if message.guild else 0
+        tenant = self.tenants.get(guild_id)
+        if tenant is not None and not tenant.config.auto_reports:
+            return
+        record = ReportRecord.from_report_data({
+            "category": category,
+            "guild_id": guild_id,
+            "channel_id": message.channel.id,
+            "message_id": message.id,
+            "author_id": message.author.id,
+            "name": message.author.name,
+            "content": message.content,
+            "confidence": confidence,
+            "additional_details": details,
+        }, reported_at=time.time())
+        self.store.add_report(self.user.id, record, source)
+        await self.submit_report(record)
+
+    def reported_message_key(self, record):
         '''
-        This function takes in report_data and formats it so that it can be displayed
-        for moderators before the select to review it.
+        Returns the (guild_id, channel_id, message_id) of the message a report is about, or None if unknown.
         '''
-        if report_data["category"] == Category.SEXUAL_THREAT:
-            return self.format_sexual_threat(report_data)
-        elif report_data["category"] == Category.OFFENSIVE_CONTENT:
-            return self.format_offesive_content(report_data)
-        elif report_data["category"] == Category.SPAM_SCAM:
-            return self.format_spam_scam(report_data)    
-        elif report_data["category"] == Category.DANGER:
-            return self.format_danger(report_data)
+        if not record.message_id:
+            return None
+        return (record.guild_id, record.channel_id, record.message_id)
 
-    def format_sexual_threat(self, report_data):
+    async def merge_report(self, tenant, mod_message_id, new_record):
         '''
-        Format function for sexual threat reports
+        Merges a new report into the waiting report of the same message: the reporter is counted, categories and
+        details are unioned, the existing mod channel post is edited and the report moves up the queue.
         '''
-        reply = "Report Summary\n" + \
-                "===========================\n"
-        
-        reply += "Abuse Type: Sexual Threat Content\n"
-        reply += f'Reported User: {report_data["name"]}\n'
-        reply += f'Message: {report_data["content"]}\n'
-        reply += f'Demand Made: {report_data["demand"]}\n'
-        reply += f'Threat Made: {report_data["threat"]}\n'
-        reply += "Addtional Content: NONE" if report_data["context"] == "No" else f'Addtional Content: {report_data["context_content"]}'
-        return reply
-    
-    def format_offesive_content(self, report_data):
+        record = tenant.reports_to_review[mod_message_id]
+        for reporter_id in new_record.reporter_ids:
+            record.add_reporter(reporter_id)
+        for category in new_record.categories:
+            record.add_category(category)
+        record.confidence = max(record.confidence, new_record.confidence)
+        details = report_details(record)
+        for detail in report_details(new_record) + list(new_record.additional_details):
+            if detail not in details:
+                record.add_detail(detail)
+
+        tenant.review_queue.update(mod_message_id)
+        self.store.add_pending(mod_message_id, record, record.reported_at, tenant.guild_id)
+        self.mod_posts.update(tenant.mod_channel, mod_message_id, render_mod_post(record))
+
+    async def requeue_report(self, tenant, mod_message_id, record):
         '''
-        Format function for offensive content reports
+        Puts a report whose review was abandoned back in tenant's queue under its existing mod channel post.
         '''
-        reply = "Report Summary\n" + \
-                "===========================\n"
-        
-        reply += "Abuse Type: Offensive Content\n"
-        reply += f'Reported User: {report_data["name"]}\n'
-        reply += f'Message: {report_data["content"]}\n'
-        reply += f'Offensive Content Type: {report_data["offensive_content_type"]}'
+        key = self.reported_message_key(record)
+        if tenant.mod_channel is None:
+            # The mod channel is gone, so the report is posted again wherever it can be reviewed
+            await self.submit_report(record)
+            return
+        if key is not None and key in tenant.pending_by_message:
+            # The message was reported again while under review and has a new post
+            await self.merge_report(tenant, tenant.pending_by_message[key], record)
+            self.mod_posts.update(tenant.mod_channel, mod_message_id, render_mod_post(record, "↩️ Merged into a newer report"))
+            return
+        tenant.reports_to_review[mod_message_id] = record
+        if key is not None:
+            tenant.pending_by_message[key] = mod_message_id
+        tenant.review_queue.push(mod_message_id, record)
+        self.store.add_pending(mod_message_id, record, record.reported_at, tenant.guild_id)
+        self.mod_posts.update(tenant.mod_channel, mod_message_id, render_mod_post(record))
+
+    async def start_manual_review(self, tenant, moderator_id, message_id, record):
+        '''
+        Starts a manual review of the report posted as message_id, which was just assigned to moderator_id
+        by tenant.review_queue.
+        '''
+        mod_channel = tenant.mod_channel
+        try:
+            self.sessions.open(REVIEW, moderator_id, moderator_id)
+        except SessionLimitReached as e:
+            # Put the report back where it was
+            tenant.review_queue.release(moderator_id)
+            tenant.review_queue.push(message_id, record)
+            await mod_channel.send(f"<@{moderator_id}> {e}")
+            return
+        tenant.reports_to_review.pop(message_id, None)
+        tenant.pending_by_message.pop(self.reported_message_key(record), None)
+        self.store.remove_pending(message_id)
+        if tenant.config.edit_in_place:
+            # The report's post shows who is reviewing it and collects the review log
+            summary = ReviewSummary(self.mod_posts, mod_channel, message_id, record, f"🔎 In review by <@{moderator_id}>")
+            summary.refresh()
+        else:
+            summary = None
+            await mod_channel.send(
+                f"Current report for <@{moderator_id}>: " + render_report(record)
+            )
+        manual_review = ManualReview(self, record, mod_channel, summary)
+        self.manual_reviews[moderator_id] = manual_review
+        await manual_review.perform_manual_review(None)
+        self.store.save_review(moderator_id, manual_review.to_dict())
 
-        return reply
-    def format_spam_scam(self, report_data):
+    async def handle_mod_command(self, message, tenant):
         '''
-        Format function for spam/scam reports
+        Handles commands typed in the mod channel of tenant:
+        `next` assigns the most urgent waiting report to the moderator who typed it.
+        `queue` shows how many reports are waiting and how old the oldest one is.
+        `clusters` lists the largest groups of waiting reports about the same content.
+        `bulk <preview|dismiss|kick|escalate> <filters>` applies one decision to every waiting report that matches.
+        `config [key=value ...]` shows or changes the guild's settings.
         '''
-        reply = "Report Summary\n" + \
-                "===========================\n"
-        
-        reply += "Abuse Type: Spam/Scam Content\n"
-        reply += f'Reported User: {report_data["name"]}\n'
-        reply += f'Message: {report_data["content"]}\n'
-        reply += f'Spam/Scam Content Type: {report_data["spam_scam_content_type"]}'
+        moderator_id = message.author.id
+        words = message.content.strip().split()
+        command = words[0].lower() if words else ""
+
+        if command == "next":
+            if moderator_id in self.manual_reviews:
+                await message.channel.send(f"<@{moderator_id}> please finish your current review first.")
+                return
+            assignment = tenant.review_queue.assign_next(moderator_id)
+            if assignment is None:
+                await message.channel.send("There are no reports waiting for review.")
+                return
+            await self.start_manual_review(tenant, moderator_id, *assignment)
+
+        elif command == "queue":
+            metrics = tenant.review_queue.metrics()
+            reply = "Review Queue\n" + \
+                    "===========================\n"
+            reply += f'Waiting: {metrics["depth"]}\n'
+            for category, depth in metrics["depth_by_category"].items():
+                reply += f'  {category.name}: {depth}\n'
+            in_review = sum(review.mod_channel.id == message.channel.id for review in self.manual_reviews.values())
+            reply += f'In review: {in_review}\n'
+            reply += f'Oldest waiting: {int(metrics["oldest_age"] // 60)} min\n'
+            gauges = self.sessions.gauges(list(self.reports.values()) + list(self.manual_reviews.values()))
+            reply += f'Live sessions: {gauges["report_sessions"]} reports, {gauges["review_sessions"]} reviews ' + \
+                     f'(~{gauges["session_bytes"] // 1024} KB)'
+            await message.channel.send(reply)
+
+        elif command == "clusters":
+            clusters = largest_clusters(tenant.reports_to_review)
+            if not clusters:
+                await message.channel.send("There are no reports waiting for review.")
+                return
+            reply = "Largest Content Clusters\n" + \
+                    "===========================\n"
+            for cluster, count, sample in clusters:
+                reply += f'cluster={cluster}: {count} reports, e.g. "{sample[:80]}"\n'
+            await message.channel.send(reply)
 
-        return reply
-    def format_danger(self, report_data):
+        elif command == "bulk":
+            action = words[1].lower() if len(words) > 1 else ""
+            if action != "preview" and action not in ACTIONS:
+                await message.channel.send("Usage: `bulk <preview|" + "|".join(ACTIONS) + "> <filters>` with filters " +
+                                           "category=..., user=..., cluster=..., older=30m, newer=2h")
+                return
+            try:
+                bulk_filter = BulkFilter.parse(words[2:])
+            except ValueError as e:
+                await message.channel.send(str(e))
+                return
+            if action == "preview":
+                await self.preview_bulk_review(tenant, bulk_filter)
+            elif bulk_filter.is_empty():
+                await message.channel.send("Bulk actions need at least one filter.")
+            else:
+                await self.bulk_review(tenant, moderator_id, action, bulk_filter)
+
+        elif command == "config":
+            await self.configure_guild(message, tenant, words[1:])
+
+    async def configure_guild(self, message, tenant, settings):
         '''
-        Format function for danger reports
+        Applies `key=value` settings to tenant's GuildConfig and shows the result.
         '''
-        reply = "Report Summary\n" + \
+        old_mod_channel_name = self.tenants.mod_channel_name(tenant)
+        try:
+            for setting in settings:
+                key, sep, value = setting.partition("=")
+                if not sep:
+                    raise ValueError(f'Could not read "{setting}". Use `config key=value`.')
+                tenant.config.set(key.lower(), value)
+        except ValueError as e:
+            await message.channel.send(str(e))
+            return
+        if settings:
+            self.store.save_guild_config(tenant.guild_id, tenant.config.to_dict())
+            if self.tenants.mod_channel_name(tenant) != old_mod_channel_name:
+                await self.index_guild(message.guild)
+        reply = "Guild Settings\n" + \
                 "===========================\n"
-        
-        reply += "Abuse Type: Imminent Danger Content\n"
-        reply += f'Reported User: {report_data["name"]}\n'
-        reply += f'Message: {report_data["content"]}\n'
-        reply += f'Imminent Danger Type: {report_data["danger_type"]}\n'
-        if "safety_threat_type" in report_data:
-            reply += f'Safety Threat Type: {report_data["safety_threat_type"]}'
-        elif "criminal_behavior_type" in report_data:
-            reply += f'Criminal Behavior Type: {report_data["criminal_behavior_type"]}'
-
-        return reply
-
-    def category_to_string(self):
-        '''
-        Convert states in Category to strings
-        '''
-        if self.review_data["category"] == Category.SEXUAL_THREAT:
-            return "Sexual Threat"
-        elif self.review_data["category"] == Category.OFFENSIVE_CONTENT:
-            return "Offensive Content"
-        elif self.review_data["category"] == Category.SPAM_SCAM:
-            return "Spam/Scam"
-        elif self.review_data["category"] == Category.DANGER:
-            return "Danger"
-        else:
-            return "Unknown"
+        for key in GuildConfig.SETTINGS:
+            reply += f'{key}: {getattr(tenant.config, key)}\n'
+        reply += f'Mod channel: {tenant.mod_channel.mention if tenant.mod_channel else "not found"}'
+        await message.channel.send(reply)
+
+    async def preview_bulk_review(self, tenant, bulk_filter):
+        selected = bulk_filter.select(tenant.reports_to_review)
+        reply = f'{len(selected)} waiting reports match {str(bulk_filter) or "(no filter)"}'
+        for _, record in selected[:5]:
+            reply += f'\n - {record.name}: "{record.content[:80]}"'
+        if len(selected) > 5:
+            reply += f'\n ... and {len(selected) - 5} more'
+        await tenant.mod_channel.send(reply)
+
+    async def bulk_review(self, tenant, moderator_id, action, bulk_filter):
+        '''
+        Applies one decision (a key of bulk.ACTIONS) to every waiting report matching bulk_filter. The reports leave
+        the queue and their outcomes are stored in a single transaction; the mod channel posts are then updated
+        concurrently within the channel's edit rate limit.
+        '''
+        selected = bulk_filter.select(tenant.reports_to_review)
+        if not selected:
+            await tenant.mod_channel.send(f"<@{moderator_id}> no waiting reports match {bulk_filter}.")
+            return
+
+        outcomes = []
+        for message_id, record in selected:
+            tenant.reports_to_review.pop(message_id, None)
+            tenant.pending_by_message.pop(self.reported_message_key(record), None)
+            tenant.review_queue.remove(message_id)
+            self.mod_posts.cancel(message_id)
+            outcomes.append((message_id, record, review_data_for(action, record)))
+        self.store.add_review_outcomes(moderator_id, [(message_id, record, ReviewRecord.from_review_data(review_data))
+                                                      for message_id, record, review_data in outcomes])
+
+        users = sorted({record.name for _, record, _ in outcomes})
+        reply = f"<@{moderator_id}> bulk {action}: {len(outcomes)} reports matching {bulk_filter}."
+        if ACTIONS[action]["legitimate"]:
+            reply += f"\nUsers kicked: {', '.join(users)}"
+        await tenant.mod_channel.send(reply)
+
+        status = f"✅ Bulk {action} by <@{moderator_id}>"
+        actions = [self.bulk_action(tenant.mod_channel, message_id, record, status, determine_action(record, review_data))
+                   for message_id, record, review_data in outcomes]
+        results = await run_limited(actions, tenant.bulk_limiter)
+        failed = sum(isinstance(result, Exception) for result in results)
+        if failed:
+            logger.warning(f"Bulk {action}: {failed} of {len(results)} mod channel posts could not be updated")
+
+    def bulk_action(self, mod_channel, message_id, record, status, action_taken):
+        async def run():
+            await mod_channel.get_partial_message(message_id).edit(content=render_mod_post(record, status, [action_taken]))
+        return run
+
+# Helper functions
 
     def eval_text(self, message):
         ''''
@@ -271,5 +913,12 @@ class ModBot(discord.Client):
         return "Evaluated: '" + text+ "'"
 
 
-client = ModBot()
-client.run(discord_token)
\ No newline at end of file
+if __name__ == '__main__':
+    load_tokens()
+    start_logging('discord.log')
+    client = ModBot()
+    try:
+        # discord.py's own log handler would write on the event loop thread
+        client.run(discord_token, log_handler=None)
+    finally:
+        stop_logging()
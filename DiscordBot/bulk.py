@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import re
+import time
+from report import Category
+
+'''
+Bulk review of waiting reports.
+
+During a spam wave the review queue fills with near identical reports. Instead of reviewing them
+one at a time, a moderator selects the waiting reports with a filter and applies one decision to
+all of them:
+
+    bulk preview category=spam cluster=3f2a9c1e
+    bulk dismiss user=spammer123 older=10m
+    bulk kick cluster=3f2a9c1e
+    bulk escalate category=danger user=someone
+
+Reports are grouped into content clusters by normalizing their message text (case, punctuation,
+numbers, links and mentions are ignored), so the copies of a spam message with a different link
+or amount all share a cluster id. `clusters` in the mod channel lists the largest ones.
+'''
+
+# Decisions that can be applied in bulk, as the review answers they stand for
+ACTIONS = {
+    "dismiss": {"legitimate": False},
+    "kick": {"legitimate": True, "severity": 2},
+    "escalate": {"legitimate": True, "severity": 3},
+}
+
+# Discord allows roughly 5 message edits per 5 seconds in a channel
+EDIT_RATE = 1.0
+EDIT_BURST = 5
+# Maximum number of bulk actions waiting on Discord at the same time
+MAX_CONCURRENT_ACTIONS = 10
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+MENTION_PATTERN = re.compile(r"<[@#][!&]?\d+>")
+NUMBER_PATTERN = re.compile(r"\d+")
+WORD_PATTERN = re.compile(r"[^\W\d_]+|0")
+AGE_PATTERN = re.compile(r"^(\d+)([smhd]?)$")
+AGE_UNITS = {"": 60, "s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def normalize_content(text):
+    '''
+    Returns the text with everything that usually varies between copies of a spam message removed.
+    '''
+    text = URL_PATTERN.sub(" url ", text.lower())
+    text = MENTION_PATTERN.sub(" ", text)
+    text = NUMBER_PATTERN.sub("0", text)
+    return " ".join(WORD_PATTERN.findall(text))
+
+
+def content_cluster(text):
+    '''
+    Returns the cluster id (8 hex digits) of a reported message.
+    '''
+    return hashlib.blake2b(normalize_content(text or "").encode("utf-8"), digest_size=4).hexdigest()
+
+
+def parse_category(name):
+    name = name.upper().replace("/", "_").replace("-", "_")
+    matches = [category for category in Category if category.name.startswith(name)]
+    if len(matches) != 1:
+        raise ValueError(f"Unknown category \"{name.lower()}\". Use one of: " +
+                         ", ".join(category.name.lower() for category in Category))
+    return matches[0]
+
+
+def parse_age(text):
+    match = AGE_PATTERN.match(text.lower())
+    if not match:
+        raise ValueError(f"Could not read the age \"{text}\". Use a number followed by s, m, h or d (e.g. 30m).")
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+class BulkFilter:
+    '''
+    Selects waiting reports. Every filter that is set must match.
+    '''
+    __slots__ = ("category", "user", "cluster", "older", "newer")
+
+    KEYS = ("category", "user", "cluster", "older", "newer")
+
+    def __init__(self, category=None, user=None, cluster=None, older=None, newer=None):
+        self.category = category # Category the report (or a merged duplicate) was filed under
+        self.user = user # Name of the reported user
+        self.cluster = cluster # content_cluster() of the reported message
+        self.older = older # Minimum age in seconds
+        self.newer = newer # Maximum age in seconds
+
+    @classmethod
+    def parse(cls, args):
+        '''
+        Builds a filter from "key=value" words. Raises ValueError with a message for the moderator.
+        '''
+        values = {}
+        for arg in args:
+            key, sep, value = arg.partition("=")
+            key = key.lower()
+            if not sep or not value or key not in cls.KEYS:
+                raise ValueError(f"Could not read the filter \"{arg}\". Filters are " +
+                                 ", ".join(f"{key}=..." for key in cls.KEYS) + ".")
+            if key == "category":
+                values[key] = parse_category(value)
+            elif key in ("older", "newer"):
+                values[key] = parse_age(value)
+            elif key == "cluster":
+                values[key] = value.lower()
+            else:
+                values[key] = value
+        return cls(**values)
+
+    def is_empty(self):
+        return all(getattr(self, key) is None for key in self.KEYS)
+
+    def matches(self, record, now=None):
+        if self.category is not None and self.category not in record.categories:
+            return False
+        if self.user is not None and record.name != self.user:
+            return False
+        if self.cluster is not None and content_cluster(record.content) != self.cluster:
+            return False
+        if self.older is not None or self.newer is not None:
+            age = (now or time.time()) - (record.reported_at or 0)
+            if self.older is not None and age < self.older:
+                return False
+            if self.newer is not None and age > self.newer:
+                return False
+        return True
+
+    def select(self, reports, now=None):
+        '''
+        Returns the (message_id, record) pairs of reports ({message_id: record}) that match, oldest first.
+        '''
+        now = now or time.time()
+        selected = [(message_id, record) for message_id, record in reports.items() if self.matches(record, now)]
+        selected.sort(key=lambda item: item[1].reported_at)
+        return selected
+
+    def __str__(self):
+        parts = []
+        for key in self.KEYS:
+            value = getattr(self, key)
+            if value is not None:
+                if isinstance(value, Category):
+                    value = value.name.lower()
+                elif key in ("older", "newer"):
+                    value = f"{value}s"
+                parts.append(f"{key}={value}")
+        return " ".join(parts)
+
+
+def largest_clusters(reports, limit=5):
+    '''
+    Returns [(cluster id, number of reports, sample content)] for the largest content clusters among
+    reports ({message_id: record}).
+    '''
+    clusters = {}
+    for record in reports.values():
+        cluster = content_cluster(record.content)
+        count, sample = clusters.get(cluster, (0, record.content))
+        clusters[cluster] = (count + 1, sample)
+    ranked = sorted(clusters.items(), key=lambda item: item[1][0], reverse=True)
+    return [(cluster, count, sample) for cluster, (count, sample) in ranked[:limit]]
+
+
+def review_data_for(action, record):
+    '''
+    Returns the review answers a bulk action stands for on one report.
+    '''
+    review_data = dict(ACTIONS[action])
+    if review_data["legitimate"]:
+        # The moderator accepted the category the reporter chose
+        review_data["category"] = record.category
+    return review_data
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by concurrent tasks: at most `burst` calls at once, refilled at `rate` per second.
+    '''
+    def __init__(self, rate=EDIT_RATE, burst=EDIT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def run_limited(actions, limiter, max_concurrent=MAX_CONCURRENT_ACTIONS):
+    '''
+    Awaits every coroutine function in actions concurrently, at most max_concurrent at a time, each
+    one after taking a token from limiter. Returns the results (or raised exceptions) in order.
+    '''
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run(action):
+        async with semaphore:
+            await limiter.acquire()
+            return await action()
+
+    return await asyncio.gather(*(run(action) for action in actions), return_exceptions=True)
@@ -0,0 +1,38 @@
+import asyncio
+import vertexai
+from vertexai.generative_models import GenerativeModel, HarmCategory, HarmBlockThreshold
+
+"""
+Gemini backend of detection.py. Imported the first time it is used.
+"""
+
+PROJECT_ID = "cs-152-discord-bot"
+LOCATION = "us-west1"
+MODEL_NAME = "gemini-1.0-pro-002"
+
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+# The SDK is set up when the module is imported, which detection.py does in a thread rather than on the event loop
+vertexai.init(project=PROJECT_ID, location=LOCATION)
+model = GenerativeModel(model_name=MODEL_NAME)
+
+
+async def detect(message, prompt, key=None):
+    """
+    Detects sextortion using the Gemini model.
+    """
+    # The SDK call blocks, so it runs in a thread instead of stalling the event loop
+    response = await asyncio.to_thread(
+        model.generate_content,
+        prompt + "\n Here's the message: " + message.content,
+        safety_settings = SAFETY_SETTINGS
+    )
+
+    if response.candidates[0].content.parts[0].text.lower().startswith("yes"):
+        return True
+    return False
@@ -0,0 +1,52 @@
+import json
+import os
+import re
+
+"""
+Local backend of detection.py: keyword lexicons, without any API call. Runs in the analysis workers.
+
+As in PROMPT, a message is sextortion if it both asks for explicit material and threatens the
+receiver. The default lexicons below can be replaced by LEXICON_PATH, a JSON file of the form
+{"demands": [...], "threats": [...]} of regular expressions, read once by each worker.
+"""
+
+LEXICON_PATH = "lexicon.json"
+
+DEMANDS = (
+    r"nudes?", r"naked", r"explicit (pics?|pictures?|photos?|videos?)", r"send (me )?(more )?(pics?|pictures?|photos?|videos?)",
+    r"(pics?|pictures?|photos?) of (you|your body)", r"take (your|ur) clothes off", r"sexy (pics?|pictures?|photos?|videos?)",
+)
+THREATS = (
+    r"or (else|i will|i'll)", r"(leak|post|share|send|show) (it|them|these|those|the (pics?|pictures?|photos?|videos?))",
+    r"(your|ur) (family|friends|parents|school|boss|followers) will (see|know)", r"expose (you|u)", r"ruin (your|ur) (life|reputation)",
+    r"everyone will see", r"(pay|send) (me )?\$?\d+", r"you have \d+ (hours?|minutes?|days?)",
+)
+
+patterns = None # (demand, threat) patterns, compiled by warm()
+
+
+def compile_lexicon(terms):
+    return re.compile(r"\b(?:" + "|".join(terms) + r")\b", re.IGNORECASE)
+
+
+def warm():
+    """
+    Compiles the lexicons. Called once in each analysis worker.
+    """
+    global patterns
+    demands, threats = DEMANDS, THREATS
+    if os.path.isfile(LEXICON_PATH):
+        with open(LEXICON_PATH) as f:
+            lexicon = json.load(f)
+        demands, threats = lexicon.get("demands", demands), lexicon.get("threats", threats)
+    patterns = (compile_lexicon(demands), compile_lexicon(threats))
+
+
+def detect(contents):
+    """
+    Returns whether each message content in contents is sextortion.
+    """
+    if patterns is None:
+        warm()
+    demand, threat = patterns
+    return [bool(demand.search(content)) and bool(threat.search(content)) for content in contents]
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import requests
+
+"""
+OpenAI (GPT) backend of detection.py. Imported the first time it is used.
+"""
+
+API_URL = "https://api.openai.com/v1/chat/completions"
+MODEL_NAME = "gpt-3.5-turbo"
+
+# requests.Session is not safe to share between threads, and calls run concurrently in the to_thread workers,
+# so each worker thread keeps its own session (and connection) across calls
+sessions = threading.local()
+
+
+def post(*args, **kwargs):
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    return session.post(*args, **kwargs)
+
+
+async def detect(message, prompt, key):
+    """ 
+    Template for making GPT request.
+    """
+    openai_api_key = key
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {openai_api_key}"
+    }
+
+    data = {
+        "model": MODEL_NAME,
+        "messages": [{"role": "system", "content": prompt}, {"role": "user", "content": message.content}],
+        "temperature": 1,
+    }
+
+    # requests blocks, so the call runs in a thread instead of stalling the event loop
+    response = await asyncio.to_thread(post, API_URL, headers=headers, json=data)
+    response = response.json()
+    if response['choices'][0]['message']['content'] == 'yes':
+         return True
+    return False
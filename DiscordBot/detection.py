@@ -1,66 +1,124 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel, HarmCategory, HarmBlockThreshold
-import requests
+import asyncio
+import importlib
+import logging
+import time
+import analysis
+from metrics import DETECT_LATENCY, DETECTIONS
+from tracing import span
+
+"""
+Sextortion detection with pluggable backends.
+
+Each backend is registered by name with the module and function implementing it, as
+"module:function". The function is `async def detect(message, prompt, key)` and returns True if
+the message is sextortion. A backend's module (and so its SDK, which can take seconds to import)
+is only imported the first time the backend is used, or when preload() is called after the bot
+has connected. The import runs in a thread so the event loop keeps handling events meanwhile.
+
+Local backends run on the bot's own CPU rather than calling an API. They are registered with
+local=True and their function is a stage of analysis.pool: `def detect(contents)` takes a list of
+message contents and returns a list of verdicts, and runs in the analysis worker processes, which
+import its module (and load its lexicons or model) once when they start.
+"""
+
+logger = logging.getLogger('discord')
+
+PROMPT = "Please tell me if you detect any sextortion in the message below. \
+          Sextortion occurs when the message contains both a request for explicit material and a threat if the receiver does not comply. \
+          For example, asking for nude images alone is not sufficient for sextortion; the message must also include a threat, such as releasing \
+          potentially incriminating or sensitive content, or physical harm. Respond in the following format: \
+          Please only say 'yes' or 'no' to indiciate if you detect sextortion."
+
+
+class DetectorRegistry:
+    def __init__(self):
+        self.backends = {} # Map from backend name to "module:function"
+        self.loaded = {} # Map from backend name to its detect function, once imported
+        self.loading = {} # Map from backend name to the task importing it
+
+    def __contains__(self, name):
+        return name in self.backends
+
+    def register(self, name, target, local=False):
+        '''
+        Registers a backend. target is "module:function", or the detect function itself. A local backend's
+        "module:function" runs in the analysis workers.
+        '''
+        if local:
+            analysis.pool.register(f"detect.{name}", target)
+            target = local_detector(f"detect.{name}")
+        self.backends[name] = target
+        self.loaded.pop(name, None)
+        if callable(target):
+            self.loaded[name] = target
+
+    async def load(self, name):
+        '''
+        Returns the detect function of a backend, importing its module on the first call.
+        '''
+        detect = self.loaded.get(name)
+        if detect is not None:
+            return detect
+        task = self.loading.get(name)
+        if task is None:
+            task = self.loading[name] = asyncio.ensure_future(asyncio.to_thread(self.import_backend, name))
+        try:
+            detect = await task
+        finally:
+            self.loading.pop(name, None)
+        self.loaded[name] = detect
+        return detect
+
+    def import_backend(self, name):
+        start = time.perf_counter()
+        module_name, function = self.backends[name].split(":")
+        detect = getattr(importlib.import_module(module_name), function)
+        logger.info(f"Loaded detector {name} in {time.perf_counter() - start:.2f}s")
+        return detect
+
+    async def preload(self, name):
+        '''
+        Imports a backend ahead of its first use. Errors are logged; the first detection will raise them again.
+        '''
+        try:
+            await self.load(name)
+        except Exception as e:
+            logger.warning(f"Could not load detector {name}: {e}")
+
+
+def local_detector(stage):
+    async def detect(message, prompt, key=None):
+        try:
+            return await analysis.pool.run(stage, message.content)
+        except analysis.AnalysisError as e:
+            # The message goes through as clean rather than failing the event; the workers are being restarted
+            logger.warning(f"Local detector {stage} gave no verdict: {e}")
+            return False
+    return detect
+
+
+detectors = DetectorRegistry()
+detectors.register("gemini", "detect_gemini:detect")
+detectors.register("gpt", "detect_openai:detect")
+detectors.register("lexicon", "detect_lexicon:detect", local=True)
 
-async def detect_sextortion_gemini(message, prompt):
-    """
-    Detects sextortion using the Gemini model.
-    """
-    
-    project_id = "cs-152-discord-bot"
-    vertexai.init(project=project_id, location="us-west1")
-    model = GenerativeModel(model_name="gemini-1.0-pro-002")
-    
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    }
-    
-    response = model.generate_content(
-        prompt + "\n Here's the message: " + message.content,
-        safety_settings = safety_settings
-    )
-
-    if response.candidates[0].content.parts[0].text.lower().startswith("yes"):
-        return True
-    return False
-
-async def detect_sextortion_openai(message, prompt, key):
-    """ 
-    Template for making GPT request.
-    """
-    openai_api_key = key
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai_api_key}"
-    }
-
-    data = {
-        "model": "gpt-3.5-turbo",
-        "messages": [{"role": "system", "content": prompt}, {"role": "user", "content": message.content}],
-        "temperature": 1,
-    }
-
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data).json()
-    if response['choices'][0]['message']['content'] == 'yes':
-         return True
-    return False
 
 async def detect_sextortion(message, model, key=None):
     """
     Called by the bot to detect sextortion in a message.
     """
-    prompt = "Please tell me if you detect any sextortion in the message below. \
-              Sextortion occurs when the message contains both a request for explicit material and a threat if the receiver does not comply. \
-              For example, asking for nude images alone is not sufficient for sextortion; the message must also include a threat, such as releasing \
-              potentially incriminating or sensitive content, or physical harm. Respond in the following format: \
-              Please only say 'yes' or 'no' to indiciate if you detect sextortion."
-    
-    if model == "gemini":
-        return await detect_sextortion_gemini(message, prompt)
-    elif model == "gpt":
-        return await detect_sextortion_openai(message, prompt, key)
-    return False
+    if model not in detectors:
+        return False
+    detect = await detectors.load(model)
 
+    start = time.perf_counter()
+    try:
+        with span("detect_sextortion", backend=model):
+            detected = await detect(message, PROMPT, key)
+    except Exception:
+        DETECTIONS.labels(model, "error").inc()
+        raise
+    finally:
+        DETECT_LATENCY.labels(model).observe(time.perf_counter() - start)
+    DETECTIONS.labels(model, "yes" if detected else "no").inc()
+    return detected
@@ -0,0 +1,175 @@
+'''
+A small engine for the question-and-reaction flows used by Report and ManualReview.
+
+A flow is plain data: a dict of named steps, each with an optional intro message, a prompt, and
+either reaction options (emoji -> label/value/next step) or a free text answer. Flow() compiles
+that dict once into a tuple of Step objects with int ids and an emoji -> transition dict per
+step, so handling a reaction is a couple of dict lookups. A FlowSession only holds the current
+step id and the answers collected so far.
+
+Example step:
+
+    "demand": {
+        "intro": "We have two clarification questions about the nature of the sexual threat.",
+        "prompt": "First question: what is the sender demanding or asking for?",
+        "key": "demand",
+        "options": [option("1️⃣", "Nude Content"), option("2️⃣", "Other")],
+        "reply": "Thank you. We've logged the demand as \"{label}\".",
+        "next": "threat",
+    }
+
+Each option stores its value (the label unless given) under "key" and goes to its own "next"
+step, or to the step's "next". A step with "text": True stores the next message instead. A
+step with neither options nor text ends the flow; its prompt is the closing message.
+'''
+
+CHOICE = "choice"
+TEXT = "text"
+END = "end"
+
+
+def option(emoji, label, value=None, next=None, reply=None):
+    '''
+    Builds one reaction option of a step. value defaults to label; next and reply default to the step's "next" and "reply".
+    '''
+    return {"emoji": emoji, "label": label, "value": label if value is None else value, "next": next, "reply": reply}
+
+
+class Step:
+    __slots__ = ("id", "name", "kind", "key", "intro", "prompt", "dynamic", "emojis", "values", "transitions", "next")
+
+    def __init__(self, id, name, kind, key, intro, prompt):
+        self.id = id
+        self.name = name
+        self.kind = kind
+        self.key = key
+        self.intro = intro
+        self.prompt = prompt
+        self.dynamic = prompt is not None and "{" in prompt # Prompt needs the session answers filled in
+        self.emojis = ()
+        self.values = () # Option values in the order they are offered
+        self.transitions = {} # Map from emoji to (value, next step id, reply)
+        self.next = None # Next step id of a TEXT step
+
+
+class FlowSession:
+    __slots__ = ("step", "answers")
+
+    def __init__(self, step, answers=None):
+        self.step = step
+        self.answers = {} if answers is None else answers
+
+
+class Flow:
+    def __init__(self, name, start, steps, invalid_reply="Invalid reaction. Please try again."):
+        self.name = name
+        self.invalid_reply = invalid_reply
+        self.index = {step_name: i for i, step_name in enumerate(steps)}
+        self.steps = tuple(self.compile_step(self.index[step_name], step_name, definition) for step_name, definition in steps.items())
+        self.start = self.index[start]
+
+    def compile_step(self, id, name, definition):
+        if definition.get("options"):
+            kind = CHOICE
+        elif definition.get("text"):
+            kind = TEXT
+        else:
+            kind = END
+        prompt = definition.get("prompt")
+        if kind == CHOICE:
+            prompt = "\n".join([prompt] + [f'{o["emoji"]}: {o["label"]}' for o in definition["options"]])
+        step = Step(id, name, kind, definition.get("key"), definition.get("intro"), prompt)
+
+        if kind == CHOICE:
+            step.emojis = tuple(o["emoji"] for o in definition["options"])
+            step.values = tuple(o["value"] for o in definition["options"])
+            for o in definition["options"]:
+                next_name = o["next"] or definition.get("next")
+                if next_name not in self.index:
+                    raise ValueError(f'Flow {self.name}: step "{name}" goes to unknown step "{next_name}"')
+                reply = o["reply"] or definition.get("reply")
+                if reply is not None:
+                    reply = reply.format(label=o["label"], value=o["value"])
+                step.transitions[o["emoji"]] = (o["value"], self.index[next_name], reply)
+        elif kind == TEXT:
+            if definition.get("next") not in self.index:
+                raise ValueError(f'Flow {self.name}: step "{name}" goes to unknown step "{definition.get("next")}"')
+            step.next = self.index[definition["next"]]
+        return step
+
+    def new_session(self):
+        return FlowSession(self.start)
+
+    def step_name(self, session):
+        return self.steps[session.step].name
+
+    def restore_session(self, step_name, answers):
+        return FlowSession(self.index[step_name], answers)
+
+    def choices(self):
+        '''
+        Returns {answer key: option values in order} for every reaction step of the flow.
+        '''
+        choices = {}
+        for step in self.steps:
+            if step.kind == CHOICE and step.key is not None:
+                choices[step.key] = step.values
+        return choices
+
+    def is_done(self, session):
+        return self.steps[session.step].kind == END
+
+    def expects_text(self, session):
+        return self.steps[session.step].kind == TEXT
+
+    async def send_step(self, session, channel, context=None):
+        '''
+        Sends the intro and prompt of the session's current step to channel and adds the option reactions.
+        Returns the id of the prompt message (the message whose reactions answer the step), or None.
+        context is used to fill in {placeholders} in the prompt; it defaults to the session answers.
+        '''
+        intro, prompt = self.step_text(session, context)
+        if intro:
+            await channel.send(intro)
+        if prompt is None:
+            return None
+        prompt_message = await channel.send(prompt)
+        for emoji in self.step_emojis(session):
+            await prompt_message.add_reaction(emoji)
+        return prompt_message.id
+
+    def step_text(self, session, context=None):
+        '''
+        Returns (intro, prompt) of the session's current step, either may be None. Used by send_step() and to show
+        the step in an existing message.
+        '''
+        step = self.steps[session.step]
+        if step.prompt is None:
+            return step.intro, None
+        prompt = step.prompt.format_map(session.answers if context is None else context) if step.dynamic else step.prompt
+        return step.intro, prompt
+
+    def step_emojis(self, session):
+        return self.steps[session.step].emojis
+
+    def react(self, session, emoji):
+        '''
+        Applies a reaction to the session's current step. Returns (accepted, reply); reply may be None.
+        '''
+        step = self.steps[session.step]
+        transition = step.transitions.get(emoji)
+        if transition is None:
+            return False, self.invalid_reply
+        value, next_step, reply = transition
+        if step.key is not None:
+            session.answers[step.key] = value
+        session.step = next_step
+        return True, reply
+
+    def answer(self, session, text):
+        '''
+        Applies a text message to the session's current step, which must be a TEXT step.
+        '''
+        step = self.steps[session.step]
+        session.answers[step.key] = text
+        session.step = step.next
@@ -0,0 +1,166 @@
+import discord
+from review_queue import ReviewQueue
+from bulk import RateLimiter
+
+'''
+Per-guild state for running one bot across many servers.
+
+Every guild the bot is in gets a Tenant: its configuration, its mod channel and its own review
+queue. Reports go to the mod channel of the guild the reported message is in, or to the default
+guild when that guild has no mod channel (and for reports about DMs).
+
+Mod channels are indexed from guild and channel events rather than by scanning every channel
+at startup. The id of each guild's mod channel is kept in its configuration, so after the first
+time a guild becomes available its mod channel is found with a single lookup; the guild's
+channels are only scanned by name when that id is unknown or stale.
+'''
+
+
+class GuildConfig:
+    '''
+    Settings a guild's moderators can change with the `config` command.
+    '''
+    __slots__ = ("mod_channel_name", "report_channel_name", "mod_channel_id", "edit_in_place", "auto_reports")
+
+    # Settings that can be changed with `config key=value`
+    SETTINGS = ("mod_channel_name", "report_channel_name", "edit_in_place", "auto_reports")
+
+    def __init__(self, mod_channel_name=None, report_channel_name=None, mod_channel_id=None, edit_in_place=True,
+                 auto_reports=True):
+        self.mod_channel_name = mod_channel_name # Name of the mod channel; None for the group's default
+        self.report_channel_name = report_channel_name # Name of the channel whose messages are handled; None for the default
+        self.mod_channel_id = mod_channel_id # Id of the mod channel last found
+        self.edit_in_place = edit_in_place # Whether manual reviews edit the report's post instead of sending messages
+        self.auto_reports = auto_reports # Whether the bot's own detections are posted for review
+
+    def set(self, key, value):
+        '''
+        Changes a setting from its text form. Raises ValueError with a message for the moderator.
+        '''
+        if key not in self.SETTINGS:
+            raise ValueError(f"Unknown setting \"{key}\". Settings are: {', '.join(self.SETTINGS)}")
+        if isinstance(getattr(self, key), bool):
+            if value.lower() not in ("on", "off", "true", "false", "yes", "no"):
+                raise ValueError(f"{key} must be on or off.")
+            value = value.lower() in ("on", "true", "yes")
+        elif value.lower() in ("default", "none"):
+            value = None
+        setattr(self, key, value)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{key: value for key, value in data.items() if key in cls.__slots__})
+
+
+class Tenant:
+    __slots__ = ("guild_id", "config", "mod_channel", "reports_to_review", "pending_by_message", "review_queue",
+                 "bulk_limiter")
+
+    def __init__(self, guild_id, config=None):
+        self.guild_id = guild_id
+        self.config = config or GuildConfig()
+        self.mod_channel = None
+        self.reports_to_review = {} # Map from message_id in mod channel to the ReportRecord of the respective report
+        self.pending_by_message = {} # Map from (guild_id, channel_id, message_id) of a reported message to its message_id in mod channel
+        self.review_queue = ReviewQueue() # Priority order of the reports in self.reports_to_review
+        self.bulk_limiter = RateLimiter() # Rate limit of the post edits made by bulk reviews
+
+
+class GuildRegistry:
+    def __init__(self, default_guild_id, configs=None):
+        self.default_guild_id = default_guild_id # Guild whose mod channel gets the reports no other guild can take
+        self.group_num = None
+        self.tenants = {guild_id: Tenant(guild_id, config) for guild_id, config in (configs or {}).items()}
+        self.by_mod_channel = {} # Map from mod channel id to its Tenant
+
+    def __iter__(self):
+        return iter(self.tenants.values())
+
+    def get(self, guild_id):
+        return self.tenants.get(guild_id)
+
+    def tenant(self, guild_id):
+        '''
+        Returns the Tenant of guild_id, creating it if needed.
+        '''
+        tenant = self.tenants.get(guild_id)
+        if tenant is None:
+            tenant = self.tenants[guild_id] = Tenant(guild_id)
+        return tenant
+
+    def for_channel(self, channel_id):
+        '''
+        Returns the Tenant whose mod channel is channel_id, or None.
+        '''
+        return self.by_mod_channel.get(channel_id)
+
+    def route(self, guild_id):
+        '''
+        Returns the Tenant whose mod channel should review a report of a message in guild_id, or None if
+        neither that guild nor the default guild has a mod channel.
+        '''
+        for candidate in (guild_id, self.default_guild_id):
+            tenant = self.tenants.get(candidate)
+            if tenant is not None and tenant.mod_channel is not None:
+                return tenant
+        return None
+
+    def mod_channel_name(self, tenant):
+        return tenant.config.mod_channel_name or f'group-{self.group_num}-mod'
+
+    def report_channel_name(self, tenant):
+        return tenant.config.report_channel_name or f'group-{self.group_num}'
+
+    ### Indexing from guild and channel events ###
+
+    def index_guild(self, guild):
+        '''
+        Finds the mod channel of guild. Returns (tenant, True if the mod channel changed).
+        '''
+        tenant = self.tenant(guild.id)
+        name = self.mod_channel_name(tenant)
+        channel = guild.get_channel(tenant.config.mod_channel_id) if tenant.config.mod_channel_id else None
+        if channel is None or channel.name != name:
+            channel = discord.utils.get(guild.text_channels, name=name)
+        return tenant, self.set_mod_channel(tenant, channel)
+
+    def set_mod_channel(self, tenant, channel):
+        if channel is tenant.mod_channel:
+            return False
+        if tenant.mod_channel is not None:
+            self.by_mod_channel.pop(tenant.mod_channel.id, None)
+        tenant.mod_channel = channel
+        tenant.config.mod_channel_id = channel.id if channel is not None else None
+        if channel is not None:
+            self.by_mod_channel[channel.id] = tenant
+        return True
+
+    def channel_created(self, channel):
+        '''
+        Returns the Tenant if channel became its mod channel, otherwise None.
+        '''
+        tenant = self.tenants.get(channel.guild.id)
+        if tenant is None or tenant.mod_channel is not None or channel.name != self.mod_channel_name(tenant):
+            return None
+        if not isinstance(channel, discord.TextChannel):
+            return None
+        self.set_mod_channel(tenant, channel)
+        return tenant
+
+    def channel_deleted(self, channel):
+        tenant = self.by_mod_channel.get(channel.id)
+        if tenant is not None:
+            self.set_mod_channel(tenant, None)
+        return tenant
+
+    def remove_guild(self, guild):
+        '''
+        Called when the bot leaves guild. Its reports stay in the store until the bot is added again.
+        '''
+        tenant = self.tenants.pop(guild.id, None)
+        if tenant is not None and tenant.mod_channel is not None:
+            self.by_mod_channel.pop(tenant.mod_channel.id, None)
+        return tenant
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import os
+import re
+import sys
+
+'''
+Link analysis for spam and scam messages.
+
+URLs are pulled out of a message (with or without a scheme, including defanged "hxxp://" and
+"example[.]com" forms), and the host of each is normalized: lowercased, without user info, port
+and trailing dot, and IDNA encoded so look-alike Unicode domains compare as their punycode form.
+Shortened links are not followed.
+
+Hosts are matched against a local blocklist (SCAM_DOMAINS_PATH). A listed domain matches itself
+and every subdomain. The list is held as a suffix set: a dict from domain to the rule it came
+from, so a lookup checks each suffix of the host ("a.b.example.com", "b.example.com",
+"example.com", "com") and costs one dict lookup per label, whatever the size of the list.
+
+List format, one entry per line:
+
+    # comment
+    [rule name]            the entries below belong to this rule
+    example.com
+    bad.example.net
+
+BlocklistWatcher reloads the file in a thread when it changes and swaps in the new set in one
+assignment, so lookups never wait for a reload.
+'''
+
+logger = logging.getLogger('discord')
+
+SCAM_DOMAINS_PATH = 'scam_domains.txt'
+# Seconds between checks of the blocklist file for changes
+RELOAD_INTERVAL = 30
+DEFAULT_RULE = "blocklist"
+
+URL_PATTERN = re.compile(
+    r"(?:(?:https?|hxxps?)://|www\.)[^\s<>\"']+"
+    r"|\b(?:[^\W_](?:[\w-]{0,61}[^\W_])?(?:\.|\[\.\]))+[^\W\d_][\w-]{1,62}\b(?:/[^\s<>\"']*)?",
+    re.IGNORECASE,
+)
+SCHEME_PATTERN = re.compile(r"^[a-z][a-z0-9+.-]*://", re.IGNORECASE)
+
+
+def normalize_host(host):
+    '''
+    Returns host in the form used by the blocklist, or None if it is not a valid host name.
+    '''
+    host = host.strip().strip(".").lower()
+    if not host:
+        return None
+    try:
+        host = host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+    labels = host.split(".")
+    if len(labels) < 2 or not all(labels):
+        return None
+    return host
+
+
+def url_host(url):
+    '''
+    Returns the normalized host of a URL found in a message.
+    '''
+    url = url.replace("[.]", ".").replace("(.)", ".")
+    url = SCHEME_PATTERN.sub("", url)
+    host = re.split(r"[/?#\\]", url, 1)[0]
+    host = host.rsplit("@", 1)[-1] # Drop user info (https://paypal.com@evil.example)
+    if host.startswith("["):
+        return None # IPv6 literal
+    return normalize_host(host.split(":", 1)[0])
+
+
+def extract_links(text):
+    '''
+    Returns [(url, host)] for every link in text, once per host.
+    '''
+    links = []
+    seen = set()
+    for match in URL_PATTERN.finditer(text or ""):
+        url = match.group(0).rstrip(".,;:!?)]}'\"")
+        host = url_host(url)
+        if host is not None and host not in seen:
+            seen.add(host)
+            links.append((url, host))
+    return links
+
+
+class DomainBlocklist:
+    def __init__(self, domains=None):
+        self.domains = domains if domains is not None else {} # Map from blocked domain to its rule name
+
+    def __len__(self):
+        return len(self.domains)
+
+    @classmethod
+    def load(cls, path=SCAM_DOMAINS_PATH):
+        '''
+        Reads a blocklist file. A missing file gives an empty list.
+        '''
+        domains = {}
+        if os.path.isfile(path):
+            rule = DEFAULT_RULE
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if not line:
+                        continue
+                    if line.startswith("[") and line.endswith("]"):
+                        rule = sys.intern(line[1:-1].strip() or DEFAULT_RULE)
+                        continue
+                    domain = normalize_host(line.removeprefix("*."))
+                    if domain is not None:
+                        domains[domain] = rule
+        return cls(domains)
+
+    def match(self, host):
+        '''
+        Returns (domain, rule) for the most specific blocked domain that host is or is a subdomain of, or None.
+        '''
+        domains = self.domains
+        start = 0
+        while True:
+            rule = domains.get(host[start:] if start else host)
+            if rule is not None:
+                return host[start:], rule
+            start = host.find(".", start) + 1
+            if not start:
+                return None
+
+
+class LinkMatch:
+    __slots__ = ("url", "host", "domain", "rule")
+
+    def __init__(self, url, host, domain, rule):
+        self.url = url
+        self.host = host
+        self.domain = domain
+        self.rule = rule
+
+    def describe(self):
+        return f"Link {self.url} matches {self.domain} (rule: {self.rule})"
+
+
+class BlocklistWatcher:
+    '''
+    Holds the current DomainBlocklist and reloads it when the file changes.
+    '''
+    def __init__(self, path=SCAM_DOMAINS_PATH, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.mtime = self.file_mtime()
+        self.blocklist = DomainBlocklist.load(path)
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def scan(self, text):
+        '''
+        Returns a LinkMatch for every link in text whose host is blocked.
+        '''
+        blocklist = self.blocklist
+        if not len(blocklist):
+            return []
+        matches = []
+        for url, host in extract_links(text):
+            match = blocklist.match(host)
+            if match is not None:
+                matches.append(LinkMatch(url, host, *match))
+        return matches
+
+    async def reload_if_changed(self):
+        mtime = self.file_mtime()
+        if mtime == self.mtime:
+            return False
+        blocklist = await asyncio.to_thread(DomainBlocklist.load, self.path)
+        self.mtime = mtime
+        self.blocklist = blocklist
+        logger.info(f"Reloaded {len(blocklist)} scam domains from {self.path}")
+        return True
+
+    async def watch(self):
+        '''
+        Background task that reloads the blocklist every `interval` seconds if the file changed.
+        '''
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reload_if_changed()
+            except (OSError, UnicodeError) as e:
+                logger.warning(f"Could not reload {self.path}: {e}")
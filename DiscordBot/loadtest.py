@@ -0,0 +1,622 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import gc
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import discord
+import bot
+import tracing
+from bulk import RateLimiter
+from report import REPORT_FLOW
+
+'''
+Offline load test of ModBot.
+
+    python loadtest.py --reports 500 --concurrency 100 --moderators 10
+    python loadtest.py --reports 200 --route-rate 1 --route-burst 5 --rest-latency 0.08
+    python loadtest.py --reports 100 --record events.jsonl
+    python loadtest.py --replay events.jsonl --speed 4
+
+A ModBot subclass is connected to a fake Discord: guilds, channels, users and messages held in
+memory. Sending a message, adding a reaction, editing or fetching a message wait for a simulated
+REST latency and go through token buckets per route and channel (and optionally a global one)
+like Discord's rate limits. The LLM detector is replaced by one with a configurable latency and
+hit rate, and the bot runs in a temporary directory with its own database. Nothing touches the
+network.
+
+Events are delivered by calling on_message and on_raw_reaction_add, as the gateway would:
+  - report journeys: a user DMs `report`, the link to a message in the group channel, then
+    answers every question of the report flow (a random option of each prompt)
+  - review journeys: moderators type `next` in the mod channel and answer every question of the
+    manual review, until every report is reviewed
+  - optionally a constant rate of plain DMs from other users (--dm-rate)
+Report journeys run --concurrency at a time. With --rounds the whole load is repeated and the
+memory is measured after each round, so growth that is not released between rounds shows up.
+
+The time to handle each event is recorded under the flow step it answered, and the run ends with
+throughput, latency percentiles per step, REST call counts and memory use. --record writes the
+delivered events to a file (links to the reported messages as "{target}", reactions as "the
+option chosen on the user's current prompt"), and --replay plays such a file back with its
+original timing, each user's events in order.
+'''
+
+HOME_GUILD_ID = 1211760623969370122
+GROUP_NUM = "32"
+# Simulated seconds per REST call, plus up to REST_JITTER
+REST_LATENCY = 0.02
+REST_JITTER = 0.01
+# Simulated seconds per call to the LLM detector, and fraction of messages it flags
+DETECT_LATENCY = 0.2
+DETECT_RATE = 0.05
+# Maximum number of events in one journey, in case a flow never ends
+MAX_JOURNEY_EVENTS = 50
+# Seconds between checks of the review queue by idle moderators
+MODERATOR_POLL = 0.05
+
+NOT_FOUND = types.SimpleNamespace(status=404, reason="Not Found")
+
+
+class SimulatedREST:
+    '''
+    Stands in for Discord's REST API. Every call waits for a token of its route and channel's bucket (and of the
+    global bucket) and then for the simulated latency.
+    '''
+    def __init__(self, latency=REST_LATENCY, jitter=REST_JITTER, route_rate=None, route_burst=5, global_rate=None,
+                 rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.route_rate = route_rate
+        self.route_burst = route_burst
+        self.global_limiter = RateLimiter(global_rate, global_rate) if global_rate else None
+        self.rng = rng or random.Random()
+        self.buckets = {} # Map from (route, channel id) to its RateLimiter
+        self.calls = collections.Counter() # Number of calls per route
+        self.limited = 0.0 # Seconds spent waiting for rate limits
+
+    async def call(self, route, channel_id):
+        self.calls[route] += 1
+        start = time.perf_counter()
+        if self.global_limiter is not None:
+            await self.global_limiter.acquire()
+        if self.route_rate:
+            bucket = self.buckets.get((route, channel_id))
+            if bucket is None:
+                bucket = self.buckets[(route, channel_id)] = RateLimiter(self.route_rate, self.route_burst)
+            await bucket.acquire()
+        self.limited += time.perf_counter() - start
+        delay = self.latency + self.rng.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+### Fake Discord objects ###
+
+class FakeUser:
+    def __init__(self, world, id, name):
+        self.world = world
+        self.id = id
+        self.name = name
+        self.mention = f"<@{id}>"
+        self.created_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.dm_channel = FakeChannel(world, world.new_id(), f"dm-{name}", None)
+
+    async def send(self, content):
+        return await self.dm_channel.send(content)
+
+
+class FakeMessage:
+    def __init__(self, channel, id, author, content):
+        self.channel = channel
+        self.id = id
+        self.author = author
+        self.content = content
+        self.guild = channel.guild
+        self.attachments = []
+        self.reactions = [] # Emojis added by the bot
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild.id if self.guild else '@me'}/{self.channel.id}/{self.id}"
+
+    async def add_reaction(self, emoji):
+        await self.channel.world.rest.call("PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me",
+                                           self.channel.id)
+        self.reactions.append(emoji)
+
+    async def edit(self, content=None):
+        await self.channel.world.rest.call("PATCH /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        self.content = content
+
+
+class FakePartialMessage:
+    def __init__(self, channel, id):
+        self.channel = channel
+        self.id = id
+
+    async def edit(self, content=None):
+        await self.channel.world.rest.call("PATCH /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        message = self.channel.messages.get(self.id)
+        if message is None:
+            raise discord.errors.NotFound(NOT_FOUND, "Unknown Message")
+        message.content = content
+
+    async def add_reaction(self, emoji):
+        await self.channel.world.rest.call("PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me",
+                                           self.channel.id)
+        self.channel.messages[self.id].reactions.append(emoji)
+
+    async def clear_reactions(self):
+        await self.channel.world.rest.call("DELETE /channels/{channel_id}/messages/{message_id}/reactions", self.channel.id)
+        self.channel.messages[self.id].reactions.clear()
+
+
+class FakeChannel:
+    def __init__(self, world, id, name, guild):
+        self.world = world
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.mention = f"<#{id}>"
+        self.messages = {} # Map from message id to FakeMessage
+        world.channels[id] = self
+
+    def post(self, author, content):
+        '''
+        Adds a message without going through the REST API (for the messages users send).
+        '''
+        message = FakeMessage(self, self.world.new_id(), author, content)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content):
+        await self.world.rest.call("POST /channels/{channel_id}/messages", self.id)
+        return self.post(self.world.bot_user, content)
+
+    async def fetch_message(self, message_id):
+        await self.world.rest.call("GET /channels/{channel_id}/messages/{message_id}", self.id)
+        message = self.messages.get(message_id)
+        if message is None:
+            raise discord.errors.NotFound(NOT_FOUND, "Unknown Message")
+        return message
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+
+class FakeGuild:
+    def __init__(self, world, id, channel_names):
+        self.world = world
+        self.id = id
+        self.name = f"guild-{id}"
+        self.text_channels = [FakeChannel(world, world.new_id(), name, self) for name in channel_names]
+
+    def get_channel(self, channel_id):
+        channel = self.world.channels.get(channel_id)
+        return channel if channel is not None and channel.guild is self else None
+
+
+class FakeDiscord:
+    '''
+    In-memory guild, channels and users the bot is connected to.
+    '''
+    def __init__(self, rest):
+        self.rest = rest
+        self.ids = itertools.count(HOME_GUILD_ID + 1)
+        self.channels = {} # Map from channel id to FakeChannel
+        self.users = {} # Map from user id to FakeUser
+        self.bot_user = self.new_user(f"Group {GROUP_NUM} Bot")
+        self.guild = FakeGuild(self, HOME_GUILD_ID, [f"group-{GROUP_NUM}", f"group-{GROUP_NUM}-mod"])
+        self.guilds = {self.guild.id: self.guild}
+        self.report_channel, self.mod_channel = self.guild.text_channels
+
+    def new_id(self):
+        return next(self.ids)
+
+    def new_user(self, name):
+        user = FakeUser(self, self.new_id(), name)
+        self.users[user.id] = user
+        return user
+
+    def forget(self, users):
+        '''
+        Drops users, their DMs and the reported messages, so the memory measured after a round is mostly the bot's.
+        '''
+        for user in users:
+            self.users.pop(user.id, None)
+            self.channels.pop(user.dm_channel.id, None)
+        self.report_channel.messages.clear()
+
+
+class LoadTestBot(bot.ModBot):
+    '''
+    ModBot connected to a FakeDiscord instead of the gateway.
+    '''
+    def __init__(self, world):
+        self.world = world
+        super().__init__()
+
+    async def setup_hook(self):
+        # login() normally runs discord.py's own setup first; without it close() has no shard queue to use
+        await self._async_setup_hook()
+        await super().setup_hook()
+
+    @property
+    def user(self):
+        return self.world.bot_user
+
+    def get_guild(self, guild_id):
+        return self.world.guilds.get(guild_id)
+
+    def get_user(self, user_id):
+        return self.world.users.get(user_id)
+
+    async def fetch_user(self, user_id):
+        await self.world.rest.call("GET /users/{user_id}", None)
+        return self.world.users[user_id]
+
+    async def fetch_channel(self, channel_id):
+        await self.world.rest.call("GET /channels/{channel_id}", channel_id)
+        return self.world.channels[channel_id]
+
+
+### Driving events ###
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def memory_used():
+    '''
+    Resident memory of this process in bytes, or None if it cannot be read.
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        return None
+
+
+class Driver:
+    '''
+    Delivers events to the bot, times them and optionally records them.
+    '''
+    def __init__(self, client, world, record=None):
+        self.client = client
+        self.world = world
+        self.latencies = collections.defaultdict(list) # Map from flow step to the seconds taken by its events
+        self.errors = collections.Counter()
+        self.events = 0
+        self.start = time.perf_counter()
+        self.record = record # File the delivered events are written to
+
+    async def deliver(self, label, event):
+        start = time.perf_counter()
+        try:
+            await event
+        except Exception as e:
+            self.errors[f"{label}: {type(e).__name__}: {e}"] += 1
+            return False
+        finally:
+            self.latencies[label].append(time.perf_counter() - start)
+            self.events += 1
+        return True
+
+    def write(self, user, **event):
+        if self.record is not None:
+            self.record.write(json.dumps({"t": round(time.perf_counter() - self.start, 4), "user": user.name, **event}) + "\n")
+
+    async def dm(self, user, content, template=None):
+        report = self.client.reports.get(user.id)
+        if report is not None:
+            label = f"report.{report.step()}"
+        else:
+            label = "report.report_start" if content.startswith("report") else "dm"
+        self.write(user, kind="dm", content=template or content)
+        return await self.deliver(label, self.client.on_message(user.dm_channel.post(user, content)))
+
+    async def mod_command(self, moderator, content):
+        self.write(moderator, kind="mod", content=content)
+        message = self.world.mod_channel.post(moderator, content)
+        return await self.deliver(f"review.{content.split()[0]}", self.client.on_message(message))
+
+    def prompt(self, user, where):
+        '''
+        Returns the message whose reactions answer the user's current question, or None.
+        '''
+        if where == "dm":
+            session, channel = self.client.reports.get(user.id), user.dm_channel
+        else:
+            session, channel = self.client.manual_reviews.get(user.id), self.world.mod_channel
+        if session is None or session.next_message_id is None:
+            return None
+        return channel.messages.get(session.next_message_id)
+
+    async def react(self, user, where, emoji):
+        prompt = self.prompt(user, where)
+        if prompt is None:
+            self.errors[f"{where}: no prompt to react to"] += 1
+            return False
+        if where == "dm":
+            label = f"report.{self.client.reports[user.id].step()}"
+        else:
+            label = f"review.{self.client.manual_reviews[user.id].step()}"
+        self.write(user, kind="reaction", where=where, emoji=emoji)
+        payload = types.SimpleNamespace(user_id=user.id, message_id=prompt.id, channel_id=prompt.channel.id,
+                                        guild_id=prompt.guild.id if prompt.guild else None,
+                                        emoji=types.SimpleNamespace(name=emoji), member=None)
+        return await self.deliver(label, self.client.on_raw_reaction_add(payload))
+
+
+async def report_journey(driver, user, target, rng, think_time=0):
+    '''
+    One user reports target (a FakeMessage) and answers every question. Returns True if the report was submitted.
+    '''
+    if not await driver.dm(user, "report"):
+        return False
+    if not await driver.dm(user, target.jump_url, template="{target}"):
+        return False
+    for _ in range(MAX_JOURNEY_EVENTS):
+        report = driver.client.reports.get(user.id)
+        if report is None:
+            return True
+        if think_time:
+            await asyncio.sleep(rng.random() * think_time)
+        if REPORT_FLOW.expects_text(report.session):
+            ok = await driver.dm(user, "They said they would share my photos.")
+        else:
+            prompt = driver.prompt(user, "dm")
+            ok = prompt is not None and prompt.reactions and await driver.react(user, "dm", rng.choice(prompt.reactions))
+        if not ok:
+            driver.errors["report: journey stopped"] += 1
+            return False
+    driver.errors["report: too many events"] += 1
+    return False
+
+
+async def review_journey(driver, moderator, rng, done, think_time=0):
+    '''
+    A moderator reviews reports until done is set and no report is waiting. Returns the number of reviews completed.
+    '''
+    client = driver.client
+    reviewed = 0
+    while True:
+        tenant = client.tenants.get(driver.world.guild.id)
+        if not len(tenant.review_queue):
+            if done.is_set():
+                return reviewed
+            await asyncio.sleep(MODERATOR_POLL)
+            continue
+        await driver.mod_command(moderator, "next")
+        if moderator.id not in client.manual_reviews:
+            continue # Another moderator took the last report
+        for _ in range(MAX_JOURNEY_EVENTS):
+            if moderator.id not in client.manual_reviews:
+                break
+            if think_time:
+                await asyncio.sleep(rng.random() * think_time)
+            prompt = driver.prompt(moderator, "mod")
+            if prompt is None or not prompt.reactions or not await driver.react(moderator, "mod", rng.choice(prompt.reactions)):
+                driver.errors["review: journey stopped"] += 1
+                return reviewed
+        else:
+            driver.errors["review: too many events"] += 1
+            return reviewed
+        reviewed += 1
+
+
+async def dm_flood(driver, users, rate, stop):
+    '''
+    Sends plain DMs from users at rate per second until stop is set.
+    '''
+    interval = 1 / rate
+    sends = set()
+    for user in itertools.cycle(users):
+        if stop.is_set():
+            break
+        sends.add(asyncio.create_task(driver.dm(user, "hey, are you around later?")))
+        await asyncio.sleep(interval)
+    await asyncio.gather(*sends)
+
+
+async def run_round(driver, args, rng, round_num):
+    world = driver.world
+    offenders = [world.new_user(f"offender-{round_num}-{i}") for i in range(max(1, args.reports // 10))]
+    targets = []
+    for i in range(args.reports):
+        if targets and rng.random() < args.duplicates:
+            targets.append(rng.choice(targets)) # Another report of a message that was already reported
+        else:
+            targets.append(world.report_channel.post(rng.choice(offenders), f"send me pics or else ({round_num}/{i})"))
+    reporters = [world.new_user(f"user-{round_num}-{i}") for i in range(args.reports)]
+    moderators = [world.new_user(f"mod-{round_num}-{i}") for i in range(args.moderators)]
+    chatters = [world.new_user(f"chatter-{round_num}-{i}") for i in range(100)] if args.dm_rate else []
+
+    done = asyncio.Event()
+    reviews = [asyncio.create_task(review_journey(driver, moderator, rng, done, args.think_time)) for moderator in moderators]
+    flood = None
+    if chatters:
+        flood = asyncio.create_task(dm_flood(driver, chatters, args.dm_rate, done))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user, target):
+        async with semaphore:
+            return await report_journey(driver, user, target, rng, args.think_time)
+
+    start = time.perf_counter()
+    submitted = await asyncio.gather(*(limited(user, target) for user, target in zip(reporters, targets)))
+    report_seconds = time.perf_counter() - start
+    done.set()
+    reviewed = sum(await asyncio.gather(*reviews))
+    if flood is not None:
+        await flood
+    await driver.client.mod_posts.flush()
+    world.forget(offenders + reporters + moderators + chatters)
+    return sum(submitted), reviewed, report_seconds, time.perf_counter() - start
+
+
+async def replay(driver, path, speed):
+    '''
+    Plays back a file written with --record. Returns the number of events.
+    '''
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    by_user = collections.defaultdict(list)
+    for event in events:
+        by_user[event["user"]].append(event)
+    world = driver.world
+    start = time.perf_counter()
+
+    async def play(name, user_events):
+        user = world.new_user(name)
+        target = world.report_channel.post(world.new_user(f"offender-of-{name}"), "send me pics or else")
+        for event in user_events:
+            delay = event["t"] / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if event["kind"] == "dm":
+                await driver.dm(user, event["content"].replace("{target}", target.jump_url))
+            elif event["kind"] == "mod":
+                await driver.mod_command(user, event["content"])
+            else:
+                await driver.react(user, event["where"], event["emoji"])
+
+    await asyncio.gather(*(play(name, user_events) for name, user_events in by_user.items()))
+    return len(events)
+
+
+def print_results(driver, rest, rounds, memory):
+    print(f"\n{'step':<40}{'events':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for label in sorted(driver.latencies):
+        values = sorted(driver.latencies[label])
+        print(f"{label:<40}{len(values):>8}" + "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (0.5, 0.9, 0.99)) +
+              f"{values[-1] * 1000:>10.1f}")
+    print(f"\nREST calls: {sum(rest.calls.values())} ({rest.limited:.1f}s waiting for rate limits)")
+    for route, count in rest.calls.most_common():
+        print(f"  {count:>8} {route}")
+    if rounds:
+        print("\nround  reports  reviews  seconds  reports/s  events/s  memory MB")
+        for i, (submitted, reviewed, report_seconds, seconds, events) in enumerate(rounds):
+            mb = f"{memory[i + 1] / 1e6:.1f}" if memory[i + 1] is not None else "?"
+            print(f"{i + 1:>5}{submitted:>9}{reviewed:>9}{seconds:>9.2f}{submitted / report_seconds:>11.1f}"
+                  f"{events / seconds:>10.1f}{mb:>11}")
+    if memory[0] is not None and memory[-1] is not None:
+        print(f"\nMemory: {memory[0] / 1e6:.1f} MB before, {memory[-1] / 1e6:.1f} MB after "
+              f"({(memory[-1] - memory[0]) / 1e6:+.1f} MB)")
+    if driver.errors:
+        print("\nErrors:")
+        for error, count in driver.errors.most_common():
+            print(f"  {count:>6} {error}")
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    rest = SimulatedREST(args.rest_latency, args.rest_jitter, args.route_rate, args.route_burst, args.global_rate, rng)
+    world = FakeDiscord(rest)
+
+    async def detect(message, model, key=None):
+        await asyncio.sleep(args.detect_latency)
+        return rng.random() < args.detect_rate
+    bot.detect_sextortion = detect
+
+    client = LoadTestBot(world)
+    tracing.configure(args.trace_sample, "traces.json")
+    client.metrics.port = 0 # Any free port, so a running bot is not disturbed
+    await client.setup_hook()
+    await client.on_guild_available(world.guild)
+
+    record = open(args.record, "w") if args.record else None
+    driver = Driver(client, world, record)
+    measure = (lambda: tracemalloc.get_traced_memory()[0]) if args.tracemalloc else memory_used
+    if args.tracemalloc:
+        tracemalloc.start()
+    gc.collect()
+    memory = [measure()]
+    rounds = []
+    replayed = None
+    try:
+        # Keeps what the bot prints out of the results table
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if args.replay:
+                start = time.perf_counter()
+                replayed = (await replay(driver, args.replay, args.speed), time.perf_counter() - start)
+            else:
+                for round_num in range(args.rounds):
+                    events = driver.events
+                    submitted, reviewed, report_seconds, seconds = await run_round(driver, args, rng, round_num)
+                    rounds.append((submitted, reviewed, report_seconds, seconds, driver.events - events))
+                    gc.collect()
+                    memory.append(measure())
+    finally:
+        if record is not None:
+            record.close()
+        await client.close()
+    if replayed is not None:
+        print(f"Replayed {replayed[0]} events in {replayed[1]:.2f}s")
+    print_results(driver, rest, rounds, memory)
+    if args.tracemalloc:
+        print("\nLargest allocations still held:")
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)])
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(f"  {stat}")
+    return 1 if driver.errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of ModBot with a simulated Discord.")
+    parser.add_argument("--reports", type=int, default=200, help="report journeys per round")
+    parser.add_argument("--concurrency", type=int, default=50, help="report journeys in progress at the same time")
+    parser.add_argument("--moderators", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of reports about an already reported message")
+    parser.add_argument("--think-time", type=float, default=0, help="maximum seconds a user waits before each answer")
+    parser.add_argument("--dm-rate", type=float, default=0, help="plain DMs per second from other users during each round")
+    parser.add_argument("--rest-latency", type=float, default=REST_LATENCY)
+    parser.add_argument("--rest-jitter", type=float, default=REST_JITTER)
+    parser.add_argument("--route-rate", type=float, default=None, help="REST calls per second per route and channel")
+    parser.add_argument("--route-burst", type=int, default=5)
+    parser.add_argument("--global-rate", type=float, default=None, help="REST calls per second in total")
+    parser.add_argument("--detect-latency", type=float, default=DETECT_LATENCY)
+    parser.add_argument("--detect-rate", type=float, default=DETECT_RATE)
+    parser.add_argument("--trace-sample", type=float, default=0.0)
+    parser.add_argument("--tracemalloc", action="store_true", help="measure Python allocations instead of resident memory")
+    parser.add_argument("--record", help="write the delivered events to this file")
+    parser.add_argument("--replay", help="play back events written with --record")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for path in ("record", "replay"):
+        if getattr(args, path):
+            setattr(args, path, os.path.abspath(getattr(args, path)))
+
+    # The bot's database and files go to a directory that is removed afterwards
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="modbot-loadtest-") as workdir:
+        os.chdir(workdir)
+        try:
+            return asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+'''
+Logging that does not block the event loop.
+
+start_logging() puts a QueueHandler on the `discord` logger (which discord.py and this bot log
+to). Handling a record on the event loop thread only merges its message with its arguments and
+puts it on a bounded queue; a QueueListener thread formats it and writes it to the log file and
+the console. If the writer falls behind and the queue is full, records are dropped rather than
+waiting, and the number dropped is logged once the queue drains.
+
+The log file rotates when it reaches LOG_MAX_BYTES or is LOG_ROTATE_INTERVAL seconds old, keeping
+LOG_BACKUPS old files. The log of the previous run is rotated out when the bot starts.
+
+DEBUG records are sampled: discord.py logs every gateway event and REST request at DEBUG level.
+Within each DEBUG_SAMPLE_WINDOW, the first DEBUG_SAMPLE_FIRST records of a message template are
+kept and then one in DEBUG_SAMPLE_EVERY. Records at INFO and above are always kept.
+
+Logger levels can be changed while the bot runs by writing LOG_LEVELS_PATH, for example
+
+    {"discord": "DEBUG", "discord.gateway": "INFO", "discord.http": "WARNING"}
+
+which is read again within LOG_LEVELS_INTERVAL seconds of changing.
+'''
+
+logger = logging.getLogger('discord')
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_ROTATE_INTERVAL = 24 * 60 * 60
+# Maximum number of records waiting for the writer thread
+LOG_QUEUE_SIZE = 10000
+DEBUG_SAMPLE_WINDOW = 10
+DEBUG_SAMPLE_FIRST = 20
+DEBUG_SAMPLE_EVERY = 100
+LOG_LEVELS_PATH = 'log_levels.json'
+LOG_LEVELS_INTERVAL = 5
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Rotates when the file reaches max_bytes or is interval seconds old.
+    '''
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, interval=LOG_ROTATE_INTERVAL):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.doRollover()
+
+    def shouldRollover(self, record):
+        return time.time() >= self.rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class DebugSampler(logging.Filter):
+    '''
+    Keeps the first `first` DEBUG records of each message template per window of `window` seconds, then one in `every`.
+    '''
+    def __init__(self, window=DEBUG_SAMPLE_WINDOW, first=DEBUG_SAMPLE_FIRST, every=DEBUG_SAMPLE_EVERY):
+        super().__init__()
+        self.window = window
+        self.first = first
+        self.every = every
+        self.counts = {} # Map from (logger name, message template) to the number of records in this window
+        self.window_end = time.time() + window
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if record.created >= self.window_end:
+            self.counts.clear()
+            self.window_end = record.created + self.window
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg))
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        return count <= self.first or count % self.every == 0
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that drops records instead of blocking when the queue is full, and leaves the formatting to
+    the writer thread.
+    '''
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The arguments may change after this returns, so the message is merged now; the rest of the
+        # formatting (time, level, exception text) happens in the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    def __init__(self, handler, listener, sampler):
+        self.handler = handler
+        self.listener = listener
+        self.sampler = sampler
+        self.reported_drops = 0
+
+    def report_drops(self):
+        dropped = self.handler.dropped - self.reported_drops
+        if dropped:
+            self.reported_drops += dropped
+            logger.warning(f"Dropped {dropped} log records because the log writer fell behind")
+
+    def stop(self):
+        '''
+        Writes the queued records and stops the writer thread.
+        '''
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        logging.getLogger('discord').removeHandler(self.handler)
+
+
+pipeline = None
+
+
+def start_logging(path='discord.log', level=logging.DEBUG, console_level=logging.INFO):
+    '''
+    Sends the records of the `discord` logger to path (and INFO and above to stderr) through a writer thread.
+    '''
+    global pipeline
+    if pipeline is not None:
+        return pipeline
+    file_handler = RotatingLogHandler(path)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(name)s %(message)s'))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = LogQueueHandler(log_queue)
+    sampler = DebugSampler()
+    handler.addFilter(sampler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    discord_logger = logging.getLogger('discord')
+    discord_logger.setLevel(level)
+    discord_logger.addHandler(handler)
+    discord_logger.propagate = False
+    pipeline = LogPipeline(handler, listener, sampler)
+    return pipeline
+
+
+def stop_logging():
+    global pipeline
+    if pipeline is not None:
+        pipeline.stop()
+        pipeline = None
+
+
+def set_levels(levels):
+    '''
+    Sets the level of each logger in levels, a dict from logger name to level name or number.
+    '''
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class LogLevelWatcher:
+    '''
+    Applies LOG_LEVELS_PATH when it changes.
+    '''
+    def __init__(self, path=LOG_LEVELS_PATH, interval=LOG_LEVELS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.mtime = None
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        with open(self.path) as f:
+            levels = json.load(f)
+        set_levels(levels)
+        logger.info(f"Log levels set from {self.path}: {levels}")
+        return True
+
+    async def watch(self):
+        '''
+        Background task that applies changes of the levels file and reports dropped log records.
+        '''
+        while True:
+            try:
+                self.reload_if_changed()
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.warning(f"Could not apply log levels from {self.path}: {e}")
+            if pipeline is not None:
+                pipeline.report_drops()
+            await asyncio.sleep(self.interval)
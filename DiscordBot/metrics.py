@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import logging
+import math
+import time
+
+'''
+Metrics in the OpenMetrics text format (the Prometheus text format, ending with "# EOF"), served
+over HTTP on the local machine.
+
+    curl http://127.0.0.1:9108/metrics
+
+Metrics are module level objects, updated in place by the code they measure:
+  - Histogram: counts of observations per bucket, plus their sum and count
+  - Counter: a number that only goes up. Its family is named without the "_total" suffix, which
+    only its samples carry, as OpenMetrics requires (Prometheus reads it as untyped otherwise)
+  - Gauge: a number read from a function when the metrics are requested
+Every metric has a fixed list of label names. labels(*values) returns the series of one
+combination of values; series are created on first use and kept in a dict, so recording an
+observation costs a dict lookup, a bisect over the buckets and two additions. The cumulative
+bucket counts of the text format are only computed when the metrics are requested.
+
+The updates are not locked: they are meant to be made from the event loop thread.
+'''
+
+logger = logging.getLogger('discord')
+
+# Upper bounds (seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds (seconds) of the buckets of the event loop lag histogram
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Upper bounds of the buckets of batch size histograms
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# Seconds between two measurements of the event loop lag
+LOOP_LAG_INTERVAL = 0.5
+
+REGISTRY = []
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.series = {} # Map from a tuple of label values to its series
+        if registry is not None:
+            registry.append(self)
+
+    def labels(self, *values):
+        series = self.series.get(values)
+        if series is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes the labels {self.label_names}, got {values}")
+            series = self.series[values] = self.new_series()
+        return series
+
+    def new_series(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in list(self.series.items()):
+            lines.extend(self.render_series(values, series))
+        return lines
+
+
+class CounterSeries:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        if name.endswith("_total"):
+            name = name[:-len("_total")]
+        super().__init__(name, help, labels, registry)
+
+    def new_series(self):
+        return CounterSeries()
+
+    def render_series(self, values, series):
+        return [f"{self.name}_total{format_labels(self.label_names, values)} {format_value(series.value)}"]
+
+
+class HistogramSeries:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Observations per bucket; the last one is above every bound
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    '''
+    Context manager observing the seconds its block took.
+    '''
+    __slots__ = ("series", "start")
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.series.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.bounds = tuple(sorted(buckets))
+
+    def new_series(self):
+        return HistogramSeries(self.bounds)
+
+    def render_series(self, values, series):
+        names = self.label_names + ("le",)
+        labels = format_labels(self.label_names, values)
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + (math.inf,), list(series.counts)):
+            total += count
+            lines.append(f"{self.name}_bucket{format_labels(names, values + (format_value(bound),))} {total}")
+        lines.append(f"{self.name}_sum{labels} {format_value(series.sum)}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Gauge(Metric):
+    '''
+    A gauge whose value is read when the metrics are requested. function returns a number, or for a gauge with
+    labels a dict from tuples of label values to numbers.
+    '''
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.function is None:
+            return lines
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.warning(f"Could not read gauge {self.name}: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+### Metrics of the bot ###
+
+DETECT_LATENCY = Histogram("modbot_detect_seconds", "Latency of detect_sextortion by backend.", ["backend"])
+DETECTIONS = Counter("modbot_detections", "Detection verdicts by detector.", ["detector", "verdict"])
+STEP_LATENCY = Histogram("modbot_step_seconds", "Time to handle one message or reaction of a report or manual review, by flow step.",
+                         ["flow", "step"])
+REST_LATENCY = Histogram("modbot_rest_seconds", "Latency of Discord REST calls by route.", ["method", "route"])
+LOOP_LAG = Histogram("modbot_event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback.",
+                     buckets=LAG_BUCKETS)
+LIVE_SESSIONS = Gauge("modbot_live_sessions", "Reports and manual reviews in progress.", ["kind"])
+PENDING_REVIEWS = Gauge("modbot_pending_reviews", "Reports posted to mod channels and not reviewed yet.")
+ANALYSIS_LATENCY = Histogram("modbot_analysis_seconds", "Time from submitting an item to an analysis stage to its result, by stage.",
+                             ["stage"])
+ANALYSIS_BATCH = Histogram("modbot_analysis_batch_items", "Items sent to an analysis worker together, by stage.", ["stage"],
+                           buckets=BATCH_BUCKETS)
+ANALYSIS_ERRORS = Counter("modbot_analysis_errors", "Analysis items that failed, by stage and reason.", ["stage", "reason"])
+
+
+def instrument_http(http):
+    '''
+    Wraps the request method of a discord.py HTTPClient so every REST call is timed by its route
+    (the path template, such as /channels/{channel_id}/messages, not the path with ids).
+    '''
+    request = http.request
+
+    async def timed_request(route, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, *args, **kwargs)
+        finally:
+            REST_LATENCY.labels(route.method, route.path).observe(time.perf_counter() - start)
+
+    http.request = timed_request
+
+
+async def watch_loop_lag(interval=LOOP_LAG_INTERVAL):
+    '''
+    Background task measuring how late the event loop wakes it up.
+    '''
+    loop = asyncio.get_running_loop()
+    series = LOOP_LAG.labels()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        series.observe(max(0.0, loop.time() - start - interval))
+
+
+class MetricsServer:
+    '''
+    Minimal HTTP server answering GET /metrics with render().
+    '''
+    def __init__(self, host, port, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", render(self.registry).encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
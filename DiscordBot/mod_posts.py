@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import discord
+from render import render_mod_post
+
+'''
+Edit-in-place mod channel posts.
+
+Instead of sending a new message for every step of a review, the report's mod channel post is
+edited to show who is reviewing it, the answers logged so far, the current question and the final
+action. The question's options replace the post's reactions, so the moderator answers on the post. Message edits
+are the rate-limited resource, so ModPostEditor debounces them: updates to a post made within
+`delay` seconds of each other are collapsed into one edit with the latest content.
+'''
+
+logger = logging.getLogger('discord')
+
+
+class ModPostEditor:
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.pending = {} # Map from message_id to (channel, latest content) waiting to be written
+        self.tasks = {} # Map from message_id to the task that will write it
+
+    def update(self, channel, message_id, content):
+        '''
+        Schedules an edit of message_id. Returns immediately; the edit happens after `delay` seconds
+        with whatever content was given last.
+        '''
+        self.pending[message_id] = (channel, content)
+        if message_id not in self.tasks:
+            self.tasks[message_id] = asyncio.create_task(self.edit_later(message_id))
+
+    def cancel(self, message_id):
+        '''
+        Drops the scheduled edit of message_id, e.g. because the post is about to be rewritten directly.
+        '''
+        self.pending.pop(message_id, None)
+
+    async def edit_later(self, message_id):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.tasks.pop(message_id, None)
+            await self.write(message_id)
+
+    async def write(self, message_id):
+        channel, content = self.pending.pop(message_id, (None, None))
+        if channel is None:
+            return
+        try:
+            await channel.get_partial_message(message_id).edit(content=content)
+        except discord.errors.HTTPException as e:
+            logger.warning(f"Could not edit mod channel post {message_id}: {e}")
+
+    async def flush(self):
+        '''
+        Writes every pending edit now (used on shutdown).
+        '''
+        for task in list(self.tasks.values()):
+            task.cancel()
+        for message_id in list(self.pending):
+            await self.write(message_id)
+
+
+class ReviewSummary:
+    '''
+    The mod channel post of a report under review. ManualReview asks its questions and logs its replies
+    here instead of sending them as new messages.
+    '''
+    __slots__ = ("editor", "channel", "message_id", "record", "status", "lines", "prompt")
+
+    def __init__(self, editor, channel, message_id, record, status, lines=(), prompt=None):
+        self.editor = editor
+        self.channel = channel
+        self.message_id = message_id
+        self.record = record
+        self.status = status
+        self.lines = list(lines)
+        self.prompt = prompt # Question being asked on the post, shown after the log
+
+    def render(self):
+        return render_mod_post(self.record, self.status, self.lines + [self.prompt] if self.prompt else self.lines)
+
+    def refresh(self):
+        self.editor.update(self.channel, self.message_id, self.render())
+
+    def add(self, line):
+        self.lines.append(line)
+        self.refresh()
+
+    def set_status(self, status):
+        self.status = status
+        self.refresh()
+
+    async def ask(self, intro, prompt, emojis):
+        '''
+        Shows a question on the post: the prompt goes below the log and the options replace the post's reactions.
+        The edit is written at once since the moderator answers it next. Raises discord.errors.HTTPException
+        (Forbidden without the Manage Messages permission) before changing anything if the reactions cannot be cleared.
+        '''
+        message = self.channel.get_partial_message(self.message_id)
+        await message.clear_reactions()
+        if intro:
+            self.lines.append(intro)
+        self.prompt = prompt
+        self.refresh()
+        await self.editor.write(self.message_id)
+        for emoji in emojis:
+            await message.add_reaction(emoji)
+
+    async def reset_reactions(self, emojis):
+        '''
+        Replaces the options of the last question with emojis, e.g. the accept reaction when the report goes back
+        to the queue.
+        '''
+        self.prompt = None
+        message = self.channel.get_partial_message(self.message_id)
+        try:
+            await message.clear_reactions()
+            for emoji in emojis:
+                await message.add_reaction(emoji)
+        except discord.errors.HTTPException as e:
+            logger.warning(f"Could not reset the reactions of mod channel post {self.message_id}: {e}")
+
+    def to_dict(self):
+        return {"message_id": self.message_id, "status": self.status, "lines": self.lines, "prompt": self.prompt}
@@ -0,0 +1,316 @@
+import json
+import struct
+from enum import Enum
+from report import Category, REPORT_FLOW
+from manual import MANUAL_REVIEW_FLOW
+
+'''
+Compact records for completed reports and review outcomes.
+
+Report.report_data and ManualReview.review_data are dicts of long, human readable answers
+("Impersonation or Fake Account"). Once a report is complete it is turned into a ReportRecord,
+a __slots__ object that stores every multiple-choice answer as a one byte code in a single bytes
+object. The codes come from the order of the options in REPORT_FLOW / MANUAL_REVIEW_FLOW (1 is the
+first option, 0 means not answered), so new options must be added at the end of a step.
+
+Records can be read like the old dicts (record["demand"] == "Nude Content") and encoded to a small
+versioned binary format for persistence and for handing reports to other processes. to_json() gives
+a readable form for debugging.
+'''
+
+# Answers stored as codes, in encoding order. Only append to these tuples.
+REPORT_CODED_FIELDS = ("category", "demand", "threat", "context", "offensive_content_type", "spam_scam_content_type",
+                       "danger_type", "safety_threat_type", "criminal_behavior_type", "block")
+REVIEW_CODED_FIELDS = ("legitimate", "category", "sexual_threat_type", "severity")
+
+REPORT_VERSION = 2
+REVIEW_VERSION = 1
+
+# version, number of codes, guild_id, channel_id, message_id, author_id, reported_at, confidence, number of reporters,
+# number of extra categories, number of additional details
+REPORT_HEADER = struct.Struct("<BBQQQQdfHBH")
+# Version 1 had no author_id
+REPORT_HEADER_V1 = struct.Struct("<BBQQQdfHBH")
+REVIEW_HEADER = struct.Struct("<BB")
+STRING_LENGTH = struct.Struct("<I")
+
+
+def code_tables(flow, fields):
+    '''
+    Returns (values, codes) where values[i] is the tuple of option values of fields[i] (index 0 is None)
+    and codes[i] maps each option value back to its code.
+    '''
+    choices = flow.choices()
+    missing = set(choices) - set(fields)
+    if missing:
+        raise ValueError(f"Flow {flow.name} has answers without a record code: {sorted(missing)}")
+    values = tuple((None,) + tuple(choices.get(field, ())) for field in fields)
+    codes = tuple({value: code for code, value in enumerate(field_values) if code} for field_values in values)
+    return values, codes
+
+
+REPORT_VALUES, REPORT_CODES = code_tables(REPORT_FLOW, REPORT_CODED_FIELDS)
+REVIEW_VALUES, REVIEW_CODES = code_tables(MANUAL_REVIEW_FLOW, REVIEW_CODED_FIELDS)
+REPORT_FIELD_INDEX = {field: i for i, field in enumerate(REPORT_CODED_FIELDS)}
+REVIEW_FIELD_INDEX = {field: i for i, field in enumerate(REVIEW_CODED_FIELDS)}
+CATEGORY_CODE = REPORT_CODES[REPORT_FIELD_INDEX["category"]]
+CATEGORY_VALUE = REPORT_VALUES[REPORT_FIELD_INDEX["category"]]
+
+
+def encode_codes(data, fields, codes):
+    return bytes(codes[i].get(data.get(field), 0) for i, field in enumerate(fields))
+
+
+def pack_string(text):
+    raw = text.encode("utf-8")
+    return STRING_LENGTH.pack(len(raw)) + raw
+
+
+def unpack_string(buffer, offset):
+    (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+    offset += STRING_LENGTH.size
+    return bytes(buffer[offset:offset + length]).decode("utf-8"), offset + length
+
+
+class ReportRecord:
+    __slots__ = ("guild_id", "channel_id", "message_id", "author_id", "name", "content", "codes", "context_content",
+                 "reported_at", "confidence", "reporter_ids", "extra_categories", "additional_details")
+
+    def __init__(self, codes, name="", content="", guild_id=0, channel_id=0, message_id=0, context_content=None,
+                 reported_at=0.0, confidence=0.0, reporter_ids=(), extra_categories=b"", additional_details=(), author_id=0):
+        self.codes = codes # One code per REPORT_CODED_FIELDS entry
+        self.author_id = author_id # ID of the reported user (0 if unknown); name can change and is not unique
+        self.name = name
+        self.content = content
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.context_content = context_content
+        self.reported_at = reported_at
+        self.confidence = confidence
+        self.reporter_ids = tuple(reporter_ids)
+        self.extra_categories = extra_categories # Category codes added by merged duplicate reports
+        self.additional_details = tuple(additional_details)
+
+    @classmethod
+    def from_report_data(cls, report_data, reporter_ids=(), reported_at=None):
+        '''
+        Builds a record from a completed Report.report_data (or a legacy report_data dict).
+        '''
+        categories = report_data.get("categories") or ()
+        return cls(
+            encode_codes(report_data, REPORT_CODED_FIELDS, REPORT_CODES),
+            name=report_data.get("name", ""),
+            content=report_data.get("content", ""),
+            guild_id=report_data.get("guild_id") or 0,
+            channel_id=report_data.get("channel_id") or 0,
+            message_id=report_data.get("message_id") or 0,
+            author_id=report_data.get("author_id") or 0,
+            context_content=report_data.get("context_content"),
+            reported_at=report_data.get("reported_at", 0.0) if reported_at is None else reported_at,
+            confidence=report_data.get("confidence", 0.0),
+            reporter_ids=report_data.get("reporter_ids", reporter_ids),
+            extra_categories=bytes(CATEGORY_CODE[c] for c in categories if c in CATEGORY_CODE and c != report_data.get("category")),
+            additional_details=report_data.get("additional_details", ()),
+        )
+
+    ### Dict-style access, so a record can be used wherever report_data was ###
+
+    @property
+    def category(self):
+        return CATEGORY_VALUE[self.codes[0]]
+
+    @property
+    def categories(self):
+        '''
+        The category chosen by the first reporter followed by the ones added by merged duplicate reports.
+        '''
+        return [self.category] + [CATEGORY_VALUE[code] for code in self.extra_categories]
+
+    @property
+    def reporter_count(self):
+        return max(len(self.reporter_ids), 1)
+
+    def get(self, key, default=None):
+        index = REPORT_FIELD_INDEX.get(key)
+        if index is not None:
+            value = REPORT_VALUES[index][self.codes[index]]
+        elif key == "categories":
+            value = self.categories if self.extra_categories else None
+        elif key in ReportRecord.__slots__ or key == "reporter_count":
+            value = getattr(self, key)
+        else:
+            value = None
+        return default if value is None or value == () else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def to_report_data(self):
+        '''
+        Returns the record as a report_data dict.
+        '''
+        data = {field: self.get(field) for field in REPORT_CODED_FIELDS if field in self}
+        for key in ("guild_id", "channel_id", "message_id", "author_id", "name", "content", "context_content", "reported_at",
+                    "confidence", "reporter_count", "categories"):
+            if key in self:
+                data[key] = self.get(key)
+        data["reporter_ids"] = list(self.reporter_ids)
+        data["additional_details"] = list(self.additional_details)
+        return data
+
+    ### Merging duplicate reports ###
+
+    def add_reporter(self, reporter_id):
+        if reporter_id not in self.reporter_ids:
+            self.reporter_ids += (reporter_id,)
+
+    def add_category(self, category):
+        if category not in self.categories:
+            self.extra_categories += bytes((CATEGORY_CODE[category],))
+
+    def add_detail(self, detail):
+        if detail not in self.additional_details:
+            self.additional_details += (detail,)
+
+    ### Serialization ###
+
+    def encode(self):
+        '''
+        Returns the record in the compact binary format read by decode().
+        '''
+        parts = [
+            REPORT_HEADER.pack(REPORT_VERSION, len(self.codes), self.guild_id, self.channel_id, self.message_id,
+                               self.author_id, self.reported_at, self.confidence, len(self.reporter_ids), len(self.extra_categories),
+                               len(self.additional_details)),
+            self.codes,
+            self.extra_categories,
+            struct.pack(f"<{len(self.reporter_ids)}Q", *self.reporter_ids),
+            pack_string(self.name),
+            pack_string(self.content),
+            pack_string(self.context_content) if self.context_content is not None else STRING_LENGTH.pack(0xFFFFFFFF),
+        ]
+        parts.extend(pack_string(detail) for detail in self.additional_details)
+        return b"".join(parts)
+
+    @classmethod
+    def decode(cls, buffer, offset=0):
+        '''
+        Reads a record written by encode(). Returns (record, offset just past the record).
+        '''
+        version = buffer[offset]
+        if version == REPORT_VERSION:
+            (version, n_codes, guild_id, channel_id, message_id, author_id, reported_at, confidence, n_reporters,
+             n_categories, n_details) = REPORT_HEADER.unpack_from(buffer, offset)
+            offset += REPORT_HEADER.size
+        elif version == 1:
+            (version, n_codes, guild_id, channel_id, message_id, reported_at, confidence, n_reporters, n_categories,
+             n_details) = REPORT_HEADER_V1.unpack_from(buffer, offset)
+            author_id = 0
+            offset += REPORT_HEADER_V1.size
+        else:
+            raise ValueError(f"Unsupported report record version {version}")
+        # Records written before a field was appended have fewer codes; the missing ones are unanswered
+        codes = bytes(buffer[offset:offset + n_codes]).ljust(len(REPORT_CODED_FIELDS), b"\0")
+        offset += n_codes
+        extra_categories = bytes(buffer[offset:offset + n_categories])
+        offset += n_categories
+        reporter_ids = struct.unpack_from(f"<{n_reporters}Q", buffer, offset)
+        offset += 8 * n_reporters
+        name, offset = unpack_string(buffer, offset)
+        content, offset = unpack_string(buffer, offset)
+        if STRING_LENGTH.unpack_from(buffer, offset)[0] == 0xFFFFFFFF:
+            context_content, offset = None, offset + STRING_LENGTH.size
+        else:
+            context_content, offset = unpack_string(buffer, offset)
+        details = []
+        for _ in range(n_details):
+            detail, offset = unpack_string(buffer, offset)
+            details.append(detail)
+        record = cls(codes, name, content, guild_id, channel_id, message_id, context_content, reported_at,
+                     confidence, reporter_ids, extra_categories, details, author_id)
+        return record, offset
+
+    def to_json(self):
+        return json.dumps(self.to_report_data(), default=lambda o: o.name if isinstance(o, Enum) else str(o),
+                          ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if "category" in data:
+            data["category"] = Category[data["category"]]
+        if "categories" in data:
+            data["categories"] = [Category[c] for c in data["categories"]]
+        return cls.from_report_data(data)
+
+    def __repr__(self):
+        return f"ReportRecord({self.to_json()})"
+
+
+class ReviewRecord:
+    __slots__ = ("codes",)
+
+    def __init__(self, codes):
+        self.codes = codes # One code per REVIEW_CODED_FIELDS entry
+
+    @classmethod
+    def from_review_data(cls, review_data):
+        return cls(encode_codes(review_data, REVIEW_CODED_FIELDS, REVIEW_CODES))
+
+    def get(self, key, default=None):
+        index = REVIEW_FIELD_INDEX.get(key)
+        value = REVIEW_VALUES[index][self.codes[index]] if index is not None else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def to_review_data(self):
+        return {field: self.get(field) for field in REVIEW_CODED_FIELDS if field in self}
+
+    def encode(self):
+        return REVIEW_HEADER.pack(REVIEW_VERSION, len(self.codes)) + self.codes
+
+    @classmethod
+    def decode(cls, buffer, offset=0):
+        version, n_codes = REVIEW_HEADER.unpack_from(buffer, offset)
+        if version != REVIEW_VERSION:
+            raise ValueError(f"Unsupported review record version {version}")
+        offset += REVIEW_HEADER.size
+        codes = bytes(buffer[offset:offset + n_codes]).ljust(len(REVIEW_CODED_FIELDS), b"\0")
+        return cls(codes), offset + n_codes
+
+    def to_json(self):
+        return json.dumps(self.to_review_data(), default=lambda o: o.name if isinstance(o, Enum) else str(o))
+
+    def __repr__(self):
+        return f"ReviewRecord({self.to_json()})"
+
+
+def encode_outcome(report_record, review_record):
+    '''
+    Encodes a finished review (the review answers followed by the report) as one blob.
+    '''
+    return review_record.encode() + report_record.encode()
+
+
+def decode_outcome(buffer):
+    '''
+    Inverse of encode_outcome(). Returns (report_record, review_record).
+    '''
+    review_record, offset = ReviewRecord.decode(buffer)
+    report_record, _ = ReportRecord.decode(buffer, offset)
+    return report_record, review_record
@@ -0,0 +1,100 @@
+from report import Category, CATEGORY_NAMES
+
+'''
+Rendering of report summaries for the mod channel.
+
+Each category's summary is defined once in TEMPLATES and compiled at import into a fixed header
+and a tuple of (prefix, answer key, default) lines, so rendering a report is a single pass that
+joins a short list of strings.
+'''
+
+SEPARATOR = "==========================="
+ACCEPT_MESSAGE = SEPARATOR + "\nPress 1️⃣ to accept and review this report."
+URGENT_HEADER = "‼️Urgent Report‼️\n"
+URGENT_CATEGORIES = (Category.DANGER, Category.SEXUAL_THREAT)
+
+# Abuse type shown for each category, and the (label, answer key[, default]) lines that follow the message.
+# Lines without a default are left out when the reporter did not answer them.
+TEMPLATES = {
+    Category.SEXUAL_THREAT: ("Sexual Threat Content", [
+        ("Demand Made", "demand", "Unknown"),
+        ("Threat Made", "threat", "Unknown"),
+        ("Addtional Content", "context_content", "NONE"),
+    ]),
+    Category.OFFENSIVE_CONTENT: ("Offensive Content", [
+        ("Offensive Content Type", "offensive_content_type", "Unknown"),
+    ]),
+    Category.SPAM_SCAM: ("Spam/Scam Content", [
+        ("Spam/Scam Content Type", "spam_scam_content_type", "Unknown"),
+    ]),
+    Category.DANGER: ("Imminent Danger Content", [
+        ("Imminent Danger Type", "danger_type", "Unknown"),
+        ("Safety Threat Type", "safety_threat_type"),
+        ("Criminal Behavior Type", "criminal_behavior_type"),
+    ]),
+}
+
+
+def compile_templates(templates):
+    compiled = {}
+    for category, (abuse_type, lines) in templates.items():
+        head = f"Report Summary\n{SEPARATOR}\nAbuse Type: {abuse_type}\nReported User: "
+        compiled[category] = (head, tuple((f"\n{line[0]}: ", line[1], line[2] if len(line) > 2 else None) for line in lines))
+    return compiled
+
+
+COMPILED_TEMPLATES = compile_templates(TEMPLATES)
+# Label of every category specific answer, used to list the answers of merged duplicate reports
+DETAIL_LABELS = {key: prefix.strip("\n: ") for _, lines in COMPILED_TEMPLATES.values() for prefix, key, _ in lines}
+
+
+def render_report(record):
+    '''
+    Returns the summary of a report (a ReportRecord or report_data dict) shown to moderators.
+    '''
+    head, lines = COMPILED_TEMPLATES[record["category"]]
+    parts = [head, record["name"], "\nMessage: ", record["content"]]
+    for prefix, key, default in lines:
+        value = record.get(key, default)
+        if value is not None:
+            parts.append(prefix)
+            parts.append(value)
+    return "".join(parts)
+
+
+def report_details(record):
+    '''
+    Returns the reporter's answers to the category specific questions as "Label: Answer" strings.
+    '''
+    return [f'{label}: {record[key]}' for key, label in DETAIL_LABELS.items() if key in record]
+
+
+def render_mod_post(record, status=None, lines=()):
+    '''
+    Returns the mod channel post of a report. Waiting reports end with the accept instructions; once a
+    moderator picks the report up, status and the review log lines are shown instead.
+    '''
+    categories = record.categories
+    parts = []
+    if any(category in URGENT_CATEGORIES for category in categories):
+        parts.append(URGENT_HEADER)
+    parts.append(render_report(record))
+    if not record.reporter_ids:
+        # Reports generated by the bot carry the reason in their details
+        for detail in record.additional_details:
+            parts.append(f"\nAutomatically reported: {detail}")
+    elif record.reporter_count > 1:
+        parts.append(f'\nReported by {record.reporter_count} users as: {", ".join(CATEGORY_NAMES.get(c, "Unknown") for c in categories)}')
+        for detail in record.additional_details:
+            parts.append(f"\nAlso reported: {detail}")
+    parts.append("\n")
+    if status is None:
+        parts.append(ACCEPT_MESSAGE)
+    else:
+        parts.append(SEPARATOR)
+        parts.append("\n")
+        parts.append(status)
+        for line in lines:
+            parts.append("\n")
+            parts.append(line)
+    return "".join(parts)
@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import math
+import time
+from report import Category
+
+'''
+Priority queue of completed reports waiting for a moderator.
+
+Each report gets a fixed sort key: the time it was reported minus a head start earned from its
+category, the detector's confidence and how many users reported it. The head start works like
+an earlier arrival time, so urgent reports go to the front, and a report that has waited long
+enough still ends up ahead of newer reports that earned a bigger head start. Because the key
+never changes while a report waits, a plain heap is enough.
+'''
+
+# Head start (in seconds) given to each category
+CATEGORY_HEAD_START = {
+    Category.DANGER: 60 * 60,
+    Category.SEXUAL_THREAT: 60 * 60,
+    Category.OFFENSIVE_CONTENT: 10 * 60,
+    Category.SPAM_SCAM: 0,
+}
+# Head start for a detector confidence of 1.0 (scaled linearly)
+CONFIDENCE_HEAD_START = 30 * 60
+# Head start for every doubling of the number of reporters
+REPORTER_HEAD_START = 5 * 60
+
+
+def priority_key(record):
+    '''
+    Returns the heap key for a ReportRecord. Smaller keys are reviewed first.
+    '''
+    reported_at = record.reported_at or time.time()
+    # Merged duplicate reports may carry several categories; the most urgent one counts
+    head_start = max(CATEGORY_HEAD_START.get(category, 0) for category in record.categories)
+    head_start += CONFIDENCE_HEAD_START * record.confidence
+    head_start += REPORTER_HEAD_START * math.log2(record.reporter_count)
+    return reported_at - head_start
+
+
+class ReviewQueue:
+    def __init__(self):
+        self.heap = [] # Entries are [key, seq, message_id, record]; record is None once removed
+        self.entries = {} # Map from message_id in mod channel to its live heap entry
+        self.assigned = {} # Map from moderator id to the message_id of the report assigned to them
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, message_id):
+        return message_id in self.entries
+
+    def push(self, message_id, record):
+        '''
+        Adds (or re-prioritizes) the report posted as message_id in the mod channel.
+        '''
+        self.remove(message_id)
+        entry = [priority_key(record), next(self.counter), message_id, record]
+        self.entries[message_id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def update(self, message_id):
+        '''
+        Recomputes the priority of a waiting report after its record changed (e.g. a duplicate report was merged into it).
+        '''
+        if message_id in self.entries:
+            self.push(message_id, self.entries[message_id][3])
+
+    def remove(self, message_id):
+        '''
+        Drops a waiting report. The heap entry is invalidated in place and discarded when it reaches the top.
+        '''
+        entry = self.entries.pop(message_id, None)
+        if entry is None:
+            return None
+        record = entry[3]
+        entry[3] = None
+        return record
+
+    def peek(self):
+        '''
+        Returns the message_id of the most urgent waiting report, or None if the queue is empty.
+        '''
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][2] if self.heap else None
+
+    def assign_next(self, moderator_id):
+        '''
+        Removes the most urgent report and assigns it to moderator_id. Returns (message_id, record)
+        or None if the queue is empty. There is no await in here, so two moderators asking at the same
+        time can never be handed the same report.
+        '''
+        message_id = self.peek()
+        if message_id is None:
+            return None
+        return self.assign(message_id, moderator_id)
+
+    def assign(self, message_id, moderator_id):
+        '''
+        Removes a specific waiting report and assigns it to moderator_id. Returns (message_id, record)
+        or None if the report is not waiting (e.g. someone else already took it).
+        '''
+        record = self.remove(message_id)
+        if record is None:
+            return None
+        self.assigned[moderator_id] = message_id
+        return message_id, record
+
+    def release(self, moderator_id):
+        '''
+        Called when a moderator finishes their review.
+        '''
+        self.assigned.pop(moderator_id, None)
+
+    def metrics(self):
+        '''
+        Returns the queue depth (total and per category) and the age in seconds of the oldest waiting report.
+        '''
+        now = time.time()
+        by_category = {category: 0 for category in Category}
+        oldest = None
+        for entry in self.entries.values():
+            record = entry[3]
+            by_category[record.category] = by_category.get(record.category, 0) + 1
+            reported_at = record.reported_at or now
+            if oldest is None or reported_at < oldest:
+                oldest = reported_at
+        return {
+            "depth": len(self.entries),
+            "depth_by_category": by_category,
+            "oldest_age": now - oldest if oldest is not None else 0,
+        }
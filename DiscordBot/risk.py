@@ -0,0 +1,197 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+
+'''
+Per-user risk profiles and known-bad content.
+
+Every author the bot sees gets a small RiskProfile with decayed counters of detector hits, reports
+against them and severities confirmed by moderators. Counters decay exponentially with a half-life
+of RISK_HALF_LIFE, applied lazily when a profile is read or updated, so an update is O(1) and old
+offences stop counting on their own. Profiles are kept in LRU order and the least recently active
+ones are dropped past max_profiles.
+
+Content confirmed as severity 2 or 3 is added to a Bloom filter of message hashes. A later message
+with the same content (up to case and whitespace) is known to be bad without asking a detector.
+Unlike the spam clusters of bulk.py, links and numbers are kept: a confirmed message with one link
+must not make every other link known bad.
+
+Profiles are keyed by user ID, as names can be changed and are not unique. Reports stored before
+ReportRecord kept the reported user's ID do not count towards any profile.
+'''
+
+# Time for every decayed counter to halve
+RISK_HALF_LIFE = 30 * 24 * 60 * 60
+# Weight of each event in the risk score
+DETECTION_WEIGHT = 1.0
+REPORT_WEIGHT = 0.5
+SEVERITY_WEIGHT = 2.0 # Per severity level, so a confirmed severity 2 adds 4
+# Score from which a user is a repeat offender: their reports go to the front of the queue
+REPEAT_OFFENDER_RISK = 4.0
+# A user is trusted, and detection is skipped, with no risk, an account this old and this many clean messages
+TRUSTED_MAX_RISK = 0.1
+TRUSTED_ACCOUNT_AGE = 90 * 24 * 60 * 60
+TRUSTED_MIN_MESSAGES = 20
+MAX_PROFILES = 100000
+
+# Outcomes of RiskStore.triage()
+SKIP = "skip" # Trusted user: no detection needed
+KNOWN_BAD = "known_bad" # Content already confirmed as abuse
+ESCALATE = "escalate" # Repeat offender: run detection and fast-track a positive
+CHECK = "check" # Run detection as usual
+
+
+def content_key(content):
+    '''
+    Returns the key of content in the known-bad filter, or None for content with no text.
+    '''
+    key = " ".join((content or "").split()).casefold()
+    return key or None
+
+
+class BloomFilter:
+    '''
+    Fixed size set of hashes with no false negatives and a false positive rate of about error_rate
+    once capacity items have been added.
+    '''
+    def __init__(self, capacity=100000, error_rate=0.0001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # Double hashing: the k positions are h1 + i * h2
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class RiskProfile:
+    __slots__ = ("detections", "reports", "confirmed", "max_severity", "report_count", "messages", "updated")
+
+    def __init__(self, now):
+        self.detections = 0.0 # Decayed count of detector hits
+        self.reports = 0.0 # Decayed count of reports
+        self.confirmed = 0.0 # Decayed sum of severities confirmed by moderators
+        self.max_severity = 0 # Highest severity ever confirmed
+        self.report_count = 0 # Reports ever received
+        self.messages = 0 # Messages checked by a detector and found clean
+        self.updated = now # Time the decayed counters were last brought up to date
+
+    def decay(self, now):
+        if now > self.updated:
+            factor = 0.5 ** ((now - self.updated) / RISK_HALF_LIFE)
+            self.detections *= factor
+            self.reports *= factor
+            self.confirmed *= factor
+            self.updated = now
+
+    def risk(self):
+        return DETECTION_WEIGHT * self.detections + REPORT_WEIGHT * self.reports + SEVERITY_WEIGHT * self.confirmed
+
+
+class RiskStore:
+    def __init__(self, max_profiles=MAX_PROFILES, bad_content=None):
+        self.max_profiles = max_profiles
+        self.profiles = OrderedDict() # Map from user ID to RiskProfile, least recently active first
+        self.bad_content = bad_content if bad_content is not None else BloomFilter()
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def profile(self, user_id, now=None, create=True):
+        '''
+        Returns the up to date profile of user_id (creating it unless create is False) and marks it as recently active.
+        '''
+        now = now or time.time()
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            if not create:
+                return None
+            profile = self.profiles[user_id] = RiskProfile(now)
+            if len(self.profiles) > self.max_profiles:
+                self.profiles.popitem(last=False)
+        else:
+            self.profiles.move_to_end(user_id)
+            profile.decay(now)
+        return profile
+
+    def risk(self, user_id, now=None):
+        profile = self.profile(user_id, now, create=False)
+        return profile.risk() if profile is not None else 0.0
+
+    def confidence(self, user_id, now=None):
+        '''
+        Returns the risk of user_id scaled to [0, 1] (1 for a repeat offender), used as a report's confidence.
+        '''
+        return min(1.0, self.risk(user_id, now) / REPEAT_OFFENDER_RISK)
+
+    def is_repeat_offender(self, user_id, now=None):
+        return self.risk(user_id, now) >= REPEAT_OFFENDER_RISK
+
+    ### Updates ###
+
+    def record_detection(self, user_id, detected, now=None):
+        profile = self.profile(user_id, now)
+        if detected:
+            profile.detections += 1
+        else:
+            profile.messages += 1
+
+    def record_report(self, user_id, now=None):
+        if not user_id:
+            return
+        profile = self.profile(user_id, now)
+        profile.reports += 1
+        profile.report_count += 1
+
+    def record_review(self, record, review_data, now=None):
+        '''
+        Adds the outcome of a finished review of record (a ReportRecord). Severity 2 and 3 content is remembered as bad.
+        '''
+        severity = review_data.get("severity") if review_data.get("legitimate") else None
+        if not severity or severity < 2:
+            return
+        if record.author_id:
+            profile = self.profile(record.author_id, now)
+            profile.confirmed += severity
+            profile.max_severity = max(profile.max_severity, severity)
+        key = content_key(record.content)
+        if key is not None:
+            self.bad_content.add(key)
+
+    ### Gating ###
+
+    def is_known_bad(self, content):
+        key = content_key(content)
+        return key is not None and key in self.bad_content
+
+    def triage(self, user_id, content, account_created_at=None, now=None):
+        '''
+        Decides how much checking a message needs. Returns SKIP, KNOWN_BAD, ESCALATE or CHECK.
+        account_created_at is the author's account creation time (seconds since the epoch), if known.
+        '''
+        now = now or time.time()
+        if self.is_known_bad(content):
+            return KNOWN_BAD
+        profile = self.profile(user_id, now, create=False)
+        if profile is None:
+            return CHECK
+        risk = profile.risk()
+        if risk >= REPEAT_OFFENDER_RISK:
+            return ESCALATE
+        if risk <= TRUSTED_MAX_RISK and profile.messages >= TRUSTED_MIN_MESSAGES and \
+                account_created_at is not None and now - account_created_at >= TRUSTED_ACCOUNT_AGE:
+            return SKIP
+        return CHECK
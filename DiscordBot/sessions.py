@@ -0,0 +1,204 @@
+import sys
+import time
+from enum import Enum
+
+'''
+Idle expiry and limits for report and manual review sessions.
+
+Sessions are tracked in a hashed timer wheel. Touching a session only updates its deadline in a
+dict; the wheel slot is fixed when the session is first scheduled. When the slot comes due, the
+real deadline is checked, and a session that was touched since then goes back on the wheel.
+That makes touch O(1) and each tick O(sessions due in that slot), whatever the session count.
+'''
+
+REPORT = "report"
+REVIEW = "review"
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=1024):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {} # Map from key to its current deadline
+        self.last_tick = None # Last tick number that has been processed
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        '''
+        Sets (or moves) the deadline of key.
+        '''
+        if key not in self.deadlines:
+            self.slots[self.slot_tick(deadline) % len(self.slots)].add(key)
+        self.deadlines[key] = deadline
+
+    def cancel(self, key):
+        # The key stays in its slot and is skipped when the slot comes due
+        self.deadlines.pop(key, None)
+
+    def slot_tick(self, deadline, after=None):
+        tick = int(deadline // self.tick)
+        if after is None:
+            after = self.last_tick
+        if after is not None and tick <= after:
+            tick = after + 1
+        return tick
+
+    def advance(self, now):
+        '''
+        Processes every tick up to now and returns the keys whose deadline has passed.
+        '''
+        now_tick = int(now // self.tick)
+        if self.last_tick is None:
+            self.last_tick = now_tick - 1
+        # A wheel turn visits every slot, so there is no point sweeping more than one turn
+        start = max(self.last_tick + 1, now_tick - len(self.slots) + 1)
+        expired = []
+        for tick in range(start, now_tick + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            self.slots[index] = set()
+            for key in slot:
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    self.slots[self.slot_tick(deadline, after=tick) % len(self.slots)].add(key)
+        self.last_tick = now_tick
+        return expired
+
+
+class SessionLimitReached(Exception):
+    pass
+
+
+class SessionManager:
+    def __init__(self, idle_timeout=15 * 60, max_per_user=2, max_sessions=10000, tick=1.0):
+        self.idle_timeout = idle_timeout
+        self.max_per_user = max_per_user
+        self.max_sessions = max_sessions
+        self.wheel = TimerWheel(tick=tick, slots=max(int(idle_timeout // tick) + 1, 64))
+        self.sessions = {} # Map from (kind, key) to the user_id owning the session
+        self.per_user = {} # Map from user_id to number of live sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session):
+        return session in self.sessions
+
+    def open(self, kind, key, user_id):
+        '''
+        Starts tracking a session. Raises SessionLimitReached if the user or the bot already has the
+        maximum number of live sessions.
+        '''
+        if (kind, key) in self.sessions:
+            self.touch(kind, key)
+            return
+        if len(self.sessions) >= self.max_sessions:
+            raise SessionLimitReached("Too many reports are in progress right now. Please try again later.")
+        if self.per_user.get(user_id, 0) >= self.max_per_user:
+            raise SessionLimitReached("You already have the maximum number of reports in progress.")
+        self.sessions[(kind, key)] = user_id
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        self.wheel.schedule((kind, key), time.monotonic() + self.idle_timeout)
+
+    def restore(self, kind, key, user_id, idle=None):
+        '''
+        Tracks a session restored after a restart. The limits are not checked, since the session was
+        already counted when it was opened. idle is how many seconds it can stay idle (default idle_timeout).
+        '''
+        if (kind, key) not in self.sessions:
+            self.sessions[(kind, key)] = user_id
+            self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        self.wheel.schedule((kind, key), time.monotonic() + (self.idle_timeout if idle is None else min(idle, self.idle_timeout)))
+
+    def idle_left(self, kind, key):
+        '''
+        Returns how many seconds the session can stay idle before it expires, or None if it is not tracked.
+        '''
+        deadline = self.wheel.deadlines.get((kind, key))
+        return max(deadline - time.monotonic(), 0.0) if deadline is not None else None
+
+    def touch(self, kind, key):
+        '''
+        Records activity on a session, pushing back its expiry.
+        '''
+        if (kind, key) not in self.sessions:
+            return
+        self.wheel.schedule((kind, key), time.monotonic() + self.idle_timeout)
+
+    def close(self, kind, key):
+        '''
+        Stops tracking a session that was completed or cancelled.
+        '''
+        if (kind, key) not in self.sessions:
+            return
+        self.wheel.cancel((kind, key))
+        self.release_user(self.sessions.pop((kind, key)))
+
+    def release_user(self, user_id):
+        count = self.per_user.get(user_id, 0) - 1
+        if count > 0:
+            self.per_user[user_id] = count
+        else:
+            self.per_user.pop(user_id, None)
+
+    def expire(self, now=None):
+        '''
+        Returns a list of (kind, key) for the sessions that have been idle for longer than
+        idle_timeout. They are no longer tracked once returned.
+        '''
+        expired = []
+        for kind, key in self.wheel.advance(time.monotonic() if now is None else now):
+            self.release_user(self.sessions.pop((kind, key)))
+            expired.append((kind, key))
+        return expired
+
+    def gauges(self, objects=()):
+        '''
+        Returns the live session counts and the approximate memory in bytes held by objects
+        (e.g. the Report and ManualReview instances).
+        '''
+        counts = {REPORT: 0, REVIEW: 0}
+        for kind, _ in self.sessions:
+            counts[kind] = counts.get(kind, 0) + 1
+        return {
+            "report_sessions": counts[REPORT],
+            "review_sessions": counts[REVIEW],
+            "session_bytes": sum(deep_sizeof(obj) for obj in objects),
+        }
+
+
+def deep_sizeof(obj, seen=None):
+    '''
+    Approximate memory used by obj and the containers and instance attributes it references.
+    Clients, channels and other objects outside the session are not followed.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(type(obj), "__slots__") or hasattr(obj, "__dict__"):
+        if isinstance(obj, (type, Enum)):
+            return size
+        for name in attribute_names(type(obj)) if hasattr(type(obj), "__slots__") else vars(obj):
+            if name not in ("client", "mod_channel") and hasattr(obj, name):
+                size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+def attribute_names(cls):
+    return [name for klass in cls.__mro__ for name in getattr(klass, "__slots__", ())]
@@ -0,0 +1,103 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+'''
+Sharded, multi-process deployment.
+
+    python sharding.py --processes 4 [--shards 16]
+
+starts one ModBot per process, each an AutoShardedClient running every `processes`-th shard
+(process i runs shards i, i + processes, ...). Without --shards the shard count Discord
+recommends for the bot is used, rounded up to a multiple of the process count. Running bot.py
+directly is the single-process mode: one AutoShardedClient running every shard.
+
+Discord sends the events of a guild to shard (guild_id >> 22) % shard_count, and all DMs to shard
+0. So a guild's mod channel, review queue and settings live in the process running its shard,
+and user report sessions (which happen in DMs) live in the process running shard 0. The processes
+share the SQLite database of ReportStore:
+  - a report about a guild handled by another process is written to the handoff table and
+    picked up by that process
+  - risk profiles are rebuilt in every process from the shared report and review history
+'''
+
+DISCORD_API = "https://discord.com/api/v10"
+
+
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+
+class ShardOwnership:
+    '''
+    Which guilds and DMs the shards of this process receive. With shard_ids None the process runs every shard.
+    '''
+    def __init__(self, shard_ids=None, shard_count=None):
+        self.shard_ids = frozenset(shard_ids) if shard_ids is not None else None
+        self.shard_count = shard_count
+
+    def owns(self, guild_id):
+        return self.shard_ids is None or shard_for(guild_id, self.shard_count) in self.shard_ids
+
+    def owns_dms(self):
+        return self.shard_ids is None or 0 in self.shard_ids
+
+    def is_sharded(self):
+        return self.shard_ids is not None
+
+
+def recommended_shards(token):
+    import requests
+    response = requests.get(f"{DISCORD_API}/gateway/bot", headers={"Authorization": f"Bot {token}"}, timeout=10)
+    response.raise_for_status()
+    return response.json()["shards"]
+
+
+def run_process(shard_ids, shard_count):
+    import bot
+    from logs import start_logging, stop_logging
+    bot.load_tokens()
+    # Each process gets its own log file
+    start_logging(f"discord.shards-{shard_ids[0]}.log")
+    client = bot.ModBot(shard_ids=shard_ids, shard_count=shard_count)
+    try:
+        client.run(bot.discord_token, log_handler=None)
+    finally:
+        stop_logging()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ModBot shards across several processes.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, default=None, help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args(argv)
+
+    shard_count = args.shards
+    if shard_count is None:
+        import bot
+        bot.load_tokens()
+        shard_count = recommended_shards(bot.discord_token)
+    processes = max(1, min(args.processes, shard_count))
+    # Every process runs the same number of shards
+    shard_count = -(-shard_count // processes) * processes
+
+    workers = []
+    for i in range(processes):
+        shard_ids = list(range(i, shard_count, processes))
+        worker = multiprocessing.get_context("spawn").Process(target=run_process, args=(shard_ids, shard_count),
+                                                              name=f"modbot-shards-{i}")
+        worker.start()
+        workers.append(worker)
+    print(f"Started {processes} processes running {shard_count} shards. Press Ctrl-C to quit.")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+    return max((worker.exitcode or 0) for worker in workers)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+import array
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+
+from records import ReportRecord, REPORT_CODED_FIELDS, REPORT_CODES, REPORT_VALUES, REPORT_FIELD_INDEX
+from report import State, REPORT_FLOW
+from sessions import REPORT, REVIEW
+from store import dumps, loads
+
+'''
+Snapshot of the bot's in-flight sessions, written on a graceful shutdown and read at the next start.
+
+Everything in the snapshot is also in the store, which is written through as sessions change, so a
+crash loses nothing. The snapshot makes the restart warm: it holds the in-progress user reports (with
+the next_message_id that ties reactions to their prompt and how long each can still stay idle), the
+manual reviews in progress and the reports waiting in each mod channel, in a single file that is read
+much faster than the JSON rows of the store.
+
+File layout, all little-endian:
+
+    MAGIC, version (B), length of the metadata (I), CRC-32 of everything after this header (I)
+    metadata: JSON with the shards of the process, the time of the snapshot and the state and step
+        names that the session entries refer to by index (so a new version of the flows can read it)
+    sessions: count (I), SESSION of every session, then the answer codes of every session, its IDs (guild,
+        channel, message and author of the reported message), its texts, and any other answers as JSON
+    pending reviews: count (I), then per report PENDING and the record in the format of records.py
+    manual reviews: length (I) and the reviews as JSON, as in the store, with the seconds each can stay idle
+
+A snapshot is deleted once read, so it is never restored twice (the store is newer after that).
+'''
+
+logger = logging.getLogger('discord')
+
+MAGIC = b"MODBOTWS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sBII")
+# user_id, state index, step index, next_message_id (0 if None), seconds left before the session expires
+# (negative if unknown), flags of the answer fields it has besides the codes
+SESSION = struct.Struct("<QBHQfB")
+# message_id, guild_id (0 if None)
+PENDING = struct.Struct("<QQ")
+COUNT = struct.Struct("<I")
+
+# Answer fields stored after the codes of a session, with their flag bit
+ID_FIELDS = ("guild_id", "channel_id", "message_id", "author_id")
+TEXT_FIELDS = ("name", "content", "context_content")
+EXTRA_FLAG = 1 << (len(ID_FIELDS) + len(TEXT_FIELDS)) # Any other answers, as JSON
+
+
+class Snapshot:
+    def __init__(self, sessions=None, pending_by_guild=None, reviews=None, idle=None, created_at=None):
+        self.sessions = sessions if sessions is not None else {} # Map from user IDs to Report.to_dict() output
+        self.pending_by_guild = pending_by_guild if pending_by_guild is not None else {} # As ReportStore.load_pending_by_guild()
+        self.reviews = reviews if reviews is not None else {} # Map from moderator IDs to ManualReview.to_dict() output
+        self.idle = idle if idle is not None else {} # Map from (REPORT or REVIEW, user ID) to the seconds the session can stay idle
+        self.created_at = created_at if created_at is not None else time.time()
+
+
+def pack_text(text):
+    raw = text.encode("utf-8")
+    return COUNT.pack(len(raw)) + raw
+
+
+def unpack_text(buffer, offset):
+    (length,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    return str(buffer[offset:offset + length], "utf-8"), offset + length
+
+
+def pack_array(typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return COUNT.pack(len(values)) + values.tobytes()
+
+
+def unpack_array(typecode, buffer, offset):
+    (count,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    values = array.array(typecode)
+    values.frombytes(buffer[offset:offset + count * values.itemsize])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, offset + count * values.itemsize
+
+
+def encode_sessions(sessions, idle):
+    '''
+    Encodes {user_id: Report.to_dict() output} column by column: the fixed size part of every session, then the
+    answer codes, the IDs and the texts of all the sessions together, so they are read back with a few calls.
+    '''
+    state_index = {state: index for index, state in enumerate(State)}
+    step_index = {step.name: index for index, step in enumerate(REPORT_FLOW.steps)}
+    headers, codes, ids, lengths, texts, extras = [], [], [], [], [], []
+    for user_id, session in sessions.items():
+        answers = session["report_data"]
+        answer_codes = bytearray(len(REPORT_CODED_FIELDS))
+        flags = 0
+        extra = {}
+        for key, value in answers.items():
+            index = REPORT_FIELD_INDEX.get(key)
+            if index is not None and value in REPORT_CODES[index]:
+                answer_codes[index] = REPORT_CODES[index][value]
+            elif key in ID_FIELDS and type(value) is int:
+                flags |= 1 << ID_FIELDS.index(key)
+            elif key in TEXT_FIELDS and type(value) is str:
+                flags |= 1 << (len(ID_FIELDS) + TEXT_FIELDS.index(key))
+            else:
+                extra[key] = value
+        ids.extend(answers[field] for bit, field in enumerate(ID_FIELDS) if flags & (1 << bit))
+        for bit, field in enumerate(TEXT_FIELDS, len(ID_FIELDS)):
+            if flags & (1 << bit):
+                lengths.append(len(answers[field]))
+                texts.append(answers[field])
+        if extra:
+            flags |= EXTRA_FLAG
+            extras.append([user_id, extra])
+        headers.append(SESSION.pack(user_id, state_index[session["state"]], step_index[session["step"]],
+                                    session["next_message_id"] or 0, idle.get((REPORT, user_id), -1.0), flags))
+        codes.append(answer_codes)
+    return b"".join([COUNT.pack(len(headers))] + headers + codes + [
+        pack_array("Q", ids),
+        pack_array("I", lengths),
+        pack_text("".join(texts)),
+        pack_text(dumps(extras)),
+    ])
+
+
+def decode_sessions(buffer, offset, meta, snapshot):
+    '''
+    Inverse of encode_sessions(). Adds the sessions to snapshot and returns the offset just past them.
+    '''
+    states = [State[name] if name in State.__members__ else None for name in meta["states"]]
+    steps = meta["steps"]
+    width = meta["codes"]
+    (count,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    headers = SESSION.iter_unpack(buffer[offset:offset + count * SESSION.size])
+    offset += count * SESSION.size
+    codes = bytes(buffer[offset:offset + count * width])
+    offset += count * width
+    ids, offset = unpack_array("Q", buffer, offset)
+    lengths, offset = unpack_array("I", buffer, offset)
+    texts, offset = unpack_text(buffer, offset)
+    extras, offset = unpack_text(buffer, offset)
+    extras = {user_id: extra for user_id, extra in loads(extras)}
+
+    # Most sessions share their answers so far, so each distinct set of codes is decoded once
+    coded_answers = {}
+    next_id = iter(ids).__next__
+    next_length = iter(lengths).__next__
+    position = 0
+    for row, (user_id, state, step, next_message_id, idle, flags) in enumerate(headers):
+        answer_codes = codes[row * width:(row + 1) * width]
+        answers = coded_answers.get(answer_codes)
+        if answers is None:
+            answers = coded_answers[answer_codes] = {REPORT_CODED_FIELDS[index]: REPORT_VALUES[index][code]
+                                                     for index, code in enumerate(answer_codes) if code}
+        answers = dict(answers)
+        if flags:
+            for bit, field in enumerate(ID_FIELDS):
+                if flags & (1 << bit):
+                    answers[field] = next_id()
+            for bit, field in enumerate(TEXT_FIELDS, len(ID_FIELDS)):
+                if flags & (1 << bit):
+                    end = position + next_length()
+                    answers[field] = texts[position:end]
+                    position = end
+            if flags & EXTRA_FLAG:
+                answers.update(extras[user_id])
+        # Sessions in a state that no longer exists are dropped, like the ones in an unknown step
+        if states[state] is None:
+            continue
+        snapshot.sessions[user_id] = {"state": states[state], "step": steps[step], "report_data": answers,
+                                      "next_message_id": next_message_id or None}
+        if idle >= 0:
+            snapshot.idle[(REPORT, user_id)] = idle
+    return offset
+
+
+def encode_snapshot(snapshot, shard_ids=None, shard_count=None):
+    meta = {"created_at": snapshot.created_at, "shard_ids": sorted(shard_ids) if shard_ids is not None else None,
+            "shard_count": shard_count,
+            "states": [state.name for state in State], "steps": [step.name for step in REPORT_FLOW.steps],
+            "codes": len(REPORT_CODED_FIELDS)}
+    parts = [json.dumps(meta).encode("utf-8")]
+    parts.append(encode_sessions(snapshot.sessions, snapshot.idle))
+    pending = [(message_id, guild_id, record) for guild_id, reports in snapshot.pending_by_guild.items()
+               for message_id, record in reports.items()]
+    parts.append(COUNT.pack(len(pending)))
+    for message_id, guild_id, record in pending:
+        parts.append(PENDING.pack(message_id, guild_id or 0))
+        parts.append(record.encode())
+    parts.append(pack_text(dumps([[moderator_id, review, snapshot.idle.get((REVIEW, moderator_id))]
+                                  for moderator_id, review in snapshot.reviews.items()])))
+    body = b"".join(parts)
+    return SNAPSHOT_HEADER.pack(MAGIC, SNAPSHOT_VERSION, len(parts[0]), zlib.crc32(body)) + body
+
+
+def decode_snapshot(data):
+    '''
+    Inverse of encode_snapshot(). Returns (snapshot, metadata). Raises ValueError if data is not a valid snapshot.
+    '''
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError("Snapshot is truncated")
+    magic, version, meta_length, checksum = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+    buffer = memoryview(data)[SNAPSHOT_HEADER.size:]
+    if zlib.crc32(buffer) != checksum:
+        raise ValueError("Snapshot checksum does not match")
+    meta = json.loads(bytes(buffer[:meta_length]))
+
+    snapshot = Snapshot(created_at=meta["created_at"])
+    offset = decode_sessions(buffer, meta_length, meta, snapshot)
+    (count,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    for _ in range(count):
+        message_id, guild_id = PENDING.unpack_from(buffer, offset)
+        record, offset = ReportRecord.decode(buffer, offset + PENDING.size)
+        snapshot.pending_by_guild.setdefault(guild_id or None, {})[message_id] = record
+    reviews, offset = unpack_text(buffer, offset)
+    for moderator_id, review, idle in loads(reviews):
+        snapshot.reviews[moderator_id] = review
+        if idle is not None:
+            snapshot.idle[(REVIEW, moderator_id)] = idle
+    return snapshot, meta
+
+
+def save_snapshot(path, snapshot, shard_ids=None, shard_count=None):
+    '''
+    Writes snapshot to path, replacing the file only once it is completely written.
+    '''
+    data = encode_snapshot(snapshot, shard_ids, shard_count)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(data)
+
+
+def load_snapshot(path, shard_ids=None, shard_count=None):
+    '''
+    Reads and deletes the snapshot at path. Returns None if there is none, or if it is invalid or was written by a
+    process running other shards (the store has the same state then).
+    '''
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    os.remove(path)
+    try:
+        snapshot, meta = decode_snapshot(data)
+    except (ValueError, KeyError, IndexError, struct.error) as e:
+        logger.warning(f"Ignoring the session snapshot {path}: {e}")
+        return None
+    if meta["shard_ids"] != (sorted(shard_ids) if shard_ids is not None else None) or meta["shard_count"] != shard_count:
+        return None
+    return snapshot
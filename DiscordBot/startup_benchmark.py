@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+'''
+Startup time of the bot, measured offline.
+
+    python startup_benchmark.py [--runs 5] [--db reports.db] [--backend gemini]
+
+Each run starts a fresh Python process (so nothing is cached in memory) that times:
+  - import: importing bot.py and everything it imports
+  - construct: ModBot() (opening the database and restoring sessions, reviews and risk profiles)
+  - ready: setup_hook() and indexing the guild, with the fake Discord of loadtest.py
+  - backend: importing the detector backend (done in the background after on_ready)
+With --db, each run starts from a copy of that database. The slowest imports of the last run are
+listed from `python -X importtime`.
+'''
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+async def measure(backend):
+    start = time.perf_counter()
+    import bot
+    imported = time.perf_counter()
+    import loadtest
+    from detection import detectors
+    world = loadtest.FakeDiscord(loadtest.SimulatedREST(0, 0))
+    before = time.perf_counter()
+    client = loadtest.LoadTestBot(world)
+    constructed = time.perf_counter()
+    client.metrics.port = 0
+    await client.setup_hook()
+    await client.on_guild_available(world.guild)
+    ready = time.perf_counter()
+    result = {"import": imported - start, "construct": constructed - before, "ready": ready - constructed}
+    if backend:
+        try:
+            await detectors.load(backend)
+            result["backend"] = time.perf_counter() - ready
+        except Exception as e:
+            result["backend_error"] = f"{type(e).__name__}: {e}"
+    await client.close()
+    return result
+
+
+def run_child(args, workdir, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+              [os.path.join(SCRIPT_DIR, "startup_benchmark.py"), "--child"] + (["--backend", args.backend] if args.backend else [])
+    if args.db:
+        shutil.copy(args.db, os.path.join(workdir, "reports.db"))
+    env = dict(os.environ, PYTHONPATH=SCRIPT_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    process = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise SystemExit(f"Benchmark process failed:\n{process.stderr}")
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def slowest_imports(importtime_output, count=15):
+    '''
+    Returns [(cumulative seconds, module)] of the slowest imports in `python -X importtime` output, including
+    the ones made by other modules (so bot and the heavy modules it imports both appear).
+    '''
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup time of the bot.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--db", help="database to start from (default: an empty one)")
+    parser.add_argument("--backend", default=None, help="also time importing this detector backend")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print(json.dumps(asyncio.run(measure(args.backend))))
+        return 0
+    if args.db:
+        args.db = os.path.abspath(args.db)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="modbot-startup-") as workdir:
+        for _ in range(args.runs):
+            # Each run starts from nothing (the bot creates files and directories such as analytics/)
+            for name in os.listdir(workdir):
+                path = os.path.join(workdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            results.append(run_child(args, workdir)[0])
+        _, importtime_output = run_child(args, workdir, importtime=True)
+
+    print(f"{'phase':<12}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for phase in ("import", "construct", "ready", "backend"):
+        values = [result[phase] for result in results if phase in result]
+        if values:
+            print(f"{phase:<12}{statistics.median(values) * 1000:>12.1f}{min(values) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+    errors = {result["backend_error"] for result in results if "backend_error" in result}
+    for error in errors:
+        print(f"backend: {error}")
+    print("\nSlowest imports (cumulative ms):")
+    for seconds, module in slowest_imports(importtime_output):
+        print(f"  {seconds * 1000:>8.1f} {module}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,481 @@
+import base64
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+import report
+from records import ReportRecord, ReviewRecord, encode_outcome, decode_outcome
+
+'''
+Durable storage for the bot's report state.
+
+Everything the bot keeps in memory about reports (in-progress user reports, reports waiting in the
+mod channel, the manual review currently in progress and finished review outcomes) is mirrored into
+a SQLite database in WAL mode. Writes are put on a queue and applied in batches by a background
+thread, so the event loop never waits on the disk. On startup the bot reads the database back to
+rebuild its in-memory maps.
+
+Completed reports and review outcomes are stored in the binary format of records.py. In-progress
+sessions are stored as JSON.
+'''
+
+logger = logging.getLogger('discord')
+
+# Enums that may appear inside report_data / review_data. They are stored as {"__enum__": key, "name": member}.
+# Unknown enums (e.g. from an older version of the bot) are loaded as their member name.
+ENUMS = {
+    "report.State": report.State,
+    "report.Category": report.Category,
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    category TEXT,
+    reported_name TEXT,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_created_at ON pending (created_at);
+CREATE INDEX IF NOT EXISTS pending_category ON pending (category, created_at);
+CREATE TABLE IF NOT EXISTS in_review (
+    moderator_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reporter_id INTEGER,
+    reported_name TEXT,
+    category TEXT,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS reports_reported_name ON reports (reported_name, created_at);
+CREATE INDEX IF NOT EXISTS reports_category ON reports (category, created_at);
+CREATE INDEX IF NOT EXISTS reports_created_at ON reports (created_at);
+CREATE TABLE IF NOT EXISTS reviews (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    moderator_id INTEGER,
+    reported_name TEXT,
+    category TEXT,
+    severity INTEGER,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reviews_reported_name ON reviews (reported_name, created_at);
+CREATE INDEX IF NOT EXISTS reviews_category ON reviews (category, severity, created_at);
+CREATE INDEX IF NOT EXISTS reviews_created_at ON reviews (created_at);
+CREATE TABLE IF NOT EXISTS guild_config (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS handoff (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+'''
+
+# Columns added after a table was first created, as (table, column, type)
+MIGRATIONS = [
+    ("pending", "guild_id", "INTEGER"),
+    ("reports", "source", "TEXT"),
+]
+
+
+def _default(obj):
+    if isinstance(obj, ReportRecord):
+        return {"__report__": base64.b64encode(obj.encode()).decode("ascii")}
+    if isinstance(obj, Enum):
+        return {"__enum__": f"{type(obj).__module__}.{type(obj).__name__}", "name": obj.name}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _object_hook(obj):
+    if "__report__" in obj:
+        return ReportRecord.decode(base64.b64decode(obj["__report__"]))[0]
+    if "__enum__" in obj:
+        enum = ENUMS.get(obj["__enum__"])
+        return enum[obj["name"]] if enum is not None and obj["name"] in enum.__members__ else obj["name"]
+    return obj
+
+
+def dumps(data):
+    '''
+    Serializes report_data / review_data (which contain Enum members) to a JSON string.
+    '''
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(text):
+    '''
+    Inverse of dumps().
+    '''
+    return json.loads(text, object_hook=_object_hook)
+
+
+def _category_name(data):
+    category = data.get("category")
+    return category.name if isinstance(category, Enum) else category
+
+
+def _load_report(data):
+    # Rows written before records.py are JSON report_data dicts
+    if isinstance(data, str):
+        return ReportRecord.from_report_data(loads(data))
+    return ReportRecord.decode(data)[0]
+
+
+def _load_outcome(data):
+    if isinstance(data, str):
+        outcome = loads(data)
+        return ReportRecord.from_report_data(outcome["report"]), ReviewRecord.from_review_data(outcome["review"])
+    return decode_outcome(data)
+
+
+class ReportStore:
+    def __init__(self, path="reports.db", batch_size=1000, flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._closed = False
+
+        # Connection used for reads from the event loop thread (and from to_thread helpers).
+        self._read_lock = threading.Lock()
+        self._read_conn = self._connect()
+        self._read_conn.executescript(SCHEMA)
+        self._migrate()
+
+        self._writer = threading.Thread(target=self._write_loop, name="report-store-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _migrate(self):
+        for table, column, kind in MIGRATIONS:
+            columns = [row[1] for row in self._read_conn.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                self._read_conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+    ### Writes (queued, never block the caller) ###
+
+    def _submit(self, sql, params):
+        self._submit_group([(sql, params)])
+
+    def _submit_group(self, statements):
+        '''
+        Queues statements that must be committed together; a group is never split across transactions.
+        '''
+        if self._closed:
+            raise RuntimeError("ReportStore is closed")
+        self._queue.put(statements)
+
+    def save_session(self, user_id, session):
+        '''
+        Upserts an in-progress user report. session is the dict returned by Report.to_dict().
+        '''
+        self._submit(
+            "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, dumps(session), time.time()),
+        )
+
+    def delete_session(self, user_id):
+        self._submit("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def add_pending(self, message_id, record, created_at=None, guild_id=None):
+        '''
+        Records a completed report (a ReportRecord) that was posted to the mod channel of guild_id and is waiting for review.
+        '''
+        self._submit(
+            "INSERT OR REPLACE INTO pending (message_id, guild_id, category, reported_name, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (message_id, guild_id, _category_name(record), record.name, record.encode(),
+             created_at if created_at is not None else time.time()),
+        )
+
+    def remove_pending(self, message_id):
+        self._submit("DELETE FROM pending WHERE message_id = ?", (message_id,))
+
+    def add_report(self, reporter_id, record, source="user"):
+        '''
+        Appends a completed report (a ReportRecord) to the report history. source is "user" for a report made by a
+        user, or the name of the detector that made it.
+        '''
+        self._submit(
+            "INSERT INTO reports (reporter_id, reported_name, category, data, created_at, source) VALUES (?, ?, ?, ?, ?, ?)",
+            (reporter_id, record.name, _category_name(record), record.encode(), time.time(), source),
+        )
+
+    def save_review(self, moderator_id, review):
+        '''
+        Upserts the manual review a moderator is working on. review is the dict returned by ManualReview.to_dict().
+        '''
+        self._submit(
+            "INSERT INTO in_review (moderator_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(moderator_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (moderator_id, dumps(review), time.time()),
+        )
+
+    def delete_review(self, moderator_id):
+        self._submit("DELETE FROM in_review WHERE moderator_id = ?", (moderator_id,))
+
+    def add_review_outcome(self, moderator_id, report_record, review_record):
+        '''
+        Appends the outcome of a finished manual review (a ReportRecord and a ReviewRecord) to the review history.
+        '''
+        self._submit(
+            "INSERT INTO reviews (moderator_id, reported_name, category, severity, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (moderator_id, report_record.name, _category_name(review_record), review_record.get("severity"),
+             encode_outcome(report_record, review_record), time.time()),
+        )
+
+    def add_review_outcomes(self, moderator_id, outcomes):
+        '''
+        Records a bulk review in one transaction. outcomes is a list of (message_id, ReportRecord, ReviewRecord):
+        each report leaves the pending table and its outcome is appended to the review history.
+        '''
+        now = time.time()
+        statements = []
+        for message_id, report_record, review_record in outcomes:
+            statements.append(("DELETE FROM pending WHERE message_id = ?", (message_id,)))
+            statements.append((
+                "INSERT INTO reviews (moderator_id, reported_name, category, severity, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (moderator_id, report_record.name, _category_name(review_record), review_record.get("severity"),
+                 encode_outcome(report_record, review_record), now),
+            ))
+        self._submit_group(statements)
+
+    def save_guild_config(self, guild_id, config):
+        '''
+        Upserts the settings of a guild. config is the dict returned by GuildConfig.to_dict().
+        '''
+        self._submit(
+            "INSERT INTO guild_config (guild_id, data) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET data = excluded.data",
+            (guild_id, dumps(config)),
+        )
+
+    def hand_off(self, guild_id, record):
+        '''
+        Queues a completed report (a ReportRecord) for the process that handles guild_id (see sharding.py).
+        '''
+        self._submit("INSERT INTO handoff (guild_id, data, created_at) VALUES (?, ?, ?)",
+                     (guild_id, record.encode(), time.time()))
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            # Gather whatever else is already queued (or arrives shortly) into the same transaction.
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._apply(conn, batch)
+            finally:
+                # flush() and close() wait on every item, whatever happened to it
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                break
+        conn.close()
+
+    def _apply(self, conn, batch):
+        '''
+        Commits a batch in one transaction. If it fails, each group is retried in its own transaction, so a bad
+        write only loses itself.
+        '''
+        try:
+            self._commit(conn, batch)
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"ReportStore: dropped a write that failed: {e}")
+                return
+            logger.warning(f"ReportStore: failed to write batch of {len(batch)}, retrying each write: {e}")
+        for statements in batch:
+            try:
+                self._commit(conn, [statements])
+            except Exception as e:
+                logger.error(f"ReportStore: dropped a write that failed: {e} ({statements[0][0]})")
+
+    def _commit(self, conn, batch):
+        try:
+            conn.execute("BEGIN")
+            for statements in batch:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except Exception:
+            # BEGIN itself may have failed, in which case there is nothing to roll back
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error as e:
+                    logger.error(f"ReportStore: rollback failed: {e}")
+            raise
+
+    def flush(self):
+        '''
+        Blocks until every write queued so far has been committed.
+        '''
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self._read_conn.close()
+
+    ### Reads ###
+
+    def _fetchall(self, sql, params=()):
+        with self._read_lock:
+            return self._read_conn.execute(sql, params).fetchall()
+
+    def load_sessions(self):
+        '''
+        Returns {user_id: session dict} for every in-progress user report.
+        '''
+        return {user_id: loads(data) for user_id, data in self._fetchall("SELECT user_id, data FROM sessions")}
+
+    def load_pending_by_guild(self):
+        '''
+        Returns {guild_id: {message_id: ReportRecord}} for every report waiting in a mod channel, oldest first.
+        Reports stored before guilds were tracked have guild_id None.
+        '''
+        pending = {}
+        for message_id, guild_id, data in self._fetchall("SELECT message_id, guild_id, data FROM pending ORDER BY created_at"):
+            pending.setdefault(guild_id, {})[message_id] = _load_report(data)
+        return pending
+
+    def take_handoffs(self, shard_ids, shard_count):
+        '''
+        Returns [(id, guild_id, ReportRecord)] of the reports handed off to guilds of the given shards and deletes
+        them, in one transaction: a report is taken once, even by processes running at the same time or restarted.
+        '''
+        placeholders = ", ".join("?" * len(shard_ids))
+        with self._read_lock:
+            conn = self._read_conn
+            # IMMEDIATE takes the write lock before the SELECT, so no other process can take the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    f"SELECT id, guild_id, data FROM handoff WHERE ((guild_id >> 22) % ?) IN ({placeholders}) ORDER BY id",
+                    [shard_count, *shard_ids],
+                ).fetchall()
+                conn.executemany("DELETE FROM handoff WHERE id = ?", [(row[0],) for row in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        return [(row_id, guild_id, _load_report(data)) for row_id, guild_id, data in rows]
+
+    def last_id(self, table):
+        return self._fetchall(f"SELECT COALESCE(MAX(id), 0) FROM {table}")[0][0]
+
+    def reports_since(self, after_id, limit=1000):
+        '''
+        Returns [(id, ReportRecord)] of the reports added to the history after after_id, oldest first.
+        '''
+        rows = self._fetchall("SELECT id, data FROM reports WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+        return [(row_id, _load_report(data)) for row_id, data in rows]
+
+    def reviews_since(self, after_id, limit=1000):
+        '''
+        Returns [(id, ReportRecord, ReviewRecord)] of the review outcomes added after after_id, oldest first.
+        '''
+        rows = self._fetchall("SELECT id, data FROM reviews WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+        return [(row_id, *_load_outcome(data)) for row_id, data in rows]
+
+    def report_rows_since(self, after_id, limit=1000):
+        '''
+        Returns [(id, reporter_id, source, created_at, ReportRecord)] of the reports added after after_id, oldest first.
+        source is None for reports stored before it was recorded.
+        '''
+        rows = self._fetchall("SELECT id, reporter_id, source, created_at, data FROM reports WHERE id > ? ORDER BY id LIMIT ?",
+                              (after_id, limit))
+        return [(row_id, reporter_id, source, created_at, _load_report(data))
+                for row_id, reporter_id, source, created_at, data in rows]
+
+    def review_rows_since(self, after_id, limit=1000):
+        '''
+        Returns [(id, moderator_id, created_at, ReportRecord, ReviewRecord)] of the review outcomes added after after_id,
+        oldest first.
+        '''
+        rows = self._fetchall("SELECT id, moderator_id, created_at, data FROM reviews WHERE id > ? ORDER BY id LIMIT ?",
+                              (after_id, limit))
+        return [(row_id, moderator_id, created_at, *_load_outcome(data)) for row_id, moderator_id, created_at, data in rows]
+
+    def load_guild_configs(self):
+        '''
+        Returns {guild_id: config dict} for every guild with saved settings.
+        '''
+        return {guild_id: loads(data) for guild_id, data in self._fetchall("SELECT guild_id, data FROM guild_config")}
+
+    def load_reviews(self):
+        '''
+        Returns {moderator_id: review dict} for every manual review in progress.
+        '''
+        return {moderator_id: loads(data) for moderator_id, data in self._fetchall("SELECT moderator_id, data FROM in_review")}
+
+    def report_history(self, reported_name=None, category=None, since=None, limit=100):
+        '''
+        Returns the most recent completed reports (ReportRecords) matching the filters, newest first.
+        Each filter is served by an index on (column, created_at).
+        '''
+        return [_load_report(data) for data in self._history("reports", reported_name, category, since, limit)]
+
+    def review_history(self, reported_name=None, category=None, since=None, limit=100):
+        '''
+        Returns the most recent review outcomes as (ReportRecord, ReviewRecord) pairs, newest first.
+        '''
+        return [_load_outcome(data) for data in self._history("reviews", reported_name, category, since, limit)]
+
+    def _history(self, table, reported_name, category, since, limit):
+        clauses, params = [], []
+        if reported_name is not None:
+            clauses.append("reported_name = ?")
+            params.append(reported_name)
+        if category is not None:
+            clauses.append("category = ?")
+            params.append(category.name if isinstance(category, Enum) else category)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(limit)
+        return [row[0] for row in self._fetchall(f"SELECT data FROM {table} {where} ORDER BY created_at DESC LIMIT ?", params)]
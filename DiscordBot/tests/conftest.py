@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot's modules import each other by bare name, as when bot.py is run from DiscordBot/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+from records import ReportRecord
+from risk import KNOWN_BAD, RiskStore
+
+
+def confirm(risk, content, author_id=1):
+    risk.record_review(ReportRecord((), content=content, author_id=author_id), {"legitimate": True, "severity": 3})
+
+
+def test_confirmed_link_does_not_flag_other_links():
+    risk = RiskStore()
+    confirm(risk, "https://evil.example/pay-now")
+    assert risk.is_known_bad("https://evil.example/pay-now")
+    assert risk.is_known_bad("  HTTPS://evil.example/pay-now ")
+    assert not risk.is_known_bad("https://github.com/discord/discord-api-docs")
+    assert risk.triage(2, "https://github.com/discord/discord-api-docs") != KNOWN_BAD
+
+
+def test_confirmed_numbers_are_kept():
+    risk = RiskStore()
+    confirm(risk, "send 500 or else")
+    assert not risk.is_known_bad("send 100 or else")
+
+
+def test_empty_content_is_never_known_bad():
+    risk = RiskStore()
+    confirm(risk, "")
+    confirm(risk, "   ")
+    assert not risk.is_known_bad("")
+    assert not risk.is_known_bad("😀")
+    confirm(risk, "😀")
+    assert risk.is_known_bad("😀")
+    assert not risk.is_known_bad("😡")
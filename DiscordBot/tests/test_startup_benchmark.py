@@ -0,0 +1,11 @@
+import asyncio
+
+import startup_benchmark
+
+
+def test_measure_runs_once(tmp_path, monkeypatch):
+    # The bot writes its database, snapshot and analytics to the working directory
+    monkeypatch.chdir(tmp_path)
+    result = asyncio.run(startup_benchmark.measure(None))
+    assert set(result) == {"import", "construct", "ready"}
+    assert all(seconds >= 0 for seconds in result.values())
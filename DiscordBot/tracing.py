@@ -0,0 +1,216 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+'''
+Span-based tracing of events.
+
+A trace starts in an event handler (on_message, on_raw_reaction_add) with start_trace(), and
+the work done for that event opens spans inside it with span() or the @traced decorator. The
+current span is kept in a ContextVar: discord.py runs every event in its own task, and tasks copy
+the context they are created in, so spans nest correctly across awaits and concurrent events.
+
+Only a sample of the events is traced (Tracer.sample_rate). When an event is not sampled there is
+no current span, and span() returns a shared no-op context manager after one ContextVar lookup,
+so code paths that are traced cost next to nothing when tracing is off.
+
+Finished spans are written by a background thread to a file in the Trace Event Format (one
+complete event per span) that chrome://tracing and https://ui.perfetto.dev open directly. Each
+trace is shown on its own row; the trace and span ids and the attributes are in the event's args.
+'''
+
+logger = logging.getLogger('discord')
+
+# Fraction of events traced
+TRACE_SAMPLE_RATE = 0.01
+TRACE_PATH = 'traces.json'
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "attributes", "start", "token")
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = None
+        self.token = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        _current.reset(self.token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.export(self, end)
+        return False
+
+
+class NoSpan:
+    '''
+    Stands in for a span when the event is not traced.
+    '''
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, path=TRACE_PATH):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.pid = os.getpid()
+        # Wall clock time of perf_counter_ns() == 0, so the spans of several processes line up
+        self.epoch_ns = time.time_ns() - time.perf_counter_ns()
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+
+    def start_trace(self, name, **attributes):
+        '''
+        Returns the root span of a new trace, or a no-op span if the event is not sampled. A trace already in
+        progress is continued instead.
+        '''
+        parent = _current.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NO_SPAN
+        return Span(self, name, random.getrandbits(128), None, attributes)
+
+    def export(self, span, end):
+        args = {"trace_id": f"{span.trace_id:032x}", "span_id": f"{span.span_id:016x}"}
+        if span.parent_id is not None:
+            args["parent_id"] = f"{span.parent_id:016x}"
+        args.update(span.attributes)
+        event = {
+            "name": span.name,
+            "ph": "X",
+            "ts": (self.epoch_ns + span.start) // 1000,
+            "dur": (end - span.start) // 1000,
+            "pid": self.pid,
+            "tid": span.trace_id & 0xFFFFFFFF,
+            "args": args,
+        }
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+            self._writer.start()
+        self._queue.put(event)
+
+    def _write_loop(self):
+        # The format allows a trailing comma and a missing closing bracket, so the file is valid after every line
+        new_file = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("[\n")
+            while True:
+                event = self._queue.get()
+                if event is None:
+                    break
+                f.write(json.dumps(event, default=str) + ",\n")
+                # Write a burst of spans at once
+                while not self._queue.empty():
+                    event = self._queue.get()
+                    if event is None:
+                        f.flush()
+                        return
+                    f.write(json.dumps(event, default=str) + ",\n")
+                f.flush()
+
+    def close(self):
+        '''
+        Writes the queued spans.
+        '''
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+
+tracer = Tracer()
+
+
+def configure(sample_rate=TRACE_SAMPLE_RATE, path=TRACE_PATH):
+    '''
+    Replaces the tracer used by start_trace() and span().
+    '''
+    global tracer
+    tracer.close()
+    tracer = Tracer(sample_rate, path)
+    return tracer
+
+
+def start_trace(name, **attributes):
+    return tracer.start_trace(name, **attributes)
+
+
+def span(name, **attributes):
+    '''
+    Returns a span inside the current trace, or a no-op span if the current event is not traced.
+    '''
+    parent = _current.get()
+    if parent is None:
+        return NO_SPAN
+    return Span(parent.tracer, name, parent.trace_id, parent.span_id, attributes)
+
+
+def current_trace_id():
+    parent = _current.get()
+    return f"{parent.trace_id:032x}" if parent is not None else None
+
+
+def traced(name):
+    '''
+    Decorator running a coroutine function in a span.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return await function(*args, **kwargs)
+            with span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_http(http):
+    '''
+    Wraps the request method of a discord.py HTTPClient so every REST call is a span.
+    '''
+    request = http.request
+
+    async def traced_request(route, *args, **kwargs):
+        if _current.get() is None:
+            return await request(route, *args, **kwargs)
+        with span(f"{route.method} {route.path}"):
+            return await request(route, *args, **kwargs)
+
+    http.request = traced_request